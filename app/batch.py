@@ -0,0 +1,217 @@
+"""
+Batch execution of many questions against one property.
+
+Questions are parsed and validated concurrently, then core specs that share
+the date range, dimensions and page filter are merged into one report with
+the union of their metrics. A union GA4 would reject is split until every
+part passes the compatibility check. Merged reports are sent up to
+BATCH_REPORTS_PER_CALL at a time through batchRunReports and the result
+columns are fanned back out to each question.
+"""
+
+from utils.packages import *
+from utils.config import *
+from utils.response_structure import *
+from app.ga4_client import *
+from app.ga4_schema_validator import *
+from app.nl_parser import *
+from app.summarizer import *
+from app.ga4_scheduler import ga4_lane
+from app.compatibility import check_compatibility_async
+
+BATCH_REPORTS_PER_CALL = 5
+MAX_METRICS_PER_REPORT = 10
+
+
+def group_key(parsed):
+    page_path = parsed.get("page_path")
+    if isinstance(page_path, list):
+        page_path = tuple(page_path)
+    if is_realtime(parsed):
+        return ("realtime", tuple(parsed["dimensions"]), tuple(parsed.get("minute_ranges", ['30'])))
+    return ("core", parsed["start_date"], parsed["end_date"], tuple(parsed["dimensions"]), page_path)
+
+
+def merge_specs(plans):
+    """
+    Group validated plans by report shape and union their metrics. Returns a
+    list of (key, metrics) with at most MAX_METRICS_PER_REPORT metrics each.
+    """
+    groups = OrderedDict()
+    for plan in plans:
+        metrics = groups.setdefault(group_key(plan["parsed"]), [])
+        for m in plan["parsed"]["metrics"]:
+            if m not in metrics:
+                metrics.append(m)
+
+    merged = []
+    for key, metrics in groups.items():
+        for i in range(0, len(metrics), MAX_METRICS_PER_REPORT):
+            merged.append((key, metrics[i:i + MAX_METRICS_PER_REPORT]))
+    return merged
+
+
+async def compatible_specs(property_id, key, metrics):
+    """Split a merged core spec until each part passes the compatibility check."""
+    if key[0] != "core" or len(metrics) < 2:
+        return [(key, metrics)]
+    dimensions = list(key[3])
+    try:
+        check_compatibility_result(await check_compatibility_async(property_id, metrics, dimensions), metrics, dimensions)
+        return [(key, metrics)]
+    except GA4ValidationError:
+        # Each question passed on its own, so halving ends in compatible parts
+        half = len(metrics) // 2
+        logger.info(f"Merged metrics {metrics} are not compatible together, splitting them")
+        return await compatible_specs(property_id, key, metrics[:half]) + await compatible_specs(property_id, key, metrics[half:])
+
+
+async def split_incompatible(property_id, merged):
+    parts = await asyncio.gather(*[compatible_specs(property_id, key, metrics) for key, metrics in merged])
+    return [spec for part in parts for spec in part]
+
+
+async def plan_question(property_id, query):
+    parsed = await parse_query_async(query)
+    if not parsed.get("metrics"):
+        raise ValueError("No valid GA4 metrics found")
+    mode = "realtime" if is_realtime(parsed) else "core"
+    metrics, dimensions = await validate_with_auto_repair_async(
+        property_id=property_id,
+        metrics=parsed["metrics"],
+        dimensions=parsed.get("dimensions", []),
+        mode=mode
+    )
+    parsed["metrics"], parsed["dimensions"] = metrics, dimensions
+    return {"query": query, "parsed": parsed, "mode": mode}
+
+
+def is_invalid_request(error) -> bool:
+    # GA4 answers 400 INVALID_ARGUMENT e.g. for metrics that cannot be queried together
+    return isinstance(error, google_exceptions.InvalidArgument)
+
+
+def spec_request(property_id, spec):
+    key, metrics = spec
+    return build_report_request(property_id, list(metrics), list(key[3]), key[1], key[2], key[4])
+
+
+async def run_core_specs(property_id, specs):
+    """
+    Run core specs in one batchRunReports call. Returns [(spec, rows or
+    exception)]. When GA4 rejects the call, the specs are retried one at a
+    time and a rejected union of metrics is split in halves, so a bad spec
+    only fails the questions it covers.
+    """
+    try:
+        frames = await run_batch_reports_async(property_id, [spec_request(property_id, spec) for spec in specs])
+        return list(zip(specs, frames))
+    except Exception as e:
+        if not is_invalid_request(e) or (len(specs) == 1 and len(specs[0][1]) == 1):
+            return [(spec, e) for spec in specs]
+        logger.info(f"GA4 rejected a batch of {len(specs)} merged report(s), splitting it: {e}")
+
+    if len(specs) > 1:
+        parts = await asyncio.gather(*[run_core_specs(property_id, [spec]) for spec in specs])
+        return [result for part in parts for result in part]
+    key, metrics = specs[0]
+    half = len(metrics) // 2
+    return await run_core_specs(property_id, [(key, metrics[:half]), (key, metrics[half:])])
+
+
+async def execute_merged(property_id, merged):
+    """
+    Run merged specs; returns {(key, metrics): rows} for every merged report
+    that was answered, or the exception of the call that failed.
+    """
+    core = [(key, metrics) for key, metrics in merged if key[0] == "core"]
+    realtime = [(key, metrics) for key, metrics in merged if key[0] == "realtime"]
+
+    calls = []
+    for i in range(0, len(core), BATCH_REPORTS_PER_CALL):
+        calls.append(run_core_specs(property_id, core[i:i + BATCH_REPORTS_PER_CALL]))
+    batch_calls = len(calls)
+    for key, metrics in realtime:
+        calls.append(run_realtime_report_async(property_id, metrics, list(key[1]), list(key[2])))
+
+    logger.info(f"Batch merged into {len(core)} core report(s) over {batch_calls} batch call(s) and {len(realtime)} realtime report(s)")
+    results = await asyncio.gather(*calls, return_exceptions=True)
+
+    by_spec = {}
+    for batch in results[:batch_calls]:
+        for (key, metrics), rows in batch:
+            by_spec[(key, tuple(metrics))] = rows
+    for (key, metrics), result in zip(realtime, results[batch_calls:]):
+        by_spec[(key, tuple(metrics))] = result if isinstance(result, Exception) else result[0]
+    return by_spec
+
+
+def rows_for(plan, by_spec):
+    """Fan the merged result columns back out to one question."""
+    key = group_key(plan["parsed"])
+    dimensions = plan["parsed"]["dimensions"]
+    wanted = plan["parsed"]["metrics"]
+
+    # Each metric may live in a different merged report when the union was
+    # split; outer-join them on the dimension values. GA4 leaves out rows
+    # where every metric is zero, so a metric missing from a row is 0
+    joined = OrderedDict()
+    for (spec_key, metrics), rows in by_spec.items():
+        if spec_key != key:
+            continue
+        present = [m for m in wanted if m in metrics]
+        if not present:
+            continue
+        if isinstance(rows, Exception):
+            raise rows
+        for r in rows:
+            entry = joined.setdefault(tuple(r[d] for d in dimensions), {d: r[d] for d in dimensions})
+            for m in present:
+                entry[m] = r[m]
+    return [
+        {**{d: entry[d] for d in dimensions}, **{m: entry.get(m, 0) for m in wanted}}
+        for entry in joined.values()
+    ]
+
+
+async def run_batch(property_id, queries):
+    # Batch reports queue behind interactive /query traffic in the GA4 scheduler
+    token = ga4_lane.set("batch")
+    try:
+        planned = await asyncio.gather(
+            *[plan_question(property_id, q) for q in queries],
+            return_exceptions=True
+        )
+        plans = [p for p in planned if not isinstance(p, Exception)]
+        by_spec = await execute_merged(property_id, await split_incompatible(property_id, merge_specs(plans))) if plans else {}
+
+        async def finish(query, plan):
+            if isinstance(plan, Exception):
+                return {"query": query, "error": str(plan)}
+            parsed, mode = plan["parsed"], plan["mode"]
+            try:
+                rows = rows_for(plan, by_spec)
+            except Exception as e:
+                return {"query": query, "error": str(e)}
+            if mode == "realtime":
+                duration = [(int(m), 0) for m in parsed.get("minute_ranges", ['30'])]
+            else:
+                duration = [parsed["start_date"], parsed["end_date"]]
+            summary = await summarize_async(query, rows, parsed["metrics"], parsed["dimensions"], duration)
+            return {
+                "query": query,
+                "metadata": {
+                    "propertyId": property_id,
+                    "mode": mode,
+                    "metrics": parsed["metrics"],
+                    "dimensions": parsed["dimensions"],
+                    "duration": duration,
+                    "page_path": parsed.get("page_path")
+                },
+                "data": rows,
+                "summary": summary
+            }
+
+        return await asyncio.gather(*[finish(q, p) for q, p in zip(queries, planned)])
+    finally:
+        ga4_lane.reset(token)
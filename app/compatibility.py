@@ -0,0 +1,301 @@
+"""
+Metric / dimension compatibility backed by the GA4 checkCompatibility API.
+
+Each property has a compatibility matrix holding
+- the verdict for every exact (metrics, dimensions) combination checked, and
+- pairwise verdicts learned from the API responses.
+
+checkCompatibility reports, for every field of the property, whether it can
+be added to the requested fields. A compatible field is therefore compatible
+with each requested field. An incompatible field conflicts with at least one
+of them, and the pair is known when only one requested field is left
+unexplained. Once every pair of a new combination is known compatible, the
+combination is answered without calling GA4. A single known incompatible
+pair is enough to reject it.
+
+Matrices are kept in memory and, when a cache directory is set, persisted
+as JSON next to the metadata cache.
+"""
+
+from utils.packages import *
+from utils.cache import cache_backend, CACHE_LOCAL_TTL
+from utils.singleflight import SingleFlight, call_key
+from app.ga4_client import get_client, get_async_client
+from app.ga4_scheduler import ga4_scheduler
+
+COMPATIBILITY_TTL = int(os.getenv("GA4_COMPATIBILITY_TTL", "604800"))
+COMPATIBILITY_MAX_PROPERTIES = int(os.getenv("GA4_COMPATIBILITY_MAX_PROPERTIES", "256"))
+COMPATIBILITY_CACHE_DIR = os.getenv("GA4_COMPATIBILITY_CACHE_DIR", os.getenv("GA4_METADATA_CACHE_DIR"))
+
+
+def field_key(kind: str, name: str) -> str:
+    return f"{kind}:{name}"
+
+
+def pair_key(a: str, b: str) -> str:
+    return "|".join(sorted((a, b)))
+
+
+def request_fields(metrics, dimensions) -> list:
+    return [field_key("metric", m) for m in metrics] + [field_key("dimension", d) for d in dimensions]
+
+
+@dataclass
+class CompatibilityResult:
+    compatible: bool
+    incompatible_metrics: list = field(default_factory=list)
+    incompatible_dimensions: list = field(default_factory=list)
+    # "combination", "pairs" or "api"
+    source: str = "api"
+
+
+class CompatibilityMatrix:
+    def __init__(self, property_id: str, combinations: dict = None, pairs: dict = None, created_at: float = None):
+        self.property_id = str(property_id)
+        # The matrix expires as a whole, so schema changes are eventually picked up
+        self.created_at = created_at or time.time()
+        # "m1,m2|d1,d2" -> [incompatible metrics, incompatible dimensions]
+        self.combinations = combinations or {}
+        # "dimension:country|metric:sessions" -> bool
+        self.pairs = pairs or {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def combination_key(metrics, dimensions) -> str:
+        return ",".join(sorted(metrics)) + "|" + ",".join(sorted(dimensions))
+
+    def lookup(self, metrics, dimensions):
+        """The verdict for a combination when it can be answered locally, else None."""
+        with self._lock:
+            entry = self.combinations.get(self.combination_key(metrics, dimensions))
+            if entry is not None:
+                bad_metrics, bad_dimensions = entry
+                return CompatibilityResult(not (bad_metrics or bad_dimensions), bad_metrics, bad_dimensions, "combination")
+            return self._infer(metrics, dimensions)
+
+    def _infer(self, metrics, dimensions):
+        fields = request_fields(metrics, dimensions)
+        bad, unknown = set(), False
+        for i, a in enumerate(fields):
+            for b in fields[i + 1:]:
+                verdict = self.pairs.get(pair_key(a, b))
+                if verdict is False:
+                    bad.update((a, b))
+                elif verdict is None:
+                    unknown = True
+        if bad:
+            return CompatibilityResult(
+                False,
+                [m for m in metrics if field_key("metric", m) in bad],
+                [d for d in dimensions if field_key("dimension", d) in bad],
+                "pairs"
+            )
+        if unknown:
+            return None
+        return CompatibilityResult(True, source="pairs")
+
+    def learn(self, metrics, dimensions, response) -> CompatibilityResult:
+        """Record a checkCompatibility response for this combination and learn pairs from it."""
+        fields = request_fields(metrics, dimensions)
+        verdicts = {}
+        for item in response.metric_compatibilities:
+            verdicts[field_key("metric", item.metric_metadata.api_name)] = item.compatibility
+        for item in response.dimension_compatibilities:
+            verdicts[field_key("dimension", item.dimension_metadata.api_name)] = item.compatibility
+
+        with self._lock:
+            for f, verdict in verdicts.items():
+                others = [r for r in fields if r != f]
+                if verdict == Compatibility.COMPATIBLE:
+                    for r in others:
+                        self.pairs[pair_key(f, r)] = True
+                elif verdict == Compatibility.INCOMPATIBLE:
+                    unexplained = [r for r in others if self.pairs.get(pair_key(f, r)) is not True]
+                    if len(unexplained) == 1:
+                        self.pairs[pair_key(f, unexplained[0])] = False
+
+            bad_metrics = [m for m in metrics if verdicts.get(field_key("metric", m)) == Compatibility.INCOMPATIBLE]
+            bad_dimensions = [d for d in dimensions if verdicts.get(field_key("dimension", d)) == Compatibility.INCOMPATIBLE]
+            self.combinations[self.combination_key(metrics, dimensions)] = [bad_metrics, bad_dimensions]
+
+        return CompatibilityResult(not (bad_metrics or bad_dimensions), bad_metrics, bad_dimensions, "api")
+
+    def absorb(self, other: "CompatibilityMatrix"):
+        """Add the verdicts of another copy of this matrix that this one lacks."""
+        data = other.to_dict()
+        with self._lock:
+            for key, verdict in data["combinations"].items():
+                self.combinations.setdefault(key, verdict)
+            for key, verdict in data["pairs"].items():
+                self.pairs.setdefault(key, verdict)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "property_id": self.property_id,
+                "created_at": self.created_at,
+                "combinations": dict(self.combinations),
+                "pairs": dict(self.pairs)
+            }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(data["property_id"], data.get("combinations"), data.get("pairs"), data.get("created_at"))
+
+
+class CompatibilityEngine:
+    """
+    Answers "can these metrics and dimensions be queried together" per property,
+    calling checkCompatibility only for combinations the matrix cannot decide.
+    """
+
+    def __init__(
+        self,
+        ttl: int = COMPATIBILITY_TTL,
+        maxsize: int = COMPATIBILITY_MAX_PROPERTIES,
+        cache_dir: str = COMPATIBILITY_CACHE_DIR
+    ):
+        self.cache_dir = cache_dir
+        self._matrices = cache_backend(
+            "compatibility", maxsize=maxsize, ttl=ttl,
+            codec=(CompatibilityMatrix.to_dict, CompatibilityMatrix.from_dict), local_ttl=CACHE_LOCAL_TTL
+        )
+        self._lock = threading.Lock()
+        self._flight = SingleFlight("compatibility")
+        self.counts = {"combination": 0, "pairs": 0, "api": 0, "errors": 0}
+
+    def matrix(self, property_id: str) -> CompatibilityMatrix:
+        property_id = str(property_id)
+        with self._lock:
+            matrix = self._matrices.get(property_id)
+            if matrix is None:
+                matrix = self._load_from_disk(property_id) or CompatibilityMatrix(property_id)
+                self._matrices.set(property_id, matrix, matrix.created_at)
+            return matrix
+
+    def check(self, property_id: str, metrics, dimensions):
+        """
+        CompatibilityResult for the combination, or None when GA4 could not be
+        asked (the query is then left for run_report to accept or reject).
+        """
+        matrix = self.matrix(property_id)
+        result = self._local(matrix, metrics, dimensions)
+        if result is not None:
+            return result
+
+        def fetch():
+            client = get_client()
+            request = build_compatibility_request(property_id, metrics, dimensions)
+            return ga4_scheduler.run(property_id, partial(client.check_compatibility, request))
+
+        try:
+            response = self._flight.do(self._key(property_id, metrics, dimensions), fetch)
+        except Exception as e:
+            self.counts["errors"] += 1
+            logger.error(f"checkCompatibility failed for property {property_id}: {e}")
+            return None
+        return self._learn(matrix, metrics, dimensions, response)
+
+    async def check_async(self, property_id: str, metrics, dimensions):
+        matrix = self.matrix(property_id)
+        result = self._local(matrix, metrics, dimensions)
+        if result is not None:
+            return result
+
+        async def fetch():
+            client = get_async_client()
+            request = build_compatibility_request(property_id, metrics, dimensions)
+            return await ga4_scheduler.run_async(property_id, partial(client.check_compatibility, request))
+
+        try:
+            response = await self._flight.do_async(self._key(property_id, metrics, dimensions), fetch)
+        except Exception as e:
+            self.counts["errors"] += 1
+            logger.error(f"checkCompatibility failed for property {property_id}: {e}")
+            return None
+        return self._learn(matrix, metrics, dimensions, response)
+
+    def _key(self, property_id, metrics, dimensions):
+        return call_key("compatibility", str(property_id), sorted(metrics), sorted(dimensions))
+
+    def _local(self, matrix: CompatibilityMatrix, metrics, dimensions):
+        result = matrix.lookup(metrics, dimensions)
+        if result is not None:
+            self.counts[result.source] += 1
+        return result
+
+    def _learn(self, matrix: CompatibilityMatrix, metrics, dimensions, response) -> CompatibilityResult:
+        self.counts["api"] += 1
+        result = matrix.learn(metrics, dimensions, response)
+        # Other workers may have learned pairs since this copy was loaded
+        latest = self._matrices.latest(matrix.property_id)
+        if latest is not None and latest is not matrix:
+            matrix.absorb(latest)
+        self._matrices.set(matrix.property_id, matrix, matrix.created_at)
+        self._save_to_disk(matrix)
+        return result
+
+    def invalidate(self, property_id: str):
+        self._matrices.delete(str(property_id))
+
+    def clear(self):
+        self._matrices.clear()
+
+    def stats(self) -> dict:
+        return {**self.counts, "properties": len(self._matrices)}
+
+    def flight_stats(self) -> dict:
+        return self._flight.stats()
+
+    def _disk_path(self, property_id: str):
+        return os.path.join(self.cache_dir, f"compatibility_{property_id}.json")
+
+    def _load_from_disk(self, property_id: str):
+        if not self.cache_dir:
+            return None
+        path = self._disk_path(property_id)
+        try:
+            with open(path) as f:
+                payload = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"Ignoring unreadable compatibility cache {path}: {e}")
+            return None
+
+        matrix = CompatibilityMatrix.from_dict(payload)
+        if time.time() - matrix.created_at > self._matrices.ttl:
+            return None
+        return matrix
+
+    def _save_to_disk(self, matrix: CompatibilityMatrix):
+        if not self.cache_dir:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = self._disk_path(matrix.property_id)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(matrix.to_dict(), f)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.error(f"Could not persist compatibility matrix for {matrix.property_id}: {e}")
+
+
+def build_compatibility_request(property_id, metrics, dimensions):
+    return CheckCompatibilityRequest(
+        property=f"properties/{property_id}",
+        metrics=[Metric(name=m) for m in metrics],
+        dimensions=[Dimension(name=d) for d in dimensions]
+    )
+
+
+compatibility_engine = CompatibilityEngine()
+
+
+def check_compatibility(property_id: str, metrics, dimensions):
+    return compatibility_engine.check(property_id, metrics, dimensions)
+
+
+async def check_compatibility_async(property_id: str, metrics, dimensions):
+    return await compatibility_engine.check_async(property_id, metrics, dimensions)
@@ -0,0 +1,129 @@
+"""
+One question asked of many GA4 properties.
+
+The question is parsed once and validated / auto-repaired against the first
+property. The validated spec is then checked on every other property, unless
+that property has the same schema fingerprint as one already checked (same
+metric and dimension names), in which case the metadata cache entry is
+reused. Reports run concurrently through a bounded pool. The per-property
+frames are merged into one report with a leading propertyId dimension, so
+one summary compares the properties. Failures are reported per property.
+
+Named groups come from PROPERTY_GROUPS (a JSON object of name -> list of
+property IDs) or the JSON file at PROPERTY_GROUPS_FILE.
+"""
+
+from utils.packages import *
+from utils.config import *
+from utils.response_structure import *
+from app.ga4_schema_validator import *
+from app.nl_parser import *
+from app.summarizer import *
+from app.report_router import execute_report_async
+from app.report_frame import ReportFrame
+
+FANOUT_CONCURRENCY = int(os.getenv("FANOUT_CONCURRENCY", "8"))
+FANOUT_MAX_PROPERTIES = int(os.getenv("FANOUT_MAX_PROPERTIES", "100"))
+PROPERTY_GROUPS_FILE = os.getenv("PROPERTY_GROUPS_FILE")
+
+PROPERTY_DIMENSION = "propertyId"
+
+
+@lru_cache(maxsize=1)
+def property_groups() -> dict:
+    groups = json.loads(os.getenv("PROPERTY_GROUPS") or "{}")
+    if PROPERTY_GROUPS_FILE:
+        with open(PROPERTY_GROUPS_FILE) as f:
+            groups.update(json.load(f))
+    return {name: [str(pid) for pid in ids] for name, ids in groups.items()}
+
+
+def resolve_properties(property_ids=None, group: str = None) -> list:
+    """Property IDs of the request, in order and without duplicates."""
+    ids = list(property_ids or [])
+    if group:
+        groups = property_groups()
+        if group not in groups:
+            raise ValueError(f"Unknown property group '{group}'")
+        ids.extend(groups[group])
+
+    ids = list(OrderedDict.fromkeys(str(pid) for pid in ids))
+    if not ids:
+        raise ValueError("No property IDs given")
+    if len(ids) > FANOUT_MAX_PROPERTIES:
+        raise ValueError(f"At most {FANOUT_MAX_PROPERTIES} properties can be queried at once, got {len(ids)}")
+    return ids
+
+
+async def plan_fanout(query, property_ids):
+    """Parse once and validate against the first property. Returns (parsed, mode)."""
+    parsed = await parse_query_async(query)
+    if not parsed.get("metrics"):
+        raise ValueError("No valid GA4 metrics found")
+    mode = "realtime" if is_realtime(parsed) else "core"
+    metrics, dimensions = await validate_with_auto_repair_async(
+        property_id=property_ids[0],
+        metrics=parsed["metrics"],
+        dimensions=parsed.get("dimensions", []),
+        mode=mode
+    )
+    parsed["metrics"], parsed["dimensions"] = metrics, dimensions
+    return parsed, mode
+
+
+async def run_fanout(query, property_ids, concurrency: int = FANOUT_CONCURRENCY):
+    parsed, mode = await plan_fanout(query, property_ids)
+    metrics, dimensions = parsed["metrics"], parsed["dimensions"]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    # Schemas known to accept the validated spec; the first property was
+    # validated by plan_fanout
+    accepted = set()
+    if mode == "core":
+        accepted.add((await get_property_metadata_async(property_ids[0])).fingerprint())
+
+    async def run_one(property_id):
+        async with semaphore:
+            if mode == "core" and property_id != property_ids[0]:
+                metadata = await get_property_metadata_async(property_id)
+                if metadata.fingerprint() not in accepted:
+                    await validate_ga4_query_async(property_id, metrics, dimensions)
+                    accepted.add(metadata.fingerprint())
+            return await execute_report_async(parsed, property_id)
+
+    results = await asyncio.gather(*[run_one(pid) for pid in property_ids], return_exceptions=True)
+
+    frames, properties, duration = [], [], None
+    for property_id, result in zip(property_ids, results):
+        if isinstance(result, Exception):
+            logger.error(f"Fan-out query failed for property {property_id}: {result}")
+            properties.append({"propertyId": property_id, "error": str(result)})
+            continue
+        if mode == "realtime":
+            result, duration = result
+        frames.append(result.with_dimension(PROPERTY_DIMENSION, property_id))
+        properties.append({"propertyId": property_id, "rows": len(result)})
+
+    if not frames:
+        raise ValueError(f"Query failed for every property: {properties[0]['error']}")
+
+    merged_dimensions = [PROPERTY_DIMENSION] + dimensions
+    merged = ReportFrame.concat(frames, metrics, merged_dimensions)
+    if mode == "core":
+        duration = [parsed["start_date"], parsed["end_date"]]
+    summary = await summarize_async(query, merged, metrics, merged_dimensions, duration)
+
+    logger.info(f"Fan-out answered for {len(frames)}/{len(property_ids)} properties")
+    return {
+        "metadata": {
+            "propertyIds": property_ids,
+            "mode": mode,
+            "metrics": metrics,
+            "dimensions": merged_dimensions,
+            "duration": duration,
+            "page_path": parsed.get("page_path")
+        },
+        "properties": properties,
+        "data": merged,
+        "summary": summary
+    }
@@ -0,0 +1,314 @@
+"""
+Deterministic parser for common query shapes.
+
+Recognizes metric and dimension phrases (including the validator's alias
+tables), realtime keywords, relative date phrases and page paths, and scores
+how much of the question it understood. parse_query only escalates to the
+LLM when the confidence is below FAST_PARSE_MIN_CONFIDENCE.
+"""
+
+from utils.packages import *
+from app.ga4_schema_validator import METRIC_ALIASES, DIMENSION_ALIASES
+
+FAST_PARSE_MIN_CONFIDENCE = float(os.getenv("FAST_PARSE_MIN_CONFIDENCE", "0.85"))
+
+DEFAULT_DAYS = 7
+DEFAULT_MINUTE_RANGES = ['29']
+
+METRIC_PHRASES = {
+    **METRIC_ALIASES,
+    "users": "totalUsers",
+    "total users": "totalUsers",
+    "visitors": "totalUsers",
+    "active users": "activeUsers",
+    "new users": "newUsers",
+    "sessions": "sessions",
+    "visits": "sessions",
+    "engaged sessions": "engagedSessions",
+    "views": "screenPageViews",
+    "screen page views": "screenPageViews",
+    "events": "eventCount",
+    "event count": "eventCount",
+    "engagement rate": "engagementRate",
+    "bounce rate": "bounceRate",
+    "average session duration": "averageSessionDuration",
+    "avg session duration": "averageSessionDuration",
+    "session duration": "averageSessionDuration",
+    "sessions per user": "sessionsPerUser",
+    "key events": "keyEvents",
+    "total revenue": "totalRevenue",
+    "purchase revenue": "purchaseRevenue",
+    "transactions": "ecommercePurchases",
+    "user engagement duration": "userEngagementDuration",
+}
+
+DIMENSION_PHRASES = {
+    **DIMENSION_ALIASES,
+    "pages": "pagePath",
+    "page title": "pageTitle",
+    "page titles": "pageTitle",
+    "landing page": "landingPage",
+    "landing pages": "landingPage",
+    "country": "country",
+    "countries": "country",
+    "city": "city",
+    "cities": "city",
+    "region": "region",
+    "regions": "region",
+    "devices": "deviceCategory",
+    "device category": "deviceCategory",
+    "browser": "browser",
+    "browsers": "browser",
+    "platform": "platform",
+    "language": "language",
+    "sources": "source",
+    "medium": "medium",
+    "channel": "sessionDefaultChannelGroup",
+    "channels": "sessionDefaultChannelGroup",
+    "campaigns": "campaignName",
+    "event": "eventName",
+    "event name": "eventName",
+    "hour": "hour",
+    "date": "date",
+    "minute": "minutesAgo",
+}
+
+# Phrases that imply a time series when they appear anywhere in the question
+TIME_SERIES_PHRASES = {
+    "daily": "date",
+    "per day": "date",
+    "by day": "date",
+    "each day": "date",
+    "day by day": "date",
+    "over time": "date",
+    "trend": "date",
+    "trends": "date",
+    "weekly": "week",
+    "per week": "week",
+    "monthly": "month",
+    "per month": "month",
+}
+
+REALTIME_PHRASES = {
+    "realtime", "real time", "right now", "live", "currently", "at the moment",
+    "active now", "this minute",
+}
+
+# Words that introduce a dimension breakdown
+DIMENSION_CONTEXT = {"by", "per", "across", "each", "top", "breakdown", "split"}
+CONNECTORS = {"and", "or", "&", ",", "vs", "versus"}
+
+STOPWORDS = {
+    "give", "me", "show", "tell", "get", "what", "whats", "how", "many", "much", "was", "were",
+    "is", "are", "the", "a", "an", "of", "for", "on", "in", "to", "from", "with", "over",
+    "during", "and", "or", "please", "our", "my", "we", "us", "did", "do", "does", "have",
+    "had", "there", "site", "website", "app", "page", "report", "breakdown", "break", "down",
+    "summarize", "summary", "summarise", "total", "number", "count", "all", "at", "so", "far",
+    "by", "per", "across", "each", "top", "split", "compare", "comparison", "list", "which",
+    "can", "you", "i", "want", "see", "data", "analytics", "metrics", "performance",
+    "overall", "vs", "versus", "&", "up", "let", "know", "it", "that", "this", "these", "those",
+}
+
+PATH_PATTERN = re.compile(r"(?<![\w.])/[\w\-./]+")
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+|&|,")
+
+# -----------------------------
+# Relative dates
+# -----------------------------
+
+def quarter_start(day: date) -> date:
+    return date(day.year, 3 * ((day.month - 1) // 3) + 1, 1)
+
+
+def relative_window(phrase: str, today: date):
+    """Map a named relative period onto (start, end) dates."""
+    if phrase == "today":
+        return today, today
+    if phrase == "yesterday":
+        day = today - timedelta(days=1)
+        return day, day
+    if phrase == "this week":
+        return today - timedelta(days=today.weekday()), today
+    if phrase == "last week":
+        start = today - timedelta(days=today.weekday() + 7)
+        return start, start + timedelta(days=6)
+    if phrase == "this month":
+        return today.replace(day=1), today
+    if phrase == "last month":
+        end = today.replace(day=1) - timedelta(days=1)
+        return end.replace(day=1), end
+    if phrase == "this quarter":
+        return quarter_start(today), today
+    if phrase == "last quarter":
+        end = quarter_start(today) - timedelta(days=1)
+        return quarter_start(end), end
+    if phrase in ("this year", "year to date", "ytd"):
+        return date(today.year, 1, 1), today
+    if phrase == "last year":
+        return date(today.year - 1, 1, 1), date(today.year - 1, 12, 31)
+    return None
+
+
+NAMED_PERIOD_PATTERN = re.compile(
+    r"\b(today|yesterday|this week|last week|this month|last month|this quarter|"
+    r"last quarter|this year|year to date|ytd|last year)\b"
+)
+RELATIVE_PERIOD_PATTERN = re.compile(
+    r"\b(?:last|past|previous|over the last|in the last)\s+(\d+)\s+(minute|day|week|month)s?\b"
+)
+UNIT_DAYS = {"day": 1, "week": 7, "month": 30}
+
+
+def extract_dates(text: str, today: date):
+    """
+    Returns ((start, end, label) or None, minute_ranges, remaining_text).
+    Windows expressed in days follow parse_query's convention of
+    start = today - days.
+    """
+    minute_ranges = []
+    window = None
+
+    for match in RELATIVE_PERIOD_PATTERN.finditer(text):
+        count, unit = int(match.group(1)), match.group(2)
+        if unit == "minute":
+            minute_ranges.append(str(max(count - 1, 0)))
+        elif window is None:
+            days = count * UNIT_DAYS[unit]
+            window = (today - timedelta(days=days), today, f"last {days} days")
+    text = RELATIVE_PERIOD_PATTERN.sub(" ", text)
+
+    for match in NAMED_PERIOD_PATTERN.finditer(text):
+        if window is None:
+            start, end = relative_window(match.group(1), today)
+            window = (start, end, match.group(1))
+    text = NAMED_PERIOD_PATTERN.sub(" ", text)
+
+    return window, minute_ranges, text
+
+# -----------------------------
+# Phrase matching
+# -----------------------------
+
+def _phrase_table():
+    table = {}
+    for phrase, value in DIMENSION_PHRASES.items():
+        table[tuple(TOKEN_PATTERN.findall(phrase))] = ("dimension", value)
+    for phrase, value in METRIC_PHRASES.items():
+        table[tuple(TOKEN_PATTERN.findall(phrase))] = ("metric", value)
+    for phrase, value in TIME_SERIES_PHRASES.items():
+        table[tuple(TOKEN_PATTERN.findall(phrase))] = ("time", value)
+    for phrase in REALTIME_PHRASES:
+        table[tuple(TOKEN_PATTERN.findall(phrase))] = ("realtime", True)
+    # GA4 api names typed verbatim (e.g. "screenPageViews")
+    for value in set(METRIC_PHRASES.values()):
+        table[(value.lower(),)] = ("metric", value)
+    return table
+
+
+PHRASES = _phrase_table()
+MAX_PHRASE_LEN = max(len(p) for p in PHRASES)
+DIMENSION_KEYS = {tuple(TOKEN_PATTERN.findall(p)) for p in DIMENSION_PHRASES}
+
+# Realtime reports only support activeUsers for user counts
+REALTIME_METRIC_SUBSTITUTES = {"totalUsers": "activeUsers", "newUsers": "activeUsers"}
+
+
+def match_phrase(tokens, i):
+    for size in range(min(MAX_PHRASE_LEN, len(tokens) - i), 0, -1):
+        hit = PHRASES.get(tuple(tokens[i:i + size]))
+        if hit:
+            return size, hit
+    return 0, None
+
+
+def fast_parse(query: str, today: date = None):
+    """
+    Parse ``query`` without the LLM. Returns the parse_query result shape
+    plus a ``confidence`` in [0, 1].
+    """
+    today = today or date.today()
+    text = query.lower()
+
+    page_paths = PATH_PATTERN.findall(text)
+    text = PATH_PATTERN.sub(" ", text)
+    window, minute_ranges, text = extract_dates(text, today)
+    tokens = TOKEN_PATTERN.findall(text)
+
+    metrics, dimensions = [], []
+    realtime = bool(minute_ranges)
+    in_dimensions = False
+    content, understood = 0, 0
+
+    i = 0
+    while i < len(tokens):
+        size, hit = match_phrase(tokens, i)
+        token = tokens[i]
+        if hit is None:
+            if token in DIMENSION_CONTEXT:
+                in_dimensions = True
+            elif token not in CONNECTORS:
+                in_dimensions = in_dimensions and token in STOPWORDS
+            if token not in STOPWORDS and token not in CONNECTORS:
+                content += 1
+            i += 1
+            continue
+
+        kind, value = hit
+        phrase = tuple(tokens[i:i + size])
+        if kind == "dimension" and not in_dimensions and all(t in STOPWORDS for t in phrase):
+            # e.g. the trailing "page" in "views of the /pricing page"
+            i += size
+            continue
+
+        content += 1
+        if kind == "metric" and not (in_dimensions and phrase in DIMENSION_KEYS):
+            understood += 1
+            if value not in metrics:
+                metrics.append(value)
+            in_dimensions = False
+        elif kind in ("dimension", "metric") and in_dimensions:
+            value = DIMENSION_PHRASES.get(" ".join(phrase), value)
+            understood += 1
+            if value not in dimensions:
+                dimensions.append(value)
+        elif kind == "time":
+            understood += 1
+            if value not in dimensions:
+                dimensions.append(value)
+        elif kind == "realtime":
+            understood += 1
+            realtime = True
+        i += size
+
+    if not metrics:
+        confidence = 0.0
+    else:
+        confidence = understood / content if content else 1.0
+
+    if realtime:
+        metrics = list(dict.fromkeys(REALTIME_METRIC_SUBSTITUTES.get(m, m) for m in metrics))
+        dimensions = ["minutesAgo" if d == "date" else d for d in dimensions]
+
+    if window is None:
+        start, end, label = today - timedelta(days=DEFAULT_DAYS), today, f"last {DEFAULT_DAYS} days"
+    else:
+        start, end, label = window
+
+    if not page_paths:
+        page_path = None
+    elif len(page_paths) == 1:
+        page_path = page_paths[0]
+    else:
+        page_path = page_paths
+
+    return {
+        "metrics": metrics,
+        "dimensions": dimensions,
+        "start_date": start.isoformat(),
+        "end_date": end.isoformat(),
+        "page_path": page_path,
+        "dateRange": label,
+        "minute_ranges": minute_ranges or DEFAULT_MINUTE_RANGES,
+        "is_realtime": str(realtime),
+        "confidence": round(confidence, 2)
+    }
@@ -1,44 +1,372 @@
 from utils.packages import *
+from app.report_frame import ReportFrame
+from utils.singleflight import SingleFlight, call_key
+from utils.metrics import record_property_quota
+from utils.logger import log_payload
+from app.ga4_scheduler import ga4_scheduler, call_priority
 
-def get_client():
-    credentials = service_account.Credentials.from_service_account_file(
-        "credentials.json",
-        scopes=["https://www.googleapis.com/auth/analytics.readonly"]
-        )
-    return BetaAnalyticsDataClient(credentials=credentials)
+GA4_SCOPES = ["https://www.googleapis.com/auth/analytics.readonly"]
+DEFAULT_CREDENTIALS_FILE = "credentials.json"
 
-def run_report(property_id, metrics, dimensions, start_date, end_date, page_path=None):
-    client = get_client()
+# Refresh the access token this many seconds before it expires
+TOKEN_REFRESH_MARGIN = int(os.getenv("GA4_TOKEN_REFRESH_MARGIN", "300"))
+
+# -----------------------------
+# Client manager
+# -----------------------------
+
+class GA4ClientManager:
+    """
+    Process-wide pool of GA4 Data API clients.
+
+    Keeps one set of service-account credentials and one long-lived gRPC
+    channel per credentials file, and refreshes the access token in the
+    background before it expires so requests never pay for the token exchange.
+    """
+
+    def __init__(self, refresh_margin: int = TOKEN_REFRESH_MARGIN):
+        self.refresh_margin = refresh_margin
+        self._lock = threading.RLock()
+        self._credentials = {}
+        self._clients = {}
+        self._async_clients = {}
+        self._timers = {}
+
+    def get_credentials(self, credentials_file: str = DEFAULT_CREDENTIALS_FILE):
+        with self._lock:
+            credentials = self._credentials.get(credentials_file)
+            if credentials is None:
+                logger.info(f"Loading GA4 credentials from {credentials_file}")
+                credentials = service_account.Credentials.from_service_account_file(
+                    credentials_file,
+                    scopes=GA4_SCOPES
+                )
+                self._credentials[credentials_file] = credentials
+                self._refresh(credentials_file)
+            return credentials
+
+    def get_client(self, credentials_file: str = DEFAULT_CREDENTIALS_FILE):
+        credentials = self.get_credentials(credentials_file)
+        with self._lock:
+            client = self._clients.get(credentials_file)
+            if client is None:
+                client = BetaAnalyticsDataClient(credentials=credentials)
+                self._clients[credentials_file] = client
+            return client
+
+    def get_async_client(self, credentials_file: str = DEFAULT_CREDENTIALS_FILE):
+        # grpc.aio channels are bound to the event loop that created them
+        credentials = self.get_credentials(credentials_file)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            entry = self._async_clients.get(credentials_file)
+            if entry is None or entry[0] is not loop:
+                entry = (loop, BetaAnalyticsDataAsyncClient(credentials=credentials))
+                self._async_clients[credentials_file] = entry
+            return entry[1]
+
+    def _refresh(self, credentials_file: str):
+        # Runs outside the lock when fired by the timer so that callers
+        # picking up the pooled client are never blocked on the token exchange
+        credentials = self._credentials.get(credentials_file)
+        if credentials is None:
+            return
+        try:
+            credentials.refresh(GoogleAuthRequest())
+        except Exception as e:
+            # The channel refreshes on demand if the background refresh fails
+            logger.error(f"GA4 token refresh failed for {credentials_file}: {e}")
+            self._schedule_refresh(credentials_file, self.refresh_margin)
+            return
+        self._schedule_refresh(credentials_file, self._seconds_until_refresh(credentials))
+
+    def _seconds_until_refresh(self, credentials) -> float:
+        if credentials.expiry is None:
+            return self.refresh_margin
+        remaining = (credentials.expiry - datetime.utcnow()).total_seconds()
+        return max(remaining - self.refresh_margin, 30)
 
+    def _schedule_refresh(self, credentials_file: str, delay: float):
+        timer = threading.Timer(delay, self._refresh, args=(credentials_file,))
+        timer.daemon = True
+        with self._lock:
+            previous = self._timers.get(credentials_file)
+            if previous:
+                previous.cancel()
+            self._timers[credentials_file] = timer
+        timer.start()
 
+    def close(self):
+        with self._lock:
+            for timer in self._timers.values():
+                timer.cancel()
+            for client in self._clients.values():
+                client.transport.close()
+            self._timers.clear()
+            self._clients.clear()
+            self._credentials.clear()
+
+    async def aclose(self):
+        with self._lock:
+            clients = [client for _, client in self._async_clients.values()]
+            self._async_clients.clear()
+        for client in clients:
+            await client.transport.close()
+
+
+client_manager = GA4ClientManager()
+
+
+def get_client(credentials_file: str = DEFAULT_CREDENTIALS_FILE):
+    return client_manager.get_client(credentials_file)
+
+def get_async_client(credentials_file: str = DEFAULT_CREDENTIALS_FILE):
+    return client_manager.get_async_client(credentials_file)
+
+# -----------------------------
+# Request / response helpers
+# -----------------------------
+
+def build_report_request(property_id, metrics, dimensions, start_date, end_date, page_path=None):
     request = RunReportRequest(
         property=f"properties/{property_id}",
         date_ranges=[DateRange(start_date=start_date, end_date=end_date)],
         metrics=[Metric(name=m) for m in metrics],
-        dimensions=[Dimension(name=d) for d in dimensions]
+        dimensions=[Dimension(name=d) for d in dimensions],
+        return_property_quota=True
         )
 
 
-    if page_path:
+    if isinstance(page_path, (list, tuple)):
+        request.dimension_filter = FilterExpression(
+            filter=Filter(
+                field_name="pagePath",
+                in_list_filter=Filter.InListFilter(values=list(page_path))
+            )
+        )
+    elif page_path:
         request.dimension_filter = FilterExpression(
             filter=Filter(
                 field_name="pagePath",
                 string_filter=Filter.StringFilter(value=page_path)
             )
         )
+    return request
+
+
+def report_rows(response, metrics, dimensions):
+    return ReportFrame.from_response(response, metrics, dimensions)
+
+
+def build_realtime_request(property_id, metrics, dimensions, minute_ranges):
+    return RunRealtimeReportRequest(
+        property=f"properties/{property_id}",
+        metrics=[{"name": m} for m in metrics],
+        dimensions=[{"name": d} for d in dimensions],
+        minute_ranges=[
+            MinuteRange(start_minutes_ago=int(m), end_minutes_ago=0)
+            for m in minute_ranges
+        ],
+        return_property_quota=True
+    )
+
+
+def realtime_rows(response, metrics, dimensions):
+    return ReportFrame.from_response(response, metrics, dimensions)
+
+# -----------------------------
+# Reports
+# -----------------------------
+
+# GA4 returns at most 10k rows unless a limit is set; 250k is the API maximum
+REPORT_PAGE_SIZE = int(os.getenv("REPORT_PAGE_SIZE", "25000"))
+REPORT_PAGE_CONCURRENCY = int(os.getenv("REPORT_PAGE_CONCURRENCY", "4"))
+
+
+def page_request(request, offset, page_size):
+    page = RunReportRequest(request)
+    page.limit = page_size
+    page.offset = offset
+    return page
+
+
+def iter_report_pages(property_id, metrics, dimensions, start_date, end_date, page_path=None,
+                      page_size: int = None):
+    """
+    Yield one ReportFrame per page, walking ``offset`` until ``row_count``.
+    Once the total is known the remaining pages are fetched concurrently,
+    at most REPORT_PAGE_CONCURRENCY ahead of the consumer.
+    """
+    request = build_report_request(property_id, metrics, dimensions, start_date, end_date, page_path)
+    yield from iter_request_pages(property_id, request, metrics, dimensions, page_size)
+
+
+def iter_request_pages(property_id, request, metrics, dimensions, page_size: int = None, first=None):
+    """
+    Pages of a built RunReportRequest. ``first`` is a response already
+    received for offset 0 (e.g. from a batch); only the rows after it are
+    then fetched.
+    """
+    client = get_client()
+    page_size = page_size or REPORT_PAGE_SIZE
 
+    priority = call_priority()
+    if first is None:
+        first = ga4_scheduler.run(property_id, partial(client.run_report, page_request(request, 0, page_size)), priority=priority)
+        record_property_quota(property_id, first)
+    yield report_rows(first, metrics, dimensions)
 
-    response = client.run_report(request)
+    offsets = deque(range(len(first.rows), first.row_count, page_size))
+    if offsets:
+        logger.info(f"Report has {first.row_count} rows, fetching {len(offsets)} more page(s)")
+    if not offsets:
+        return
+    # One pool per report: its read-ahead never queues behind other reports'
+    # pages, and the GA4 scheduler still bounds concurrency per property
+    pool = ThreadPoolExecutor(max_workers=REPORT_PAGE_CONCURRENCY, thread_name_prefix="ga4-page")
+    pending = deque()
+    try:
+        while offsets or pending:
+            while offsets and len(pending) < REPORT_PAGE_CONCURRENCY:
+                pending.append(pool.submit(
+                    ga4_scheduler.run, property_id,
+                    partial(client.run_report, page_request(request, offsets.popleft(), page_size)),
+                    priority=priority
+                ))
+            page = pending.popleft().result()
+            record_property_quota(property_id, page)
+            yield report_rows(page, metrics, dimensions)
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
 
 
-    rows = []
-    for row in response.rows:
-        entry = {"date": row.dimension_values[0].value}
-        for i, m in enumerate(metrics):
-            entry[m] = int(row.metric_values[i].value)
-        rows.append(entry)
+async def aiter_report_pages(property_id, metrics, dimensions, start_date, end_date, page_path=None,
+                             page_size: int = None):
+    request = build_report_request(property_id, metrics, dimensions, start_date, end_date, page_path)
+    async for page in aiter_request_pages(property_id, request, metrics, dimensions, page_size):
+        yield page
+
+
+async def aiter_request_pages(property_id, request, metrics, dimensions, page_size: int = None, first=None):
+    client = get_async_client()
+    page_size = page_size or REPORT_PAGE_SIZE
+
+    if first is None:
+        first = await ga4_scheduler.run_async(property_id, partial(client.run_report, page_request(request, 0, page_size)))
+        record_property_quota(property_id, first)
+    yield report_rows(first, metrics, dimensions)
+
+    offsets = deque(range(len(first.rows), first.row_count, page_size))
+    if offsets:
+        logger.info(f"Report has {first.row_count} rows, fetching {len(offsets)} more page(s)")
+    pending = deque()
+    try:
+        while offsets or pending:
+            while offsets and len(pending) < REPORT_PAGE_CONCURRENCY:
+                pending.append(asyncio.ensure_future(ga4_scheduler.run_async(
+                    property_id, partial(client.run_report, page_request(request, offsets.popleft(), page_size))
+                )))
+            page = await pending.popleft()
+            record_property_quota(property_id, page)
+            yield report_rows(page, metrics, dimensions)
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def iter_report_rows(property_id, metrics, dimensions, start_date, end_date, page_path=None,
+                     page_size: int = None):
+    for page in iter_report_pages(property_id, metrics, dimensions, start_date, end_date, page_path, page_size):
+        yield from page
+
+
+async def aiter_report_rows(property_id, metrics, dimensions, start_date, end_date, page_path=None,
+                            page_size: int = None):
+    async for page in aiter_report_pages(property_id, metrics, dimensions, start_date, end_date, page_path, page_size):
+        for row in page:
+            yield row
+
+
+# Identical reports requested at the same time share one GA4 call. Frames
+# handed to several callers are shared, so they must not be modified in place
+report_flight = SingleFlight("ga4")
+
+
+def report_key(kind, property_id, *spec):
+    return call_key(kind, str(property_id), *spec)
+
+
+def run_report(property_id, metrics, dimensions, start_date, end_date, page_path=None):
+    """
+    The whole report as one ReportFrame. /query returns every row in one
+    JSON body and the report cache stores per-day slices, so both need the
+    full frame; /query/stream reads aiter_report_pages instead and never
+    holds more than the pages in flight.
+    """
+    def fetch():
+        pages = iter_report_pages(property_id, metrics, dimensions, start_date, end_date, page_path)
+        return ReportFrame.concat(list(pages), metrics, dimensions)
+
+    key = report_key("report", property_id, metrics, dimensions, start_date, end_date, page_path)
+    return report_flight.do(key, fetch)
+
+
+async def run_report_async(property_id, metrics, dimensions, start_date, end_date, page_path=None):
+    async def fetch():
+        pages = [
+            page async for page in aiter_report_pages(property_id, metrics, dimensions, start_date, end_date, page_path)
+        ]
+        return ReportFrame.concat(pages, metrics, dimensions)
+
+    key = report_key("report", property_id, metrics, dimensions, start_date, end_date, page_path)
+    return await report_flight.do_async(key, fetch)
+
+
+def build_batch_request(property_id, requests):
+    # Requests inside a batch must not repeat the property; the callers'
+    # requests keep it for fetching further pages
+    inner = []
+    for request in requests:
+        request = page_request(request, 0, REPORT_PAGE_SIZE)
+        request.property = ""
+        inner.append(request)
+    return BatchRunReportsRequest(property=f"properties/{property_id}", requests=inner)
+
+
+def report_request_fields(request):
+    return [m.name for m in request.metrics], [d.name for d in request.dimensions]
+
+
+def run_batch_reports(property_id, requests):
+    """
+    Run up to 5 RunReportRequests in one batchRunReports call. Returns one
+    complete ReportFrame per request: reports longer than REPORT_PAGE_SIZE
+    rows are paged in with run_report from where the batch left off.
+    """
+    client = get_client()
+    request = build_batch_request(property_id, requests)
+    response = ga4_scheduler.run(property_id, partial(client.batch_run_reports, request))
+    frames = []
+    for request, report in zip(requests, response.reports):
+        record_property_quota(property_id, report)
+        metrics, dimensions = report_request_fields(request)
+        pages = iter_request_pages(property_id, request, metrics, dimensions, first=report)
+        frames.append(ReportFrame.concat(list(pages), metrics, dimensions))
+    return frames
+
+
+async def run_batch_reports_async(property_id, requests):
+    client = get_async_client()
+    request = build_batch_request(property_id, requests)
+    response = await ga4_scheduler.run_async(property_id, partial(client.batch_run_reports, request))
+    frames = []
+    for request, report in zip(requests, response.reports):
+        record_property_quota(property_id, report)
+        metrics, dimensions = report_request_fields(request)
+        pages = [page async for page in aiter_request_pages(property_id, request, metrics, dimensions, first=report)]
+        frames.append(ReportFrame.concat(pages, metrics, dimensions))
+    return frames
 
-    return rows
 
 def run_realtime_report(
     property_id,
@@ -46,26 +374,33 @@ def run_realtime_report(
     dimensions,
     minute_ranges=['30']
 ):
-    client = get_client()
+    def fetch():
+        client = get_client()
+        request = build_realtime_request(property_id, metrics, dimensions, minute_ranges)
+        log_payload("Realtime report request", request, property_id=property_id)
+        response = ga4_scheduler.run(property_id, partial(client.run_realtime_report, request), realtime=True)
+        log_payload("Realtime report response", response, property_id=property_id)
+        record_property_quota(property_id, response, report="realtime")
+        return realtime_rows(response, metrics, dimensions)
 
-    request = RunRealtimeReportRequest(
-        property=f"properties/{property_id}",
-        metrics=[{"name": m} for m in metrics],
-        dimensions=[{"name": d} for d in dimensions],
-        minute_ranges=[
-            MinuteRange(start_minutes_ago=int(m), end_minutes_ago=0)
-            for m in minute_ranges
-        ]
-    )
-    logger.info(f"Request is {request}")
-    response = client.run_realtime_report(request)
-    logger.info(f"Response of realtime report looks like {response}")
-    rows = []
-    for row in response.rows:
-        entry = {}
-        for i, d in enumerate(dimensions):
-            entry[d] = row.dimension_values[i].value
-        for i, m in enumerate(metrics):
-            entry[m] = int(row.metric_values[i].value)
-        rows.append(entry)
-    return rows,[(int(m),0) for m in minute_ranges]
\ No newline at end of file
+    key = report_key("realtime", property_id, metrics, dimensions, minute_ranges)
+    return report_flight.do(key, fetch),[(int(m),0) for m in minute_ranges]
+
+
+async def run_realtime_report_async(
+    property_id,
+    metrics,
+    dimensions,
+    minute_ranges=['30']
+):
+    async def fetch():
+        client = get_async_client()
+        request = build_realtime_request(property_id, metrics, dimensions, minute_ranges)
+        log_payload("Realtime report request", request, property_id=property_id)
+        response = await ga4_scheduler.run_async(property_id, partial(client.run_realtime_report, request), realtime=True)
+        log_payload("Realtime report response", response, property_id=property_id)
+        record_property_quota(property_id, response, report="realtime")
+        return realtime_rows(response, metrics, dimensions)
+
+    key = report_key("realtime", property_id, metrics, dimensions, minute_ranges)
+    return await report_flight.do_async(key, fetch),[(int(m),0) for m in minute_ranges]
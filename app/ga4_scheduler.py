@@ -0,0 +1,326 @@
+"""
+Quota-aware scheduling of GA4 Data API calls.
+
+Every report call takes a slot from the scheduler before it is sent.
+Waiting calls are granted in priority order (realtime before core,
+interactive before batch) and, within a priority, to the property with the
+fewest calls in flight, so one busy property cannot starve the others.
+
+Each property has its own concurrency limit per quota category: GA4 meters
+core and realtime reports separately, so each category of a property keeps
+its own limit, quota and backoff. It shrinks as the hourly / daily token
+quota reported through ``property_quota`` runs low, is capped by the
+concurrent requests GA4 reports as still available (other clients of the
+property use the same allowance), halves on RESOURCE_EXHAUSTED (which also
+pauses the property for a backoff period) and grows back by one on every
+success. Transient errors are retried with full jitter exponential backoff.
+"""
+
+from utils.packages import *
+
+GA4_MAX_CONCURRENT = int(os.getenv("GA4_MAX_CONCURRENT", "20"))
+# GA4 standard properties allow 10 concurrent requests
+GA4_MAX_CONCURRENT_PER_PROPERTY = int(os.getenv("GA4_MAX_CONCURRENT_PER_PROPERTY", "10"))
+GA4_TOKENS_PER_HOUR = int(os.getenv("GA4_TOKENS_PER_HOUR", "40000"))
+GA4_TOKENS_PER_DAY = int(os.getenv("GA4_TOKENS_PER_DAY", "200000"))
+GA4_MAX_RETRIES = int(os.getenv("GA4_MAX_RETRIES", "4"))
+GA4_BACKOFF_BASE = float(os.getenv("GA4_BACKOFF_BASE", "0.5"))
+GA4_BACKOFF_MAX = float(os.getenv("GA4_BACKOFF_MAX", "30"))
+
+PRIORITY_REALTIME_INTERACTIVE = 0
+PRIORITY_CORE_INTERACTIVE = 1
+PRIORITY_REALTIME_BATCH = 2
+PRIORITY_CORE_BATCH = 3
+
+# "interactive" or "batch"; set by callers that fan out many reports
+ga4_lane = contextvars.ContextVar("ga4_lane", default="interactive")
+
+
+@lru_cache(maxsize=1)
+def transient_errors() -> tuple:
+    # Resolved on the first failure so google.api_core stays off the import path
+    return (
+        google_exceptions.TooManyRequests,  # includes ResourceExhausted
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.InternalServerError,
+        google_exceptions.Aborted,
+    )
+
+
+def call_priority(realtime: bool = False, lane: str = None) -> int:
+    lane = lane or ga4_lane.get()
+    if lane == "batch":
+        return PRIORITY_REALTIME_BATCH if realtime else PRIORITY_CORE_BATCH
+    return PRIORITY_REALTIME_INTERACTIVE if realtime else PRIORITY_CORE_INTERACTIVE
+
+
+def backoff_delay(attempt: int, base: float = GA4_BACKOFF_BASE, cap: float = GA4_BACKOFF_MAX) -> float:
+    # Full jitter: uniform over [0, min(cap, base * 2^attempt)]
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def quota_category(realtime: bool) -> str:
+    return "realtime" if realtime else "core"
+
+
+def is_quota_error(error) -> bool:
+    return isinstance(error, google_exceptions.TooManyRequests)
+
+
+class PropertyState:
+    def __init__(self, limit: int = GA4_MAX_CONCURRENT_PER_PROPERTY):
+        self.max_limit = limit
+        self.limit = limit
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.failures = 0
+        self.tokens_per_hour = None
+        self.tokens_per_day = None
+        # Our calls in flight plus GA4's concurrentRequests.remaining, as of the latest response
+        self.concurrent_allowance = None
+
+    def quota_fraction(self):
+        fractions = []
+        if self.tokens_per_hour is not None:
+            fractions.append(self.tokens_per_hour / GA4_TOKENS_PER_HOUR)
+        if self.tokens_per_day is not None:
+            fractions.append(self.tokens_per_day / GA4_TOKENS_PER_DAY)
+        return min(fractions) if fractions else 1.0
+
+    def capacity(self) -> int:
+        """Concurrency allowed right now, scaled down as token quota runs out."""
+        fraction = self.quota_fraction()
+        if fraction < 0.05:
+            limit = 1
+        elif fraction < 0.2:
+            limit = max(1, self.limit // 4)
+        elif fraction < 0.5:
+            limit = max(1, self.limit // 2)
+        else:
+            limit = self.limit
+        if self.concurrent_allowance is not None:
+            limit = min(limit, max(1, self.concurrent_allowance))
+        return limit
+
+    def to_dict(self) -> dict:
+        return {
+            "limit": self.limit,
+            "capacity": self.capacity(),
+            "in_flight": self.in_flight,
+            "cooling_down": max(0.0, self.cooldown_until - time.time()),
+            "tokens_per_hour": self.tokens_per_hour,
+            "tokens_per_day": self.tokens_per_day,
+            "concurrent_allowance": self.concurrent_allowance
+        }
+
+
+class _Waiter:
+    def __init__(self, property_id, category, priority, seq, loop=None):
+        self.property_id = property_id
+        self.category = category
+        self.priority = priority
+        self.seq = seq
+        self.granted = False
+        self.loop = loop
+        if loop is None:
+            self.event = threading.Event()
+        else:
+            self.future = loop.create_future()
+
+    def grant(self):
+        self.granted = True
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(True)
+
+
+class GA4Scheduler:
+    def __init__(self, max_concurrent: int = GA4_MAX_CONCURRENT,
+                 per_property: int = GA4_MAX_CONCURRENT_PER_PROPERTY):
+        self.max_concurrent = max_concurrent
+        self.per_property = per_property
+        self._lock = threading.Lock()
+        self._states = {}
+        self._waiters: List[_Waiter] = []
+        self._seq = 0
+        self._in_flight = 0
+        self.retries = 0
+
+    def state(self, property_id, category: str = "core") -> PropertyState:
+        key = (str(property_id), category)
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = PropertyState(self.per_property)
+        return state
+
+    # -----------------------------
+    # Slots
+    # -----------------------------
+
+    def _enqueue(self, property_id, category, priority, loop=None) -> _Waiter:
+        with self._lock:
+            self._seq += 1
+            waiter = _Waiter(str(property_id), category, priority, self._seq, loop)
+            self.state(waiter.property_id, category)
+            self._waiters.append(waiter)
+            self._dispatch_locked()
+        return waiter
+
+    def _dispatch_locked(self):
+        now = time.time()
+        while self._waiters and self._in_flight < self.max_concurrent:
+            best = None
+            for waiter in self._waiters:
+                state = self._states[(waiter.property_id, waiter.category)]
+                if state.cooldown_until > now or state.in_flight >= state.capacity():
+                    continue
+                rank = (waiter.priority, state.in_flight, waiter.seq)
+                if best is None or rank < best[0]:
+                    best = (rank, waiter)
+            if best is None:
+                return
+            waiter = best[1]
+            self._waiters.remove(waiter)
+            self._states[(waiter.property_id, waiter.category)].in_flight += 1
+            self._in_flight += 1
+            waiter.grant()
+
+    def _dispatch(self):
+        with self._lock:
+            self._dispatch_locked()
+
+    def _abandon(self, waiter: _Waiter):
+        """Drop a waiter whose caller gave up, returning its slot if it had one."""
+        with self._lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                return
+        if waiter.granted:
+            self.release(waiter.property_id, error=asyncio.CancelledError(), category=waiter.category)
+
+    def acquire(self, property_id, priority: int, category: str = "core"):
+        waiter = self._enqueue(property_id, category, priority)
+        waiter.event.wait()
+
+    async def acquire_async(self, property_id, priority: int, category: str = "core"):
+        waiter = self._enqueue(property_id, category, priority, asyncio.get_running_loop())
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            self._abandon(waiter)
+            raise
+
+    def release(self, property_id, response=None, error=None, category: str = "core"):
+        property_id = str(property_id)
+        with self._lock:
+            state = self.state(property_id, category)
+            state.in_flight -= 1
+            self._in_flight -= 1
+
+            if error is None:
+                state.failures = 0
+                state.limit = min(state.max_limit, state.limit + 1)
+                self._record_quota(state, response)
+            elif is_quota_error(error):
+                state.failures += 1
+                state.limit = max(1, state.limit // 2)
+                pause = backoff_delay(state.failures)
+                state.cooldown_until = max(state.cooldown_until, time.time() + pause)
+                logger.info(f"GA4 {category} quota exhausted for property {property_id}; limit {state.limit}, pausing {pause:.1f}s")
+                timer = threading.Timer(pause, self._dispatch)
+                timer.daemon = True
+                timer.start()
+            self._dispatch_locked()
+
+    def _record_quota(self, state: PropertyState, response):
+        reports = getattr(response, "reports", None)
+        if reports:
+            # batchRunReports carries the quota on each report; the last is the latest
+            response = reports[-1]
+        quota = getattr(response, "property_quota", None)
+        if not quota:
+            return
+        if quota.tokens_per_hour:
+            state.tokens_per_hour = quota.tokens_per_hour.remaining
+        if quota.tokens_per_day:
+            state.tokens_per_day = quota.tokens_per_day.remaining
+        if quota.concurrent_requests:
+            # remaining was measured while this call (already released) was still in flight
+            state.concurrent_allowance = state.in_flight + 1 + quota.concurrent_requests.remaining
+
+    # -----------------------------
+    # Calls
+    # -----------------------------
+
+    def run(self, property_id, fn, realtime: bool = False, priority: int = None):
+        """Run ``fn()`` under a slot for ``property_id``, retrying transient errors."""
+        priority = call_priority(realtime) if priority is None else priority
+        category = quota_category(realtime)
+        attempt = 0
+        while True:
+            self.acquire(property_id, priority, category)
+            try:
+                response = fn()
+            except transient_errors() as e:
+                self.release(property_id, error=e, category=category)
+                if attempt >= GA4_MAX_RETRIES:
+                    raise
+                delay = backoff_delay(attempt)
+                logger.info(f"GA4 call for property {property_id} failed ({e}); retry {attempt + 1} in {delay:.2f}s")
+                with self._lock:
+                    self.retries += 1
+                attempt += 1
+                time.sleep(delay)
+                continue
+            except BaseException as e:
+                self.release(property_id, error=e, category=category)
+                raise
+            self.release(property_id, response, category=category)
+            return response
+
+    async def run_async(self, property_id, fn, realtime: bool = False, priority: int = None):
+        """Async ``run``; ``fn()`` returns an awaitable."""
+        priority = call_priority(realtime) if priority is None else priority
+        category = quota_category(realtime)
+        attempt = 0
+        while True:
+            await self.acquire_async(property_id, priority, category)
+            try:
+                response = await fn()
+            except transient_errors() as e:
+                self.release(property_id, error=e, category=category)
+                if attempt >= GA4_MAX_RETRIES:
+                    raise
+                delay = backoff_delay(attempt)
+                logger.info(f"GA4 call for property {property_id} failed ({e}); retry {attempt + 1} in {delay:.2f}s")
+                with self._lock:
+                    self.retries += 1
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            except BaseException as e:
+                self.release(property_id, error=e, category=category)
+                raise
+            self.release(property_id, response, category=category)
+            return response
+
+    def stats(self) -> dict:
+        with self._lock:
+            properties = {}
+            for (pid, category), state in self._states.items():
+                properties.setdefault(pid, {})[category] = state.to_dict()
+            return {
+                "in_flight": self._in_flight,
+                "waiting": len(self._waiters),
+                "retries": self.retries,
+                "properties": properties
+            }
+
+
+ga4_scheduler = GA4Scheduler()
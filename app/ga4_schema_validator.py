@@ -1,12 +1,19 @@
-from utils.packages import *
-from utils.config import *
-from utils.response_structure import *
-
 """
-GA4 Validator with Metadata API + Rule-based checks + LLM Auto-repair
-NO caching (no lru_cache)
+GA4 Validator with Metadata API + checkCompatibility + LLM Auto-repair
+Metadata is cached per property (TTL + LRU, optional on-disk persistence);
+compatibility verdicts come from app.compatibility
 """
 
+from utils.packages import *
+from utils.config import *
+from utils.response_structure import *
+from utils.cache import cache_backend, CACHE_LOCAL_TTL
+from utils.metrics import STAGE_SECONDS, SCHEMA_REPAIRS, LLM_FALLBACKS
+from utils.logger import log_payload
+from app.ga4_client import get_client, get_async_client
+from app.schema_index import SchemaIndex, SchemaEntry, SCHEMA_REPAIR_TOP_K
+from app.compatibility import check_compatibility, check_compatibility_async
+from app.llm_gateway import llm_gateway, LLMGatewayError
 
 # -----------------------------
 # Constants
@@ -18,27 +25,6 @@ TIME_DIMENSIONS = {
     "date", "dateHour", "dateHourMinute", "week", "month", "year"
 }
 
-EVENT_DIMENSIONS = {
-    "eventName", "eventCategory", "eventLabel"
-}
-
-ITEM_DIMENSIONS = {
-    "itemName", "itemBrand", "itemCategory","browser","city","cohort"
-}
-
-SESSION_METRICS = {
-    "sessions",
-    "averageSessionDuration",
-    "engagementRate",
-    "sessionsPerUser"
-}
-
-USER_METRICS = {
-    "totalUsers",
-    "activeUsers",
-    "newUsers"
-}
-
 ADS_METRICS = {
     "advertiserAdClicks",
     "advertiserAdCost",
@@ -159,65 +145,277 @@ class GA4RealtimeValidationError(GA4BaseValidationError):
 
 
 # -----------------------------
-# Metadata Loader (NO CACHE)
+# Metadata Store
 # -----------------------------
 
-def load_metadata(property_id: str):
-    credentials = service_account.Credentials.from_service_account_file(
-        "credentials.json",
-        scopes=["https://www.googleapis.com/auth/analytics.readonly"]
-    )
+METADATA_TTL = int(os.getenv("GA4_METADATA_TTL", "21600"))
+METADATA_REFRESH_AFTER = int(os.getenv("GA4_METADATA_REFRESH_AFTER", "3600"))
+METADATA_MAX_PROPERTIES = int(os.getenv("GA4_METADATA_MAX_PROPERTIES", "256"))
+METADATA_CACHE_DIR = os.getenv("GA4_METADATA_CACHE_DIR")
+REPAIR_CACHE_TTL = int(os.getenv("REPAIR_CACHE_TTL", "86400"))
+
+
+@dataclass
+class PropertyMetadata:
+    """Per-property view of the GA4 Metadata API with precomputed lookup tables."""
+    property_id: str
+    metric_types: dict
+    dimension_set: set
+    # {"metrics": {api_name: [ui_name, description]}, "dimensions": {...}}
+    labels: dict = field(default_factory=dict)
+    _index: SchemaIndex = field(default=None, init=False, repr=False, compare=False)
+    _fingerprint: str = field(default=None, init=False, repr=False, compare=False)
+
+    @classmethod
+    def from_response(cls, property_id: str, metadata):
+        return cls.build(
+            property_id,
+            {m.api_name: m.type_.name for m in metadata.metrics},
+            {d.api_name for d in metadata.dimensions},
+            {
+                "metrics": {m.api_name: [m.ui_name, m.description] for m in metadata.metrics},
+                "dimensions": {d.api_name: [d.ui_name, d.description] for d in metadata.dimensions}
+            }
+        )
 
-    client = BetaAnalyticsDataClient(credentials=credentials)
+    @classmethod
+    def build(cls, property_id: str, metric_types: dict, dimension_set, labels: dict = None):
+        return cls(property_id, metric_types, set(dimension_set), labels or {})
+
+    def index(self) -> SchemaIndex:
+        """Candidate-retrieval index over this property's schema, built on first use."""
+        if self._index is None:
+            metric_labels = self.labels.get("metrics", {})
+            dimension_labels = self.labels.get("dimensions", {})
+            self._index = SchemaIndex(
+                [SchemaEntry(m, "metric", *metric_labels.get(m, [])) for m in self.metric_types]
+                + [SchemaEntry(d, "dimension", *dimension_labels.get(d, [])) for d in self.dimension_set]
+            )
+        return self._index
+
+    def fingerprint(self) -> str:
+        """Hash of the metric and dimension names; equal for properties with the same schema."""
+        if self._fingerprint is None:
+            self._fingerprint = call_key(sorted(self.metric_types.items()), sorted(self.dimension_set))
+        return self._fingerprint
+
+    def to_dict(self) -> dict:
+        return {
+            "property_id": self.property_id,
+            "metric_types": self.metric_types,
+            "dimensions": sorted(self.dimension_set),
+            "labels": self.labels
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls.build(data["property_id"], data["metric_types"], data["dimensions"], data.get("labels"))
+
+
+class MetadataStore:
+    """
+    Caches GA4 metadata per property.
+
+    Entries older than ``refresh_after`` are served as-is while a background
+    thread re-fetches them; entries older than ``ttl`` are fetched inline.
+    When ``cache_dir`` is set, every fetch is also written to disk and read
+    back on a cold start.
+    """
+
+    def __init__(
+        self,
+        ttl: int = METADATA_TTL,
+        refresh_after: int = METADATA_REFRESH_AFTER,
+        maxsize: int = METADATA_MAX_PROPERTIES,
+        cache_dir: str = METADATA_CACHE_DIR
+    ):
+        self.refresh_after = refresh_after
+        self.cache_dir = cache_dir
+        self._cache = cache_backend(
+            "metadata", maxsize=maxsize, ttl=ttl,
+            codec=(PropertyMetadata.to_dict, PropertyMetadata.from_dict), local_ttl=CACHE_LOCAL_TTL
+        )
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        # Concurrent cold misses for one property share a single fetch
+        self._flight = SingleFlight("metadata")
+
+    def get(self, property_id: str) -> PropertyMetadata:
+        metadata = self.get_cached(property_id)
+        if metadata is None:
+            return self.refresh(property_id)
+        return metadata
+
+    async def get_async(self, property_id: str) -> PropertyMetadata:
+        metadata = self.get_cached(property_id)
+        if metadata is None:
+            return await self.refresh_async(property_id)
+        return metadata
+
+    def get_cached(self, property_id: str):
+        entry = self._cache.get_entry(property_id) or self._load_from_disk(property_id)
+        if entry is None:
+            return None
+
+        metadata, stored_at = entry
+        if time.time() - stored_at > self.refresh_after:
+            self._refresh_in_background(property_id)
+        return metadata
+
+    def refresh(self, property_id: str) -> PropertyMetadata:
+        def fetch():
+            logger.info(f"Fetching GA4 metadata for property {property_id}")
+            response = get_client().get_metadata(
+                name=f"properties/{property_id}/metadata"
+            )
+            metadata = PropertyMetadata.from_response(property_id, response)
+            self.put(metadata)
+            return metadata
+        return self._flight.do(property_id, fetch)
+
+    async def refresh_async(self, property_id: str) -> PropertyMetadata:
+        async def fetch():
+            logger.info(f"Fetching GA4 metadata for property {property_id}")
+            response = await get_async_client().get_metadata(
+                name=f"properties/{property_id}/metadata"
+            )
+            metadata = PropertyMetadata.from_response(property_id, response)
+            self.put(metadata)
+            return metadata
+        return await self._flight.do_async(property_id, fetch)
+
+    def put(self, metadata: PropertyMetadata, stored_at: float = None):
+        stored_at = stored_at or time.time()
+        self._cache.set(metadata.property_id, metadata, stored_at)
+        self._save_to_disk(metadata, stored_at)
+
+    def invalidate(self, property_id: str):
+        self._cache.delete(property_id)
+
+    def stats(self) -> dict:
+        return self._cache.stats()
+
+    def flight_stats(self) -> dict:
+        return self._flight.stats()
+
+    def _refresh_in_background(self, property_id: str):
+        with self._lock:
+            if property_id in self._refreshing:
+                return
+            self._refreshing.add(property_id)
+
+        def worker():
+            try:
+                self.refresh(property_id)
+            except Exception as e:
+                logger.error(f"Background metadata refresh failed for {property_id}: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(property_id)
+
+        threading.Thread(target=worker, daemon=True).start()
+
+    def _disk_path(self, property_id: str):
+        return os.path.join(self.cache_dir, f"metadata_{property_id}.json")
+
+    def _load_from_disk(self, property_id: str):
+        if not self.cache_dir:
+            return None
+        path = self._disk_path(property_id)
+        try:
+            with open(path) as f:
+                payload = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"Ignoring unreadable metadata cache {path}: {e}")
+            return None
+
+        stored_at = payload["stored_at"]
+        if time.time() - stored_at > self._cache.ttl:
+            return None
+        metadata = PropertyMetadata.from_dict(payload["metadata"])
+        self._cache.set(property_id, metadata, stored_at)
+        return metadata, stored_at
+
+    def _save_to_disk(self, metadata: PropertyMetadata, stored_at: float):
+        if not self.cache_dir:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            path = self._disk_path(metadata.property_id)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"stored_at": stored_at, "metadata": metadata.to_dict()}, f)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.error(f"Could not persist metadata for {metadata.property_id}: {e}")
+
+
+metadata_store = MetadataStore()
+
+
+def get_property_metadata(property_id: str) -> PropertyMetadata:
+    return metadata_store.get(property_id)
+
+
+async def get_property_metadata_async(property_id: str) -> PropertyMetadata:
+    return await metadata_store.get_async(property_id)
 
-    metadata = client.get_metadata(
-        name=f"properties/{property_id}/metadata"
-    )
 
-    metric_types = {
-        m.api_name: m.type_
-        for m in metadata.metrics
-    }
+def load_metadata(property_id: str):
+    metadata = get_property_metadata(property_id)
+    return metadata.metric_types, metadata.dimension_set
 
-    dimension_set = {d.api_name for d in metadata.dimensions}
 
-    return metric_types, dimension_set
+async def load_metadata_async(property_id: str):
+    metadata = await get_property_metadata_async(property_id)
+    return metadata.metric_types, metadata.dimension_set
 
 # -----------------------------
 # Core Validation
 # -----------------------------
 
 def validate_ga4_query(property_id, metrics, dimensions):
-    metric_types, dimension_set = load_metadata(property_id)
+    check_ga4_query(get_property_metadata(property_id), metrics, dimensions)
+    check_compatibility_result(check_compatibility(property_id, metrics, dimensions), metrics, dimensions)
+    return True
+
+
+async def validate_ga4_query_async(property_id, metrics, dimensions):
+    check_ga4_query(await get_property_metadata_async(property_id), metrics, dimensions)
+    result = await check_compatibility_async(property_id, metrics, dimensions)
+    check_compatibility_result(result, metrics, dimensions)
+    return True
 
+
+def check_ga4_query(metadata: PropertyMetadata, metrics, dimensions):
     # --- existence ---
     for m in metrics:
-        if m not in metric_types:
+        if m not in metadata.metric_types:
             raise GA4ValidationError(f"Invalid GA4 metric: {m}", metrics, dimensions)
 
     for d in dimensions:
-        if d not in dimension_set:
+        if d not in metadata.dimension_set:
             raise GA4ValidationError(f"Invalid GA4 dimension: {d}", metrics, dimensions)
 
-    # --- scope rules ---
-    for m in metrics:
-        metric_type = metric_types[m]
-
-        if metric_type == "SESSION" and EVENT_DIMENSIONS & set(dimensions):
-            raise GA4ValidationError(
-                "Session metrics cannot be broken down by event dimensions",
-                metrics,
-                dimensions
-            )
+    return True
 
-        if metric_type == "USER" and ITEM_DIMENSIONS & set(dimensions):
-            raise GA4ValidationError(
-                "User metrics cannot be broken down by item dimensions",
-                metrics,
-                dimensions
-            )
 
-    return True
+def check_compatibility_result(result, metrics, dimensions):
+    # None means GA4 could not be asked; run_report has the final say
+    if result is None or result.compatible:
+        return True
+    raise GA4ValidationError(
+        f"Incompatible GA4 fields: metrics {result.incompatible_metrics} "
+        f"cannot be queried with dimensions {result.incompatible_dimensions}",
+        metrics,
+        dimensions,
+        extra={
+            "incompatible_metrics": result.incompatible_metrics,
+            "incompatible_dimensions": result.incompatible_dimensions
+        }
+    )
 
 
 def validate_realtime_query(metrics, dimensions):
@@ -240,8 +438,60 @@ def validate_realtime_query(metrics, dimensions):
 # LLM Auto-repair
 # -----------------------------
 
-def build_repair_prompt(error, metric_map, dimension_set,mode="Core"):
+# LLM repairs by (model, prompt); the prompt holds the invalid query, the
+# error and the candidates, so a hit is the same repair problem
+repair_cache = cache_backend("repair", maxsize=1024, ttl=REPAIR_CACHE_TTL)
+
+@lru_cache(maxsize=1)
+def realtime_index() -> SchemaIndex:
+    return SchemaIndex.from_names(REALTIME_ALLOWED_METRICS, REALTIME_ALLOWED_DIMENSIONS)
+
+
+def resolve_locally(index: SchemaIndex, metrics, dimensions):
+    """
+    Map every unknown metric / dimension onto a valid name with the schema
+    index. Returns the repaired (metrics, dimensions), or None when a name
+    cannot be resolved confidently or nothing changed.
+    """
+    repaired = {}
+    for kind, names in (("metric", metrics), ("dimension", dimensions)):
+        out = []
+        for name in names:
+            resolved = index.resolve(name, kind)
+            if resolved is None:
+                return None
+            if resolved not in out:
+                out.append(resolved)
+        repaired[kind] = out
+
+    if (repaired["metric"], repaired["dimension"]) == (list(metrics), list(dimensions)):
+        return None
+    logger.info(f"Resolved {metrics}/{dimensions} locally to {repaired['metric']}/{repaired['dimension']}")
+    SCHEMA_REPAIRS.inc(method="local")
+    return repaired["metric"], repaired["dimension"]
+
+
+def repair_candidates(index: SchemaIndex, names, kind, k: int = SCHEMA_REPAIR_TOP_K):
+    """Names already valid plus the top-k nearest valid names for each invalid one."""
+    candidates = []
+    for name in names:
+        if (kind, name) in index.by_name:
+            ranked = [name]
+        else:
+            ranked = [api_name for api_name, _ in index.candidates(name, kind, k)]
+        for api_name in ranked:
+            if api_name not in candidates:
+                candidates.append(api_name)
+    if not candidates:
+        # Nothing to anchor on; fall back to a small slice of the schema
+        candidates = [e.api_name for e in index.entries if e.kind == kind][:k]
+    return [index.describe(c, kind) for c in candidates]
+
+
+def build_repair_prompt(error, metric_candidates, dimension_candidates, mode="Core"):
     logger.info(f"The Repair Prompt is building")
+    metric_lines = "\n".join(f"- {c}" for c in metric_candidates)
+    dimension_lines = "\n".join(f"- {c}" for c in dimension_candidates)
     return f"""
 You are a Google Analytics 4 query repair agent repairing {mode.upper()} query.
 
@@ -256,30 +506,24 @@ Metrics:
 Dimensions:
 {error.dimensions}
 
-VALID METRICS:
-{list(metric_map)}
+VALID METRICS (closest matches):
+{metric_lines}
 
-VALID DIMENSIONS:
-{list(dimension_set)}
+VALID DIMENSIONS (closest matches):
+{dimension_lines}
 
 Invalid error:
 {str(error)}
 
 Rules:
 - ONLY return fields supported by GA4 {mode.upper()} reports
-- Use ONLY valid metrics and dimensions
+- Use ONLY the valid metrics and dimensions listed above (api name before the parentheses)
 - Ensure compatibility
 - Preserve original intent
 - Prefer removing invalid dimensions over changing metrics
 IMPORTANT:
 GA4 metric names MUST match the GA4 Data API exactly.
 
-Examples:
-- Use "ecommercePurchases" NOT "purchases"
-- Use "eventsPerSession" NOT "eventCountPerSession"
-- Use "screenPageViews" NOT "pageViews"
-- Use "keyEvents" NOT "conversions"
-
 If unsure, choose the closest valid GA4 metric.
 Return STRICT JSON ONLY.
 
@@ -291,27 +535,63 @@ Format:
 """
 
 def llm_repair_query(
-    client,
     property_id: str,
     error: GA4BaseValidationError,
     mode:"Core"
 ):
     if mode.lower()=="core":
-        metric_type, dimension_set = load_metadata(property_id)
-        metric_map = metric_type.keys()
+        index = get_property_metadata(property_id).index()
     else:
-        metric_map, dimension_set = REALTIME_ALLOWED_METRICS,REALTIME_ALLOWED_DIMENSIONS
-
-    prompt = build_repair_prompt(error, metric_map, dimension_set,mode)
-    logger.info(f"The Repair prompt is generated, {prompt}")
-    response = client.chat.completions.create(
-        model=parser_model,
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0
+        index = realtime_index()
+
+    prompt = build_repair_prompt(
+        error,
+        repair_candidates(index, error.metrics, "metric"),
+        repair_candidates(index, error.dimensions, "dimension"),
+        mode
     )
+    log_payload("Repair prompt", prompt)
+    key = call_key(parser_model, prompt)
+    cached = repair_cache.get(key)
+    if cached is not None:
+        SCHEMA_REPAIRS.inc(method="cache")
+        return cached
+    response = llm_gateway.complete(parser_model, prompt, temperature=0)
+    SCHEMA_REPAIRS.inc(method="llm")
+    log_payload("Repair response", response, model=parser_model)
+    repaired = safe_json_loads(response.choices[0].message.content)
+    repair_cache.set(key, repaired)
+    return repaired
+
+
+async def llm_repair_query_async(
+    property_id: str,
+    error: GA4BaseValidationError,
+    mode:"Core"
+):
+    if mode.lower()=="core":
+        index = (await get_property_metadata_async(property_id)).index()
+    else:
+        index = realtime_index()
 
-    logger.info(f"Model used is {parser_model} with response is {response}")
-    return safe_json_loads(response.choices[0].message.content)
+    prompt = build_repair_prompt(
+        error,
+        repair_candidates(index, error.metrics, "metric"),
+        repair_candidates(index, error.dimensions, "dimension"),
+        mode
+    )
+    log_payload("Repair prompt", prompt)
+    key = call_key(parser_model, prompt)
+    cached = repair_cache.get(key)
+    if cached is not None:
+        SCHEMA_REPAIRS.inc(method="cache")
+        return cached
+    response = await llm_gateway.complete_async(parser_model, prompt, temperature=0)
+    SCHEMA_REPAIRS.inc(method="llm")
+    log_payload("Repair response", response, model=parser_model)
+    repaired = safe_json_loads(response.choices[0].message.content)
+    repair_cache.set(key, repaired)
+    return repaired
 
 
 # -----------------------------
@@ -319,7 +599,6 @@ def llm_repair_query(
 # -----------------------------
 
 def validate_with_auto_repair(
-    client,
     property_id: str,
     metrics: list[str],
     dimensions: list[str],
@@ -340,18 +619,27 @@ def validate_with_auto_repair(
 
     except GA4BaseValidationError as e:
         logger.info(f"GA4BaseValidationError is raised")
+        index = realtime_index() if mode == "realtime" else get_property_metadata(property_id).index()
+        local = resolve_locally(index, e.metrics, e.dimensions)
+        if local is not None:
+            return validate_with_auto_repair(property_id, *local, mode=mode, retries=retries)
         if retries <= 0:
             raise
 
-        repaired = llm_repair_query(
-            client=client,
-            property_id=property_id,
-            error=e,
-            mode=mode
-        )
+        try:
+            with STAGE_SECONDS.time(stage="repair"):
+                repaired = llm_repair_query(
+                    property_id=property_id,
+                    error=e,
+                    mode=mode
+                )
+        except LLMGatewayError as llm_error:
+            # No LLM to repair with: report the validation error itself
+            logger.error(f"Schema repair unavailable: {llm_error}")
+            LLM_FALLBACKS.inc(component="repair")
+            raise e
 
         return validate_with_auto_repair(
-            client,
             property_id,
             repaired["metrics"],
             repaired["dimensions"],
@@ -360,4 +648,53 @@ def validate_with_auto_repair(
         )
 
 
+async def validate_with_auto_repair_async(
+    property_id: str,
+    metrics: list[str],
+    dimensions: list[str],
+    mode: str = "core",
+    retries: int = 1
+):
+    logger.info(f"Identified Mode is {mode}")
+    try:
+        if mode == "realtime":
+            validate_realtime_query(metrics, dimensions)
+        else:
+            metrics = normalize_metrics(metrics)
+            dimensions = normalize_dimensions(dimensions)
+            await validate_ga4_query_async(property_id, metrics, dimensions)
+
+        return metrics, dimensions
 
+    except GA4BaseValidationError as e:
+        logger.info(f"GA4BaseValidationError is raised")
+        if mode == "realtime":
+            index = realtime_index()
+        else:
+            index = (await get_property_metadata_async(property_id)).index()
+        local = resolve_locally(index, e.metrics, e.dimensions)
+        if local is not None:
+            return await validate_with_auto_repair_async(property_id, *local, mode=mode, retries=retries)
+        if retries <= 0:
+            raise
+
+        try:
+            with STAGE_SECONDS.time(stage="repair"):
+                repaired = await llm_repair_query_async(
+                    property_id=property_id,
+                    error=e,
+                    mode=mode
+                )
+        except LLMGatewayError as llm_error:
+            # No LLM to repair with: report the validation error itself
+            logger.error(f"Schema repair unavailable: {llm_error}")
+            LLM_FALLBACKS.inc(component="repair")
+            raise e
+
+        return await validate_with_auto_repair_async(
+            property_id,
+            repaired["metrics"],
+            repaired["dimensions"],
+            mode=mode,
+            retries=retries - 1
+        )
@@ -0,0 +1,262 @@
+"""
+Deterministic trend / anomaly analysis of GA4 report rows.
+
+Computes per-metric direction and start-vs-end change, rolling z-score (or
+IQR for short series) anomalies and per-dimension top contributors with
+NumPy, and fills the summarizer's trends / anomalies / dimension_insights
+JSON shape. The result is independent of the number of rows, so it can be
+handed to the LLM as a compact digest.
+"""
+
+from utils.packages import *
+from app.report_frame import ReportFrame
+import numpy as np
+
+TIME_DIMENSIONS = ("date", "dateHour", "dateHourMinute", "week", "month", "year", "minutesAgo")
+
+FLAT_THRESHOLD = float(os.getenv("INSIGHTS_FLAT_THRESHOLD", "0.05"))
+ANOMALY_Z = float(os.getenv("INSIGHTS_ANOMALY_Z", "3.0"))
+ROLLING_WINDOW = int(os.getenv("INSIGHTS_ROLLING_WINDOW", "7"))
+TOP_N = int(os.getenv("INSIGHTS_TOP_N", "3"))
+
+
+def is_additive(metric: str) -> bool:
+    # Rates, averages and per-X ratios cannot be summed across rows
+    return not (metric.startswith("average") or "Rate" in metric or "Per" in metric)
+
+
+def time_dimension(dimensions):
+    for d in dimensions:
+        if d in TIME_DIMENSIONS:
+            return d
+    return None
+
+
+def columns_from_rows(rows, metrics, dimensions):
+    if isinstance(rows, ReportFrame):
+        # Already columnar: no per-row work
+        values = {m: rows.columns[m].astype(np.float64, copy=False) for m in metrics}
+        labels = {d: rows.dimension_array(d) for d in dimensions}
+        return values, labels
+
+    rows = list(rows)
+    values = {
+        m: np.fromiter((float(r.get(m, 0) or 0) for r in rows), dtype=np.float64, count=len(rows))
+        for m in metrics
+    }
+    labels = {d: np.array([str(r.get(d, "")) for r in rows], dtype=object) for d in dimensions}
+    return values, labels
+
+
+def group_sums(keys, values):
+    """Per-key (sum, count) of ``values``."""
+    uniques, inverse = np.unique(keys, return_inverse=True)
+    return (
+        uniques,
+        np.bincount(inverse, weights=values, minlength=len(uniques)),
+        np.bincount(inverse, minlength=len(uniques))
+    )
+
+
+def ordered_series(keys, values, time_dim):
+    if time_dim == "minutesAgo":
+        # Minutes ago counts backwards; put the oldest minute first
+        order = np.argsort(keys.astype(np.int64))[::-1]
+    else:
+        order = np.argsort(keys)
+    return keys[order], values[order]
+
+
+def trend(series):
+    n = len(series)
+    if n < 2:
+        return None
+
+    k = max(1, n // 4)
+    start, end = series[:k].mean(), series[-k:].mean()
+    change = (end - start) / abs(start) if start else (np.inf if end > 0 else 0.0)
+    slope = np.polyfit(np.arange(n, dtype=np.float64), series, 1)[0]
+
+    if abs(change) <= FLAT_THRESHOLD:
+        direction = "flat"
+    elif np.sign(change) != np.sign(slope):
+        direction = "mixed"
+    else:
+        direction = "up" if change > 0 else "down"
+    return {"direction": direction, "start": float(start), "end": float(end), "change": float(change)}
+
+
+def anomalies(series, window: int = ROLLING_WINDOW, threshold: float = ANOMALY_Z):
+    """Indexes and scores of points that stand out from the series."""
+    n = len(series)
+    if n < 4:
+        return []
+
+    if n > window:
+        history = np.lib.stride_tricks.sliding_window_view(series[:-1], window)
+        mean, std = history.mean(axis=1), history.std(axis=1)
+        current = series[window:]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            z = np.where(std > 0, (current - mean) / std, 0.0)
+        flagged = np.nonzero(np.abs(z) > threshold)[0]
+        return [(int(i + window), float(z[i])) for i in flagged]
+
+    q1, q3 = np.percentile(series, [25, 75])
+    iqr = q3 - q1
+    if iqr == 0:
+        return []
+    low, high = q1 - 1.5 * iqr, q3 + 1.5 * iqr
+    flagged = np.nonzero((series < low) | (series > high))[0]
+    return [(int(i), float((series[i] - np.median(series)) / iqr)) for i in flagged]
+
+
+def top_contributors(keys, totals, metric, top_n: int = TOP_N):
+    order = np.argsort(totals)[::-1][:top_n]
+    grand_total = totals.sum()
+    return [
+        {
+            "value": str(keys[i]),
+            "total": float(totals[i]),
+            "share": float(totals[i] / grand_total) if grand_total and is_additive(metric) else None
+        }
+        for i in order
+    ]
+
+
+class RowDigest:
+    """
+    Incremental aggregation of report rows. Rows can be added in chunks as
+    they stream in; memory grows with the number of distinct dimension
+    values, not with the number of rows.
+    """
+
+    def __init__(self, metrics, dimensions):
+        self.metrics = list(metrics)
+        self.dimensions = list(dimensions)
+        self.time_dim = time_dimension(dimensions)
+        self.breakdowns = [d for d in dimensions if d != self.time_dim]
+        self.rows = 0
+        self.sums = {m: 0.0 for m in self.metrics}
+        self.groups = {
+            (m, d): {}
+            for m in self.metrics
+            for d in ([self.time_dim] if self.time_dim else []) + self.breakdowns
+        }
+
+    def add(self, rows):
+        values, labels = columns_from_rows(rows, self.metrics, self.dimensions)
+        self.rows += len(rows) if isinstance(rows, ReportFrame) else len(next(iter(values.values()), []))
+        for (m, d), acc in self.groups.items():
+            keys, sums, counts = group_sums(labels[d], values[m])
+            for key, total, count in zip(keys.tolist(), sums.tolist(), counts.tolist()):
+                entry = acc.get(key)
+                if entry is None:
+                    acc[key] = [total, count]
+                else:
+                    entry[0] += total
+                    entry[1] += count
+        for m in self.metrics:
+            self.sums[m] += float(values[m].sum())
+        return self
+
+    def grouped(self, metric, dimension):
+        """Per-value totals for additive metrics, per-value means otherwise."""
+        acc = self.groups[(metric, dimension)]
+        keys = np.array(list(acc.keys()), dtype=object)
+        stats = np.array(list(acc.values()), dtype=np.float64).reshape(-1, 2)
+        if is_additive(metric):
+            return keys, stats[:, 0]
+        return keys, stats[:, 0] / np.maximum(stats[:, 1], 1)
+
+    def digest(self) -> dict:
+        """Numeric digest of a report: per-metric trend, anomalies and contributors."""
+        digest = {"rows": self.rows, "time_dimension": self.time_dim, "metrics": {}}
+        for m in self.metrics:
+            entry = {
+                "total": self.sums[m] if is_additive(m) else None,
+                "mean": self.sums[m] / self.rows if self.rows else None,
+            }
+            if self.time_dim:
+                keys, series = ordered_series(*self.grouped(m, self.time_dim), self.time_dim)
+                entry["trend"] = trend(series)
+                entry["anomalies"] = [
+                    {"at": str(keys[i]), "value": float(series[i]), "score": round(score, 2)}
+                    for i, score in anomalies(series)
+                ]
+            entry["contributors"] = {
+                d: top_contributors(*self.grouped(m, d), m) for d in self.breakdowns
+            }
+            digest["metrics"][m] = entry
+        return digest
+
+
+def analyze(rows, metrics, dimensions) -> dict:
+    return RowDigest(metrics, dimensions).add(rows).digest()
+
+# -----------------------------
+# Digest -> summary JSON
+# -----------------------------
+
+def format_number(value) -> str:
+    if value is None:
+        return "n/a"
+    if abs(value) >= 100 or float(value).is_integer():
+        return f"{value:,.0f}"
+    return f"{value:,.2f}"
+
+
+def digest_to_summary(digest: dict) -> dict:
+    trends, anomaly_items, insights, sentences = [], [], [], []
+
+    if digest["rows"] == 0:
+        return {
+            "summary": "No data was returned for the requested report, so no trends can be inferred.",
+            "trends": [],
+            "anomalies": [],
+            "dimension_insights": []
+        }
+
+    for metric, entry in digest["metrics"].items():
+        t = entry.get("trend")
+        if t:
+            change = "n/a" if not np.isfinite(t["change"]) else f"{t['change']:+.0%}"
+            description = (
+                f"{metric} moved from {format_number(t['start'])} at the start of the period "
+                f"to {format_number(t['end'])} at the end ({change})."
+            )
+            trends.append({"metric": metric, "direction": t["direction"], "description": description})
+            sentences.append(f"{metric} is {t['direction']} ({change})")
+        elif entry["total"] is not None:
+            sentences.append(f"{metric} totalled {format_number(entry['total'])}")
+        else:
+            sentences.append(f"{metric} averaged {format_number(entry['mean'])}")
+
+        for a in entry.get("anomalies", []):
+            kind = "spike" if a["score"] > 0 else "drop"
+            anomaly_items.append({
+                "metric": metric,
+                "date": a["at"],
+                "description": f"Unusual {kind} in {metric} ({format_number(a['value'])}, score {a['score']})."
+            })
+
+        for dimension, contributors in entry["contributors"].items():
+            for c in contributors[:1]:
+                share = f" ({c['share']:.0%} of the total)" if c["share"] is not None else ""
+                insights.append({
+                    "dimension": dimension,
+                    "value": c["value"],
+                    "description": f"Top {dimension} for {metric} with {format_number(c['total'])}{share}."
+                })
+
+    summary = "; ".join(sentences) + "."
+    if anomaly_items:
+        summary += f" {len(anomaly_items)} anomal{'y' if len(anomaly_items) == 1 else 'ies'} detected."
+    if digest["time_dimension"] is None:
+        summary += " The report has no time dimension, so trends over time cannot be inferred."
+
+    return {
+        "summary": summary,
+        "trends": trends,
+        "anomalies": anomaly_items,
+        "dimension_insights": insights
+    }
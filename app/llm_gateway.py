@@ -0,0 +1,371 @@
+"""
+Single entry point for LLM completions (parser, schema repair, summarizer).
+
+- Calls go through the process-wide OpenAI clients from utils.config, so
+  keep-alive connections are pooled, and identical prompts in flight share
+  one call (llm_flight).
+- Every call has a deadline (LLM_TIMEOUT by default) covering the wait for
+  a slot and the completion itself.
+- Each model has at most LLM_MAX_CONCURRENT_PER_MODEL calls in flight.
+- Once LLM_HEDGE_MIN_SAMPLES latencies of a model are known, a call still
+  running after that model's p95 gets one duplicate request, if a slot is
+  free. The first response wins and the other is cancelled.
+- A circuit breaker opens after LLM_BREAKER_FAILURES consecutive failed
+  calls to the endpoint. Calls that never got a local slot
+  (LLMSaturatedError) say nothing about the endpoint and are not
+  counted. While it is open calls fail immediately with
+  LLMUnavailableError, so callers go straight to their deterministic
+  fallbacks. After LLM_BREAKER_COOLDOWN seconds one probe call is let
+  through to decide whether to close it again.
+"""
+
+from utils.packages import *
+from utils.config import *
+from utils.metrics import LLM_SECONDS, record_llm_usage
+from concurrent.futures import FIRST_COMPLETED, wait as wait_futures
+
+LLM_MAX_CONCURRENT_PER_MODEL = int(os.getenv("LLM_MAX_CONCURRENT_PER_MODEL", "16"))
+LLM_HEDGE = os.getenv("LLM_HEDGE", "true").lower() == "true"
+LLM_HEDGE_QUANTILE = float(os.getenv("LLM_HEDGE_QUANTILE", "0.95"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "0.5"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+
+# Latencies kept per model for the hedge threshold
+LATENCY_WINDOW = 200
+
+
+class LLMGatewayError(Exception):
+    pass
+
+
+class LLMUnavailableError(LLMGatewayError):
+    """The circuit breaker is open."""
+
+
+class LLMTimeoutError(LLMGatewayError):
+    def __init__(self, model, timeout):
+        super().__init__(f"LLM call to {model} exceeded its {timeout}s deadline")
+        self.model = model
+        self.timeout = timeout
+
+
+class LLMSaturatedError(LLMGatewayError):
+    """No local slot for the model freed up within the deadline."""
+
+    def __init__(self, model, timeout):
+        super().__init__(f"No free slot for {model} within {timeout}s ({LLM_MAX_CONCURRENT_PER_MODEL} calls in flight)")
+        self.model = model
+        self.timeout = timeout
+
+
+def is_client_error(error) -> bool:
+    # 4xx other than 429 means the endpoint is up and rejected the request
+    status = getattr(error, "status_code", None)
+    return status is not None and 400 <= status < 500 and status != 429
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failures: int = LLM_BREAKER_FAILURES, cooldown: float = LLM_BREAKER_COOLDOWN):
+        self.threshold = failures
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.time()
+            if now - self.opened_at >= self.cooldown:
+                # Let one probe through per cooldown; everyone else keeps failing fast
+                self.state = self.HALF_OPEN
+                self.opened_at = now
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, error=None):
+        with self._lock:
+            if error is None or is_client_error(error):
+                if self.state != self.CLOSED:
+                    logger.info(f"LLM circuit closed")
+                self.state = self.CLOSED
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                if self.state != self.OPEN:
+                    logger.error(f"LLM circuit opened after {self.failures} failure(s): {error}")
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+
+class LLMGateway:
+    def __init__(self, max_per_model: int = LLM_MAX_CONCURRENT_PER_MODEL, hedge: bool = LLM_HEDGE):
+        self.max_per_model = max_per_model
+        self.hedge = hedge
+        self.breaker = CircuitBreaker()
+        self._lock = threading.Lock()
+        self._slots = {}
+        self._async_slots = {}
+        self._latencies = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_per_model * 2, thread_name_prefix="llm")
+        self.counts = {"calls": 0, "hedged": 0, "hedge_wins": 0, "timeouts": 0, "saturated": 0, "failures": 0}
+
+    # -----------------------------
+    # Slots and latency tracking
+    # -----------------------------
+
+    def slots(self, model) -> threading.BoundedSemaphore:
+        with self._lock:
+            slots = self._slots.get(model)
+            if slots is None:
+                slots = self._slots[model] = threading.BoundedSemaphore(self.max_per_model)
+            return slots
+
+    def async_slots(self, model) -> asyncio.Semaphore:
+        # asyncio semaphores belong to one event loop
+        key = (id(asyncio.get_running_loop()), model)
+        with self._lock:
+            slots = self._async_slots.get(key)
+            if slots is None:
+                slots = self._async_slots[key] = asyncio.Semaphore(self.max_per_model)
+            return slots
+
+    def hedge_delay(self, model):
+        """Seconds after which a call to ``model`` is hedged, or None."""
+        if not self.hedge:
+            return None
+        samples = self._latencies.get(model)
+        if not samples or len(samples) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return max(LLM_HEDGE_MIN_DELAY, ordered[int(LLM_HEDGE_QUANTILE * (len(ordered) - 1))])
+
+    def _observe(self, model, started, outcome):
+        elapsed = time.perf_counter() - started
+        LLM_SECONDS.observe(elapsed, model=model, outcome=outcome)
+        if outcome == "ok":
+            with self._lock:
+                samples = self._latencies.get(model)
+                if samples is None:
+                    samples = self._latencies[model] = deque(maxlen=LATENCY_WINDOW)
+                samples.append(elapsed)
+
+    def _finish(self, model, started, error=None):
+        if error is None:
+            outcome = "ok"
+        elif isinstance(error, LLMSaturatedError):
+            # Local congestion: the endpoint was never called, so the breaker is left alone
+            self.counts["saturated"] += 1
+            self._observe(model, started, "saturated")
+            return
+        elif isinstance(error, LLMTimeoutError):
+            outcome = "timeout"
+            self.counts["timeouts"] += 1
+        else:
+            outcome = "error"
+            self.counts["failures"] += 1
+        self._observe(model, started, outcome)
+        self.breaker.record(error)
+
+    def _admit(self, model):
+        if not self.breaker.allow():
+            raise LLMUnavailableError(f"LLM circuit is open, not calling {model}")
+        self.counts["calls"] += 1
+
+    @staticmethod
+    def _messages(prompt):
+        return [{"role": "user", "content": prompt}]
+
+    # -----------------------------
+    # Completions
+    # -----------------------------
+
+    def complete(self, model, prompt, timeout: float = None, **params):
+        """Chat completion of a single user prompt."""
+        timeout = timeout or LLM_TIMEOUT
+        return llm_flight.do(call_key(model, prompt, params), self._complete, model, prompt, timeout, params)
+
+    def _complete(self, model, prompt, timeout, params):
+        self._admit(model)
+        started = time.perf_counter()
+        deadline = time.monotonic() + timeout
+        slots = self.slots(model)
+        try:
+            if not slots.acquire(timeout=timeout):
+                raise LLMSaturatedError(model, timeout)
+            response = self._race(model, prompt, deadline, timeout, params, slots)
+        except Exception as e:
+            self._finish(model, started, e)
+            raise
+        self._finish(model, started)
+        record_llm_usage(model, response)
+        return response
+
+    def _attempt(self, slots, model, prompt, timeout, params):
+        try:
+            return client.chat.completions.create(
+                model=model, messages=self._messages(prompt), timeout=timeout, **params
+            )
+        finally:
+            slots.release()
+
+    def _race(self, model, prompt, deadline, timeout, params, slots):
+        """Run the call (holding one slot), hedging it once if it outlives the model's p95."""
+        delay = self.hedge_delay(model)
+        primary = self._executor.submit(self._attempt, slots, model, prompt, timeout, params)
+        pending, error = {primary}, None
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = wait_futures(
+                pending, timeout=min(remaining, delay) if delay else remaining, return_when=FIRST_COMPLETED
+            )
+            for future in done:
+                if future.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    if future is not primary:
+                        self.counts["hedge_wins"] += 1
+                    return future.result()
+                error = future.exception()
+            if not done and delay and slots.acquire(blocking=False):
+                self.counts["hedged"] += 1
+                pending.add(self._executor.submit(self._attempt, slots, model, prompt, deadline - time.monotonic(), params))
+            if not done:
+                delay = None
+        if error is not None and not pending:
+            raise error
+        raise LLMTimeoutError(model, timeout)
+
+    async def complete_async(self, model, prompt, timeout: float = None, **params):
+        timeout = timeout or LLM_TIMEOUT
+        return await llm_flight.do_async(
+            call_key(model, prompt, params), self._complete_async, model, prompt, timeout, params
+        )
+
+    async def _complete_async(self, model, prompt, timeout, params):
+        self._admit(model)
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        slots = self.async_slots(model)
+        try:
+            try:
+                await asyncio.wait_for(slots.acquire(), timeout)
+            except asyncio.TimeoutError:
+                raise LLMSaturatedError(model, timeout)
+            response = await self._race_async(model, prompt, deadline, timeout, params, slots)
+        except Exception as e:
+            self._finish(model, started, e)
+            raise
+        self._finish(model, started)
+        record_llm_usage(model, response)
+        return response
+
+    async def _attempt_async(self, slots, model, prompt, timeout, params):
+        try:
+            return await async_client.chat.completions.create(
+                model=model, messages=self._messages(prompt), timeout=timeout, **params
+            )
+        finally:
+            slots.release()
+
+    async def _race_async(self, model, prompt, deadline, timeout, params, slots):
+        loop = asyncio.get_running_loop()
+        delay = self.hedge_delay(model)
+        primary = asyncio.ensure_future(self._attempt_async(slots, model, prompt, timeout, params))
+        pending, error = {primary}, None
+        try:
+            while pending:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                done, pending = await asyncio.wait(
+                    pending, timeout=min(remaining, delay) if delay else remaining, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.counts["hedge_wins"] += 1
+                        return task.result()
+                    error = task.exception()
+                if not done and delay and not slots.locked():
+                    await slots.acquire()
+                    self.counts["hedged"] += 1
+                    pending.add(asyncio.ensure_future(
+                        self._attempt_async(slots, model, prompt, deadline - loop.time(), params)
+                    ))
+                if not done:
+                    delay = None
+            if error is not None and not pending:
+                raise error
+            raise LLMTimeoutError(model, timeout)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def stream_async(self, model, prompt, timeout: float = None, **params):
+        """
+        Streamed completion; yields text deltas. ``timeout`` bounds the wait
+        for a slot and the first chunk. Streams are not hedged or shared.
+        """
+        timeout = timeout or LLM_TIMEOUT
+        self._admit(model)
+        started = time.perf_counter()
+        slots = self.async_slots(model)
+        try:
+            await asyncio.wait_for(slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            error = LLMSaturatedError(model, timeout)
+            self._finish(model, started, error)
+            raise error
+
+        try:
+            stream = await asyncio.wait_for(async_client.chat.completions.create(
+                model=model,
+                messages=self._messages(prompt),
+                timeout=timeout,
+                stream=True,
+                stream_options={"include_usage": True},
+                **params
+            ), timeout)
+            async for chunk in stream:
+                if not chunk.choices:
+                    # The final chunk only carries the token usage
+                    record_llm_usage(model, chunk)
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+        except asyncio.TimeoutError:
+            error = LLMTimeoutError(model, timeout)
+            self._finish(model, started, error)
+            raise error
+        except Exception as e:
+            self._finish(model, started, e)
+            raise
+        else:
+            self._finish(model, started)
+        finally:
+            slots.release()
+
+    def stats(self) -> dict:
+        return {
+            **self.counts,
+            "rejected": self.breaker.rejected,
+            "circuit": self.breaker.state,
+            "hedge_delays": {model: self.hedge_delay(model) for model in list(self._latencies)}
+        }
+
+
+llm_gateway = LLMGateway()
@@ -1,3 +1,9 @@
+from dotenv import load_dotenv
+
+# Modules read their settings from the environment when they are imported,
+# so .env is loaded first, once, for the whole process
+load_dotenv()
+
 from utils.packages import *
 from utils.config import *
 from app.ga4_schema_validator import *
@@ -5,13 +11,78 @@ from app.nl_parser import *
 from app.ga4_client import *
 from app.summarizer import *
 from app.report_router import *
+from app.pipeline import *
+from app.batch import run_batch
+from app.fanout import run_fanout, resolve_properties
+from app.insights import RowDigest
+from app.report_frame import ReportFrame, FrameJSONResponse
+from app.realtime_hub import realtime_hub
+from app.report_cache import report_cache
+from app.parse_cache import parse_cache
+from app.compatibility import compatibility_engine
+from app.llm_gateway import llm_gateway
+from app.rollup_store import rollup_store, run_rollup_report_async
+from utils.metrics import registry, request_id, stage_timings, REQUEST_SECONDS
+from utils.logger import configure_logging
 
+configure_logging()
 app = FastAPI()
 
 
 class AnalyticsRequest(BaseModel):
-    propertyId: str
+    # One property, or several via propertyIds / a named propertyGroup
+    propertyId: str | None = None
     query: str
+    propertyIds: list[str] | None = None
+    propertyGroup: str | None = None
+
+    def is_fanout(self) -> bool:
+        return bool(self.propertyIds or self.propertyGroup)
+
+
+class BatchAnalyticsRequest(BaseModel):
+    propertyId: str
+    queries: list[str]
+
+
+@app.on_event("startup")
+async def startup():
+    rollup_store.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    rollup_store.stop()
+    realtime_hub.close()
+    client_manager.close()
+    await client_manager.aclose()
+
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    # Honour a caller-supplied trace ID so logs can be joined across services
+    trace_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    token = request_id.set(trace_id)
+    timings_token = stage_timings.set({})
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers["X-Request-ID"] = trace_id
+        return response
+    finally:
+        elapsed = time.perf_counter() - started
+        route = request.scope.get("route")
+        path = route.path if route else "unmatched"
+        REQUEST_SECONDS.observe(elapsed, method=request.method, path=path, status=status)
+        # One record per request with its stage timings
+        logger.bind(
+            method=request.method, path=path, status=status,
+            duration_ms=round(elapsed * 1000, 1), stages=stage_timings.get()
+        ).info("Request completed")
+        stage_timings.reset(timings_token)
+        request_id.reset(token)
 
 
 @app.get("/health")
@@ -19,63 +90,354 @@ def health():
     return {"status": "ok"}
 
 
-@app.post("/query")
-def analytics_query(req: AnalyticsRequest):
-    try:
-        parsed = parse_query(req.query)
-        metrics = parsed.get("metrics", [])
-        dimensions = parsed.get("dimensions", [])
-
-        if not metrics:
-            raise ValueError("No valid GA4 metrics found")
-
-        # 2. Determine report mode
-        logger.info(f"Identified is_realtime is {parsed.get("is_realtime")}")
-        mode = "realtime" if eval(parsed.get("is_realtime")) else "core"
-        # 3. Validate + auto-repair schema
-        metrics, dimensions = validate_with_auto_repair(
-            client,  # LLM client is created inside repair function
-            property_id=req.propertyId,
-            metrics=metrics,
-            dimensions=dimensions,
-            mode=mode
-        )
-        parsed['metrics'] = metrics
-        parsed['dimensions'] = dimensions
-        logger.info('Validataion of metrics and dimensions is completed')
-        # 4. Execute report (router decides core vs realtime)
-        rows = execute_report(parsed, req.propertyId)
+@registry.collector
+def cache_metrics():
+    caches = {
+        "report": report_cache.stats(),
+        "parse": parse_cache.stats(),
+        "metadata": metadata_store.stats(),
+        "summary": summary_cache.stats(),
+        "repair": repair_cache.stats(),
+        "rollup": rollup_store.stats()
+    }
+    flights = {
+        "ga4": report_flight.stats(),
+        "llm": llm_flight.stats(),
+        "metadata": metadata_store.flight_stats(),
+        "compatibility": compatibility_engine.flight_stats()
+    }
+    scheduler = ga4_scheduler.stats()
+    compatibility = compatibility_engine.stats()
+    gateway = llm_gateway.stats()
+    events = [
+        ((name, event), stats[event])
+        for name, stats in caches.items()
+        for event in ("hits", "near_hits", "misses") if event in stats
+    ]
+    return [
+        ("spikeai_cache_events_total", "counter", "Cache lookups by cache and result",
+         ("cache", "result"), events),
+        ("spikeai_cache_entries", "gauge", "Entries currently held per cache",
+         ("cache",), [((name,), stats["size"]) for name, stats in caches.items()]),
+        ("spikeai_singleflight_calls_total", "counter", "Calls issued by each single-flight group",
+         ("group",), [((name,), stats["calls"]) for name, stats in flights.items()]),
+        ("spikeai_singleflight_shared_total", "counter", "Duplicate calls that reused an in-flight result",
+         ("group",), [((name,), stats["shared"]) for name, stats in flights.items()]),
+        ("spikeai_compatibility_checks_total", "counter",
+         "Compatibility checks by how they were answered (combination, pairs, api, errors)",
+         ("source",), [((source,), compatibility[source]) for source in ("combination", "pairs", "api", "errors")]),
+        ("spikeai_llm_gateway_events_total", "counter",
+         "LLM gateway calls, hedged duplicates, hedge wins, timeouts, slot waits given up, failures and circuit rejections",
+         ("event",), [((event,), gateway[event])
+                      for event in ("calls", "hedged", "hedge_wins", "timeouts", "saturated", "failures", "rejected")]),
+        ("spikeai_llm_circuit_open", "gauge", "1 while the LLM circuit breaker is open or probing",
+         (), [((), int(gateway["circuit"] != "closed"))]),
+        ("spikeai_ga4_scheduler_in_flight", "gauge", "GA4 calls currently holding a scheduler slot",
+         (), [((), scheduler["in_flight"])]),
+        ("spikeai_ga4_scheduler_waiting", "gauge", "GA4 calls queued for a scheduler slot",
+         (), [((), scheduler["waiting"])]),
+        ("spikeai_ga4_retries_total", "counter", "GA4 calls retried after a transient error",
+         (), [((), scheduler["retries"])]),
+        ("spikeai_ga4_property_concurrency", "gauge", "Current adaptive concurrency per property and quota category",
+         ("property", "category"), [((pid, category), s["capacity"])
+                                    for pid, categories in scheduler["properties"].items()
+                                    for category, s in categories.items()]),
+        ("spikeai_realtime_pollers", "gauge", "Active realtime pollers",
+         (), [((), realtime_hub.stats()["pollers"])]),
+        ("spikeai_realtime_subscribers", "gauge", "Connected realtime subscribers",
+         (), [((), realtime_hub.stats()["subscribers"])]),
+    ]
 
-        # 5. Summarize results
-        if eval(parsed.get("is_realtime")):
-            summary = summarize(req.query, rows[0], metrics, dimensions, rows[1])
-            return {
-                "metadata": {
-                    "propertyId": req.propertyId,
-                    "mode": mode,
-                    "metrics": metrics,
-                    "dimensions": dimensions,
-                    "duration": rows[1],
-                    "page_path": parsed.get("page_path")
-                },
-                "data": rows,
-                "summary": summary
+
+@app.get("/metrics")
+def metrics():
+    return Response(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+def build_response(req: AnalyticsRequest, parsed, mode, metrics, dimensions, rows, summary):
+    if mode == "realtime":
+        duration = rows[1]
+    else:
+        duration = [parsed["start_date"], parsed['end_date']]
+
+    return {
+        "metadata": {
+            "propertyId": req.propertyId,
+            "mode": mode,
+            "metrics": metrics,
+            "dimensions": dimensions,
+            "duration": duration,
+            "page_path": parsed.get("page_path")
+        },
+        "data": rows,
+        "summary": summary
+    }
+
+
+async def prepare_query(req: AnalyticsRequest, executor: StagedExecutor, prefetch: bool = True):
+    """
+    Parse, validate and auto-repair the question. Returns (parsed, mode,
+    speculative). ``prefetch=False`` skips the speculative core report for
+    callers that fetch it differently.
+    """
+    # 1. Parse while the property metadata is fetched
+    executor.start("metadata", get_property_metadata_async(req.propertyId))
+    parsed = await executor.run("parse", parse_query_async(req.query))
+    metrics = parsed.get("metrics", [])
+    dimensions = parsed.get("dimensions", [])
+
+    if not metrics:
+        raise ValueError("No valid GA4 metrics found")
+
+    # 2. Determine report mode
+    logger.info(f"Identified is_realtime is {parsed.get('is_realtime')}")
+    mode = "realtime" if is_realtime(parsed) else "core"
+    speculative = None
+    if mode == "realtime":
+        executor.cancel("metadata")
+    else:
+        if SPECULATIVE_REPORT_PREFETCH and prefetch:
+            speculative = {
+                **parsed,
+                "metrics": normalize_metrics(metrics),
+                "dimensions": normalize_dimensions(dimensions)
             }
+            executor.start("prefetch", execute_report_async(speculative, req.propertyId))
+        await executor.result("metadata")
+
+    # 3. Validate + auto-repair schema
+    metrics, dimensions = await executor.run("validate", validate_with_auto_repair_async(
+        property_id=req.propertyId,
+        metrics=metrics,
+        dimensions=dimensions,
+        mode=mode
+    ))
+    parsed['metrics'] = metrics
+    parsed['dimensions'] = dimensions
+    logger.info('Validataion of metrics and dimensions is completed')
+    return parsed, mode, speculative
+
+
+async def fetch_report(req: AnalyticsRequest, parsed, speculative, executor: StagedExecutor):
+    # 4. Execute report (router decides core vs realtime), reusing the
+    # speculative prefetch when validation left the query unchanged
+    rows = None
+    if speculative is not None:
+        if (speculative["metrics"], speculative["dimensions"]) == (parsed["metrics"], parsed["dimensions"]):
+            rows = await executor.result("prefetch")
         else:
-            summary = summarize(req.query, rows, metrics, dimensions, [parsed["start_date"],parsed['end_date']])
-
-            return {
-                "metadata": {
-                    "propertyId": req.propertyId,
-                    "mode": mode,
-                    "metrics": metrics,
-                    "dimensions": dimensions,
-                    "duration": [parsed["start_date"],parsed['end_date']],
-                    "page_path": parsed.get("page_path")
-                },
-                "data": rows,
-                "summary": summary
-            }
+            executor.cancel("prefetch")
+    if rows is None:
+        rows = await executor.run("execute", execute_report_async(parsed, req.propertyId))
+    return rows
+
+
+def report_data(parsed, mode, rows):
+    """Split the router result into (rows, duration)."""
+    if mode == "realtime":
+        return rows[0], rows[1]
+    return rows, [parsed["start_date"], parsed['end_date']]
+
+
+@app.post("/query", response_class=FrameJSONResponse)
+async def analytics_query(req: AnalyticsRequest):
+    if req.is_fanout():
+        return await analytics_query_fanout(req)
+    if not req.propertyId:
+        raise HTTPException(status_code=400, detail="propertyId, propertyIds or propertyGroup is required")
+
+    executor = StagedExecutor()
+    try:
+        parsed, mode, speculative = await prepare_query(req, executor)
+        metrics, dimensions = parsed["metrics"], parsed["dimensions"]
+        rows = await fetch_report(req, parsed, speculative, executor)
+
+        # 5. Summarize results
+        data, duration = report_data(parsed, mode, rows)
+        summary = await executor.run("summarize", summarize_async(req.query, data, metrics, dimensions, duration))
+
+        return FrameJSONResponse(build_response(req, parsed, mode, metrics, dimensions, rows, summary))
+
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        executor.cancel_pending()
+
+
+async def analytics_query_fanout(req: AnalyticsRequest):
+    """
+    Answer one question across several properties: parsed once, run
+    concurrently, merged into one report with a propertyId column.
+    """
+    try:
+        property_ids = resolve_properties(
+            ([req.propertyId] if req.propertyId else []) + (req.propertyIds or []),
+            req.propertyGroup
+        )
+        return FrameJSONResponse(await run_fanout(req.query, property_ids))
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.post("/query/batch", response_class=FrameJSONResponse)
+async def analytics_query_batch(req: BatchAnalyticsRequest):
+    """
+    Answer many questions about one property at once. Compatible questions
+    share GA4 reports; failures are reported per question.
+    """
+    try:
+        return FrameJSONResponse({"results": await run_batch(req.propertyId, req.queries)})
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+STREAM_ROW_CHUNK = int(os.getenv("STREAM_ROW_CHUNK", "500"))
+
+
+def frame_chunks(rows):
+    return (rows[i:i + STREAM_ROW_CHUNK] for i in range(0, len(rows), STREAM_ROW_CHUNK))
+
+
+def stream_event(event, data, fmt="sse"):
+    payload = data.to_json() if isinstance(data, ReportFrame) else json.dumps(data, default=str)
+    if fmt == "ndjson":
+        return f'{{"event": {json.dumps(event)}, "data": {payload}}}\n'
+    return f"event: {event}\ndata: {payload}\n\n"
+
+
+@app.post("/query/stream")
+async def analytics_query_stream(req: AnalyticsRequest, format: str = "sse"):
+    """
+    Streaming variant of /query. Emits parsed, validated, rows (in chunks),
+    summary_token and summary events as each stage completes, as
+    Server-Sent Events or NDJSON (?format=ndjson). Core report rows are
+    paged from GA4 and never held in memory all at once.
+    """
+    if not req.propertyId or req.is_fanout():
+        raise HTTPException(status_code=400, detail="Streaming supports a single propertyId")
+
+    async def events():
+        executor = StagedExecutor()
+        try:
+            # Core rows are streamed rather than fetched whole, so a speculative
+            # report would only spend quota and a scheduler slot
+            parsed, mode, speculative = await prepare_query(req, executor, prefetch=False)
+            metrics, dimensions = parsed["metrics"], parsed["dimensions"]
+            yield stream_event("parsed", {**parsed, "mode": mode}, format)
+            yield stream_event("validated", {"metrics": metrics, "dimensions": dimensions}, format)
+
+            if mode == "realtime":
+                # Realtime reports are small (at most a few thousand rows) and
+                # are not paged by GA4, so they are fetched whole and chunked
+                rows = await fetch_report(req, parsed, speculative, executor)
+                data, duration = report_data(parsed, mode, rows)
+                pages = frame_chunks(data)
+            else:
+                # Specs covered by the local rollups are answered from them;
+                # other core reports are streamed page by page from GA4 and
+                # folded into the summary digest without holding every row
+                duration = [parsed["start_date"], parsed['end_date']]
+                rolled = await executor.run("execute", run_rollup_report_async(
+                    req.propertyId, metrics, dimensions,
+                    parsed["start_date"], parsed["end_date"], parsed.get("page_path")
+                ))
+                pages = None if rolled is None else frame_chunks(rolled)
+            yield stream_event("metadata", {
+                "propertyId": req.propertyId,
+                "mode": mode,
+                "metrics": metrics,
+                "dimensions": dimensions,
+                "duration": duration,
+                "page_path": parsed.get("page_path")
+            }, format)
+
+            digest = RowDigest(metrics, dimensions)
+            if pages is None:
+                async for page in executor.iterate("execute", aiter_report_pages(
+                    req.propertyId, metrics, dimensions,
+                    parsed["start_date"], parsed["end_date"], parsed.get("page_path")
+                )):
+                    digest.add(page)
+                    for chunk in frame_chunks(page):
+                        yield stream_event("rows", chunk, format)
+            else:
+                for chunk in pages:
+                    digest.add(chunk)
+                    yield stream_event("rows", chunk, format)
+
+            async for kind, payload in summarize_digest_stream_async(req.query, digest.digest(), metrics, dimensions, duration):
+                yield stream_event(kind, payload, format)
+            yield stream_event("done", {}, format)
+
+        except Exception as e:
+            logger.error(f"Streaming query failed: {e}")
+            yield stream_event("error", {"detail": str(e)}, format)
+        finally:
+            executor.cancel_pending()
+
+    media_type = "application/x-ndjson" if format == "ndjson" else "text/event-stream"
+    return StreamingResponse(events(), media_type=media_type)
+
+
+
+async def realtime_subscription_spec(message: dict):
+    """Metrics, dimensions and minute ranges from a subscribe message or a question."""
+    if message.get("query"):
+        parsed = await parse_query_async(message["query"])
+        if not is_realtime(parsed):
+            raise ValueError("Only realtime questions can be subscribed to")
+        return parsed["metrics"], parsed["dimensions"], parsed.get("minute_ranges", ['29'])
+    return (
+        normalize_metrics(message.get("metrics", [])),
+        normalize_dimensions(message.get("dimensions", [])),
+        message.get("minute_ranges", ['29'])
+    )
+
+
+@app.websocket("/realtime/ws")
+async def realtime_ws(websocket: WebSocket):
+    """
+    Live realtime report. The client sends one JSON message with propertyId
+    and either a query or metrics / dimensions / minute_ranges; the server
+    sends a snapshot followed by diffs of the changed and removed rows.
+    """
+    await websocket.accept()
+    subscription = None
+    try:
+        message = await websocket.receive_json()
+        metrics, dimensions, minute_ranges = await realtime_subscription_spec(message)
+        subscription = realtime_hub.subscribe(message["propertyId"], metrics, dimensions, minute_ranges)
+        await websocket.send_json({
+            "type": "subscribed",
+            "metrics": metrics,
+            "dimensions": dimensions,
+            "minute_ranges": minute_ranges
+        })
+
+        # Waiting on the socket is what notices the client going away;
+        # anything else the client sends is ignored
+        incoming = asyncio.ensure_future(websocket.receive())
+        update = asyncio.ensure_future(subscription.get())
+        try:
+            while True:
+                done, _ = await asyncio.wait({update, incoming}, return_when=asyncio.FIRST_COMPLETED)
+                if incoming in done:
+                    if incoming.result()["type"] == "websocket.disconnect":
+                        break
+                    incoming = asyncio.ensure_future(websocket.receive())
+                if update in done:
+                    await websocket.send_json(update.result())
+                    update = asyncio.ensure_future(subscription.get())
+        finally:
+            incoming.cancel()
+            update.cancel()
 
+    except WebSocketDisconnect:
+        pass
     except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
\ No newline at end of file
+        logger.error(f"Realtime subscription failed: {e}")
+        await websocket.send_json({"type": "error", "detail": str(e)})
+        await websocket.close()
+    finally:
+        if subscription is not None:
+            realtime_hub.unsubscribe(subscription)
@@ -1,23 +1,14 @@
 from utils.packages import *
 from utils.config import *
+from utils.metrics import LLM_FALLBACKS
+from utils.logger import log_payload
 from utils.response_structure import *
+from app.parse_cache import parse_cache
+from app.fast_parser import fast_parse, FAST_PARSE_MIN_CONFIDENCE
+from app.llm_gateway import llm_gateway
 
-# ---------------- Rule-based fallback ----------------
-METRIC_MAP = {
-    "page views": "screenPageViews",
-    "pageviews": "screenPageViews",
-    "users": "totalUsers",
-    "sessions": "sessions"
-}
-
-DIMENSIONS = ["date"]
-
-# Enabled only if OPENAI_API_KEY is present
-def llm_parse(query: str):
-    logger.info(f"LLM Parse Running")
-    try:
-        logger.info(f"Client Initialized")
-        prompt = f"""
+def build_parse_prompt(query: str) -> str:
+    return f"""
         You are a Google Analytics 4 (GA4) query parsing agent.
 
 Your task is to convert a natural-language analytics question into a
@@ -87,27 +78,74 @@ OUTPUT FORMAT (STRICT)
 }}
 If you are unsure about a metric or dimension, OMIT it rather than guessing.
         """
-        logger.info(f"prompt is :- {prompt}")
-        response = client.chat.completions.create(
-            model=parser_model,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0
-        )
-        logger.info(f"Response:{response} and model used is {parser_model}")
+
+
+# Enabled only if OPENAI_API_KEY is present
+def llm_parse(query: str):
+    logger.info(f"LLM Parse Running")
+    try:
+        prompt = build_parse_prompt(query)
+        log_payload("Parse prompt", prompt)
+        response = llm_gateway.complete(parser_model, prompt, temperature=0)
+        log_payload("Parse response", response, model=parser_model)
         return safe_json_loads(response.choices[0].message.content)
     # return response
 
     except Exception as e:
         # Any failure → fallback to rules
         logger.error(f"Error {e}")
+        LLM_FALLBACKS.inc(component="parse")
+        return None
+
+
+async def llm_parse_async(query: str):
+    logger.info(f"LLM Parse Running")
+    try:
+        prompt = build_parse_prompt(query)
+        log_payload("Parse prompt", prompt)
+        response = await llm_gateway.complete_async(parser_model, prompt, temperature=0)
+        log_payload("Parse response", response, model=parser_model)
+        return safe_json_loads(response.choices[0].message.content)
+
+    except Exception as e:
+        # Any failure → fallback to rules
+        logger.error(f"Error {e}")
+        LLM_FALLBACKS.inc(component="parse")
         return None
 
 
 # ---------------- Unified parser ----------------
 def parse_query(query: str):
-    # 1️⃣ Try LLM-based parsing
-    llm_result = llm_parse(query)
-
+    # 1️⃣ Deterministic fast path for common query shapes
+    fast = fast_parse(query)
+    if fast["confidence"] >= FAST_PARSE_MIN_CONFIDENCE:
+        logger.info(f"Fast path parsed query with confidence {fast['confidence']}")
+        return fast
+
+    # 2️⃣ Parse cache, then LLM-based parsing
+    llm_result = parse_cache.get(query)
+    if llm_result is None:
+        llm_result = llm_parse(query)
+        if llm_result:
+            parse_cache.put(query, llm_result)
+    return build_parsed_query(query, llm_result, fast)
+
+
+async def parse_query_async(query: str):
+    fast = fast_parse(query)
+    if fast["confidence"] >= FAST_PARSE_MIN_CONFIDENCE:
+        logger.info(f"Fast path parsed query with confidence {fast['confidence']}")
+        return fast
+
+    llm_result = parse_cache.get(query)
+    if llm_result is None:
+        llm_result = await llm_parse_async(query)
+        if llm_result:
+            parse_cache.put(query, llm_result)
+    return build_parsed_query(query, llm_result, fast)
+
+
+def build_parsed_query(query: str, llm_result, fast=None):
     if llm_result:
         logger.info(f"Got query response from LLM")
         days = llm_result.get("days", 7)
@@ -125,33 +163,9 @@ def parse_query(query: str):
             "is_realtime": llm_result.get("is_realtime", "False")
         }
 
-    # 2️⃣ Deterministic rule-based fallback
+    # 3️⃣ Low-confidence fast-path result as the fallback
     logger.info(f"Did not receive response from LLM, running Rules Fallback")
-    q = query.lower()
-
-    metrics = [v for k, v in METRIC_MAP.items() if k in q]
-    if not metrics:
+    fast = fast or fast_parse(query)
+    if not fast["metrics"]:
         raise ValueError("No valid GA4 metrics found in query")
-
-    days_match = re.search(r"last (\d+) days", q)
-    days = int(days_match.group(1)) if days_match else 7
-
-    end_date = date.today()
-    start_date = end_date - timedelta(days=days)
-
-    page_match = re.search(r"/(\w+)", q)
-    page_path = f"/{page_match.group(1)}" if page_match else None
-
-    return {
-        "metrics": metrics,
-        "dimensions": DIMENSIONS,
-        "start_date": start_date.isoformat(),
-        "end_date": end_date.isoformat(),
-        "page_path": page_path,
-        "dateRange": f"last {days} days",
-        "minute_ranges": llm_result.get("minute_ranges", ['29']),
-        "is_realtime": "False"
-    }
-
-
-
+    return fast
@@ -0,0 +1,229 @@
+"""
+Cache of LLM parse results for the natural-language parser.
+
+Queries are normalized into a template (lowercase, collapsed whitespace,
+numbers and page paths replaced by slots). The structured LLM result is
+stored with its days / page_path / minute_ranges bound to those slots, so
+"page views last 7 days for /pricing" and "page views last 30 days for /blog"
+share one entry and the new values are re-bound on a hit.
+
+Entries live in the configured cache backend, so workers share them; the
+trigram index used for near-duplicate matching is kept per worker and covers
+the templates that worker has stored or served.
+"""
+
+from utils.packages import *
+from utils.cache import cache_backend
+
+PARSE_CACHE_MAX_ENTRIES = int(os.getenv("PARSE_CACHE_MAX_ENTRIES", "2048"))
+PARSE_CACHE_TTL = int(os.getenv("PARSE_CACHE_TTL", "604800"))
+# Trigram Jaccard similarity needed to reuse a near-duplicate template;
+# 1.0 disables near-duplicate matching
+PARSE_CACHE_SIMILARITY = float(os.getenv("PARSE_CACHE_SIMILARITY", "1.0"))
+
+PATH_PATTERN = re.compile(r"(?<![\w.])/[\w\-./]*")
+NUMBER_PATTERN = re.compile(r"\d+")
+SLOT_PATTERN = re.compile(r"<(path|num)>")
+
+
+def clean_query(query: str) -> str:
+    return " ".join(query.lower().split()).strip(" ?.!")
+
+
+def normalize_query(query: str):
+    """Return (template, slots) where slots are the values cut out of the query."""
+    text = clean_query(query)
+    slots = []
+
+    def cut(kind):
+        def replace(match):
+            slots.append((kind, match.group(0)))
+            return f"<{kind}>"
+        return replace
+
+    text = PATH_PATTERN.sub(cut("path"), text)
+    text = NUMBER_PATTERN.sub(cut("num"), text)
+
+    # Paths are cut first so digits inside them stay in the path slot;
+    # reorder slots to match their position in the template
+    kinds = SLOT_PATTERN.findall(text)
+    by_kind = {"path": [v for k, v in slots if k == "path"], "num": [v for k, v in slots if k == "num"]}
+    slots = [by_kind[kind].pop(0) for kind in kinds]
+    return text, slots
+
+
+def trigrams(text: str) -> set:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def bind_slots(llm_result: dict, slots: list):
+    """
+    Replace values in the LLM result that came from a query slot with
+    {"slot": i}. Returns None when a slot is not accounted for, because the
+    result then depends on a value we cannot re-bind (e.g. "last 2 weeks").
+    """
+    used = set()
+
+    def bind(value):
+        for i, slot in enumerate(slots):
+            if str(value) == slot:
+                used.add(i)
+                return {"slot": i}
+        return value
+
+    bound = dict(llm_result)
+    if "days" in bound:
+        bound["days"] = bind(bound["days"])
+    if bound.get("page_path"):
+        bound["page_path"] = bind(bound["page_path"])
+    if isinstance(bound.get("minute_ranges"), list):
+        bound["minute_ranges"] = [bind(m) for m in bound["minute_ranges"]]
+
+    if used != set(range(len(slots))):
+        return None
+    return bound
+
+
+def rebind_slots(bound: dict, slots: list) -> dict:
+    def value(v, cast=str):
+        if isinstance(v, dict) and "slot" in v:
+            return cast(slots[v["slot"]])
+        return v
+
+    result = dict(bound)
+    if "days" in result:
+        result["days"] = value(result["days"], int)
+    if result.get("page_path"):
+        result["page_path"] = value(result["page_path"])
+    if isinstance(result.get("minute_ranges"), list):
+        result["minute_ranges"] = [value(m) for m in result["minute_ranges"]]
+    return result
+
+
+class ParseCache:
+    def __init__(self, maxsize: int = PARSE_CACHE_MAX_ENTRIES, similarity: float = PARSE_CACHE_SIMILARITY,
+                 ttl: int = PARSE_CACHE_TTL):
+        self.maxsize = maxsize
+        self.similarity = similarity
+        self._entries = cache_backend("parse", maxsize=maxsize, ttl=ttl)
+        # Near-duplicate index over templates known to this worker, LRU-bounded
+        self._known = OrderedDict()
+        self._grams = {}
+        self._index = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    def get(self, query: str):
+        template, slots = normalize_query(query)
+        exact = (clean_query(query), "exact")
+        found = self._entries.get_many([(template, "template"), exact])
+
+        key = (template, "template") if (template, "template") in found else exact if exact in found else None
+        near = False
+        if key is None and self.similarity < 1.0:
+            with self._lock:
+                key = self._nearest(template)
+            if key is not None:
+                found = self._entries.get_many([key])
+                near = key in found
+                if not near:
+                    # Evicted from the shared cache
+                    with self._lock:
+                        self._forget(key)
+                    key = None
+
+        with self._lock:
+            if key is None:
+                self.misses += 1
+                return None
+            self._remember(key)
+            if near:
+                self.near_hits += 1
+            else:
+                self.hits += 1
+
+        bound = found[key]
+        if key[1] == "exact":
+            slots = []
+        logger.info(f"Parse cache hit for template '{key[0]}'")
+        return rebind_slots(bound, slots)
+
+    def put(self, query: str, llm_result: dict):
+        template, slots = normalize_query(query)
+        bound = bind_slots(llm_result, slots)
+        if bound is None:
+            # Cache the exact text only: the result uses a number we can't re-bind
+            key = (clean_query(query), "exact")
+            bound = dict(llm_result)
+        else:
+            key = (template, "template")
+
+        self._entries.set(key, bound)
+        with self._lock:
+            self._remember(key)
+
+    def _remember(self, key):
+        if key in self._known:
+            self._known.move_to_end(key)
+            return
+        self._known[key] = True
+        self._add_to_index(key)
+        while len(self._known) > self.maxsize:
+            evicted, _ = self._known.popitem(last=False)
+            self._remove_from_index(evicted)
+
+    def _forget(self, key):
+        if self._known.pop(key, None):
+            self._remove_from_index(key)
+
+    def _nearest(self, template):
+        grams = trigrams(template)
+        kinds = SLOT_PATTERN.findall(template)
+        counts = {}
+        for gram in grams:
+            for key in self._index.get(gram, ()):
+                counts[key] = counts.get(key, 0) + 1
+
+        best, best_score = None, 0.0
+        for key, shared in counts.items():
+            if key[1] != "template" or SLOT_PATTERN.findall(key[0]) != kinds:
+                continue
+            score = shared / len(grams | self._grams[key])
+            if score > best_score:
+                best, best_score = key, score
+        return best if best_score >= self.similarity else None
+
+    def _add_to_index(self, key):
+        grams = trigrams(key[0])
+        self._grams[key] = grams
+        for gram in grams:
+            self._index.setdefault(gram, set()).add(key)
+
+    def _remove_from_index(self, key):
+        for gram in self._grams.pop(key, ()):
+            keys = self._index.get(gram)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self._index[gram]
+
+    def clear(self):
+        self._entries.clear()
+        with self._lock:
+            self._known.clear()
+            self._grams.clear()
+            self._index.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses
+        }
+
+
+parse_cache = ParseCache()
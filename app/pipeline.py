@@ -0,0 +1,118 @@
+"""
+Staged executor for the /query pipeline.
+
+Stages that do not depend on each other (e.g. the GA4 metadata fetch, which
+only needs the property ID, and the LLM parse) are started together, and
+every stage runs under its own deadline so late work is cancelled instead of
+holding the request open.
+"""
+
+from utils.packages import *
+from utils.metrics import STAGE_SECONDS, stage_timings
+
+STAGE_DEADLINES = {
+    "parse": float(os.getenv("PARSE_DEADLINE", "20")),
+    "metadata": float(os.getenv("METADATA_DEADLINE", "10")),
+    "validate": float(os.getenv("VALIDATE_DEADLINE", "20")),
+    "execute": float(os.getenv("EXECUTE_DEADLINE", "30")),
+    "summarize": float(os.getenv("SUMMARIZE_DEADLINE", "30")),
+}
+
+SPECULATIVE_REPORT_PREFETCH = os.getenv("SPECULATIVE_REPORT_PREFETCH", "false").lower() == "true"
+
+
+class StageTimeoutError(Exception):
+    def __init__(self, stage, deadline):
+        super().__init__(f"Stage '{stage}' exceeded its {deadline}s deadline")
+        self.stage = stage
+        self.deadline = deadline
+
+
+class StagedExecutor:
+    def __init__(self, deadlines: dict = None):
+        self.deadlines = {**STAGE_DEADLINES, **(deadlines or {})}
+        self._tasks = {}
+
+    async def _with_deadline(self, stage, awaitable):
+        deadline = self.deadlines.get(stage)
+        started = time.perf_counter()
+        try:
+            with STAGE_SECONDS.time(stage=stage):
+                return await asyncio.wait_for(awaitable, timeout=deadline)
+        except asyncio.TimeoutError:
+            logger.error(f"Stage '{stage}' timed out after {deadline}s")
+            raise StageTimeoutError(stage, deadline)
+        finally:
+            timings = stage_timings.get()
+            if timings is not None:
+                timings[stage] = round((time.perf_counter() - started) * 1000, 1)
+
+    async def iterate(self, stage, iterator):
+        """
+        Yield the items of an async iterator, the stage's deadline bounding
+        the total time spent waiting for them (not the time the consumer
+        spends on each item).
+        """
+        deadline = self.deadlines.get(stage)
+        waited = 0.0
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    timeout = None if deadline is None else max(deadline - waited, 0)
+                    item = await asyncio.wait_for(iterator.__anext__(), timeout=timeout)
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError:
+                    logger.error(f"Stage '{stage}' timed out after {deadline}s")
+                    raise StageTimeoutError(stage, deadline)
+                finally:
+                    waited += time.perf_counter() - started
+                yield item
+        finally:
+            await iterator.aclose()
+            STAGE_SECONDS.observe(waited, stage=stage)
+            timings = stage_timings.get()
+            if timings is not None:
+                timings[stage] = round(waited * 1000, 1)
+
+    def start(self, stage, awaitable):
+        """Start a stage in the background; collect it later with ``result``."""
+        task = asyncio.create_task(self._with_deadline(stage, awaitable))
+        self._tasks[stage] = task
+        return task
+
+    async def run(self, stage, awaitable):
+        """Run a stage inline under its deadline."""
+        return await self._with_deadline(stage, awaitable)
+
+    async def result(self, stage, default=None):
+        """
+        Wait for a background stage. Failures of background stages are
+        logged and turned into ``default`` so the caller can fall back to
+        doing the work inline.
+        """
+        task = self._tasks.get(stage)
+        if task is None:
+            return default
+        try:
+            return await task
+        except asyncio.CancelledError:
+            return default
+        except Exception as e:
+            logger.error(f"Background stage '{stage}' failed: {e}")
+            return default
+
+    def cancel(self, stage):
+        task = self._tasks.pop(stage, None)
+        if task is None:
+            return
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled():
+            # Mark unconsumed failures as retrieved
+            task.exception()
+
+    def cancel_pending(self):
+        for stage in list(self._tasks):
+            self.cancel(stage)
@@ -0,0 +1,158 @@
+"""
+Shared realtime polling.
+
+Subscribers asking for the same (property, metrics, dimensions, minute
+ranges) share one poller, so N viewers of a live dashboard cost one
+runRealtimeReport call per interval instead of N. Each poll is diffed
+against the previous one and only the changed / removed rows are pushed.
+A poller stops as soon as its last subscriber leaves.
+"""
+
+from utils.packages import *
+from app.ga4_client import run_realtime_report_async
+from app.ga4_schema_validator import validate_realtime_query
+
+REALTIME_POLL_INTERVAL = float(os.getenv("REALTIME_POLL_INTERVAL", "15"))
+REALTIME_POLL_JITTER = float(os.getenv("REALTIME_POLL_JITTER", "0.2"))
+REALTIME_MAX_BACKOFF = float(os.getenv("REALTIME_MAX_BACKOFF", "120"))
+REALTIME_SUBSCRIBER_QUEUE = int(os.getenv("REALTIME_SUBSCRIBER_QUEUE", "32"))
+
+
+def subscription_key(property_id, metrics, dimensions, minute_ranges):
+    return (
+        str(property_id),
+        tuple(sorted(metrics)),
+        tuple(dimensions),
+        tuple(str(m) for m in minute_ranges)
+    )
+
+
+def poll_delay(interval: float = REALTIME_POLL_INTERVAL, jitter: float = REALTIME_POLL_JITTER) -> float:
+    # Spread pollers out so they do not all hit the quota on the same tick
+    return interval * (1 + random.uniform(-jitter, jitter))
+
+
+def diff_rows(previous: dict, current: dict):
+    """Returns (changed rows, removed dimension keys) between two snapshots."""
+    changed = [row for key, row in current.items() if previous.get(key) != row]
+    removed = [list(key) for key in previous if key not in current]
+    return changed, removed
+
+
+class Subscription:
+    def __init__(self, key):
+        self.key = key
+        self.queue = asyncio.Queue(maxsize=REALTIME_SUBSCRIBER_QUEUE)
+
+    def push(self, message, snapshot):
+        if self.queue.full():
+            # A slow consumer cannot apply diffs it never saw; replace its
+            # backlog with the full current state
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            message = snapshot()
+        self.queue.put_nowait(message)
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class RealtimePoller:
+    def __init__(self, key):
+        self.key = key
+        self.property_id, metrics, dimensions, minute_ranges = key
+        self.metrics = list(metrics)
+        self.dimensions = list(dimensions)
+        self.minute_ranges = list(minute_ranges)
+        self.subscribers: Set[Subscription] = set()
+        self.rows = {}
+        self.polls = 0
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def snapshot(self) -> dict:
+        return {"type": "snapshot", "rows": list(self.rows.values()), "removed": []}
+
+    def broadcast(self, message):
+        for subscriber in list(self.subscribers):
+            subscriber.push(message, self.snapshot)
+
+    async def poll(self):
+        rows, _ = await run_realtime_report_async(
+            self.property_id, self.metrics, self.dimensions, self.minute_ranges
+        )
+        current = {tuple(row[d] for d in self.dimensions): row for row in rows}
+        changed, removed = diff_rows(self.rows, current)
+        self.rows = current
+        self.polls += 1
+        return changed, removed
+
+    async def run(self):
+        delay = REALTIME_POLL_INTERVAL
+        while True:
+            try:
+                first = self.polls == 0
+                changed, removed = await self.poll()
+                if first:
+                    self.broadcast(self.snapshot())
+                elif changed or removed:
+                    self.broadcast({"type": "diff", "rows": changed, "removed": removed})
+                delay = REALTIME_POLL_INTERVAL
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Realtime poll for {self.key} failed: {e}")
+                self.broadcast({"type": "error", "detail": str(e)})
+                delay = min(delay * 2, REALTIME_MAX_BACKOFF)
+            await asyncio.sleep(poll_delay(delay))
+
+
+class RealtimeHub:
+    def __init__(self):
+        self.pollers: dict = {}
+
+    def subscribe(self, property_id, metrics, dimensions, minute_ranges) -> Subscription:
+        validate_realtime_query(metrics, dimensions)
+        key = subscription_key(property_id, metrics, dimensions, minute_ranges)
+        subscription = Subscription(key)
+
+        poller = self.pollers.get(key)
+        if poller is None:
+            poller = self.pollers[key] = RealtimePoller(key)
+            poller.start()
+            logger.info(f"Started realtime poller for {key}")
+        elif poller.polls:
+            subscription.push(poller.snapshot(), poller.snapshot)
+        poller.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        poller = self.pollers.get(subscription.key)
+        if poller is None:
+            return
+        poller.subscribers.discard(subscription)
+        if not poller.subscribers:
+            poller.stop()
+            del self.pollers[subscription.key]
+            logger.info(f"Stopped realtime poller for {subscription.key}")
+
+    def close(self):
+        for poller in self.pollers.values():
+            poller.stop()
+        self.pollers.clear()
+
+    def stats(self) -> dict:
+        return {
+            "pollers": len(self.pollers),
+            "subscribers": sum(len(p.subscribers) for p in self.pollers.values())
+        }
+
+
+realtime_hub = RealtimeHub()
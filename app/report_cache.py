@@ -0,0 +1,155 @@
+"""
+Day-granular result cache for core GA4 reports.
+
+Reports that are broken down by ``date`` are stored per day, one cache entry
+per (property, sorted metrics, dimensions, page filter, day). A request only
+fetches the days that are missing from the cache or still mutable (the most
+recent REPORT_CACHE_MUTABLE_DAYS, i.e. today by default) and merges them with
+the cached closed days. Days are kept as ReportFrame slices so a hit is
+assembled with one concatenation per column. Per-day entries also let
+workers sharing the cache backend add days without overwriting each other.
+"""
+
+from utils.packages import *
+from utils.cache import cache_backend
+from app.ga4_client import *
+from app.report_frame import ReportFrame
+
+REPORT_CACHE_TTL = int(os.getenv("REPORT_CACHE_TTL", "86400"))
+# One entry is one day of one report
+REPORT_CACHE_MAX_ENTRIES = int(os.getenv("REPORT_CACHE_MAX_ENTRIES", "50000"))
+REPORT_CACHE_MUTABLE_DAYS = int(os.getenv("REPORT_CACHE_MUTABLE_DAYS", "1"))
+
+
+def report_cache_key(property_id, metrics, dimensions, page_path=None):
+    if isinstance(page_path, (list, tuple)):
+        page_path = tuple(page_path)
+    return (str(property_id), tuple(sorted(metrics)), tuple(dimensions), page_path or "")
+
+
+def is_cacheable(dimensions) -> bool:
+    # Only per-day rows can be merged across overlapping windows; aggregates
+    # such as totalUsers over a range are not the sum of their days
+    return "date" in dimensions
+
+
+class ReportCache:
+    def __init__(self, ttl: int = REPORT_CACHE_TTL, maxsize: int = REPORT_CACHE_MAX_ENTRIES,
+                 mutable_days: int = REPORT_CACHE_MUTABLE_DAYS):
+        self.mutable_days = mutable_days
+        self._cache = cache_backend("report", maxsize=maxsize, ttl=ttl, codec=(compact_day, None))
+
+    def first_mutable_day(self) -> date:
+        return date.today() - timedelta(days=self.mutable_days - 1)
+
+    def cached_days(self, key, start_date: str, end_date: str) -> dict:
+        """{iso day: frame or None (no rows)} for the closed days of the window in the cache."""
+        first_mutable = self.first_mutable_day()
+        wanted = [(*key, day.isoformat()) for day in iter_days(start_date, end_date) if day < first_mutable]
+        return {entry[-1]: frame for entry, frame in self._cache.get_many(wanted).items()}
+
+    def missing_ranges(self, key, start_date: str, end_date: str, days: dict = None):
+        """Contiguous (start, end) ISO ranges that have to be fetched from GA4."""
+        if days is None:
+            days = self.cached_days(key, start_date, end_date)
+        first_mutable = self.first_mutable_day()
+
+        ranges = []
+        current = None
+        for day in iter_days(start_date, end_date):
+            if day.isoformat() in days and day < first_mutable:
+                current = None
+                continue
+            if current is None:
+                current = [day, day]
+                ranges.append(current)
+            else:
+                current[1] = day
+        return [(s.isoformat(), e.isoformat()) for s, e in ranges]
+
+    def merge(self, key, start_date: str, end_date: str, fetched, metrics=None, dimensions=None, days: dict = None):
+        """
+        Store the closed days of ``fetched`` (a list of ((start, end), frame))
+        and return a ReportFrame for the full window in date order. ``days``
+        are the cached days already read by missing_ranges.
+        """
+        if days is None:
+            days = self.cached_days(key, start_date, end_date)
+        first_mutable = self.first_mutable_day()
+
+        fresh = {}
+        for (start, end), frame in fetched:
+            for day in iter_days(start, end):
+                fresh[day.isoformat()] = None
+            for value, rows in frame.split_by("date"):
+                fresh[ga4_date_to_iso(value)] = rows
+
+        self._cache.set_many(
+            ((*key, day), rows) for day, rows in fresh.items() if date.fromisoformat(day) < first_mutable
+        )
+
+        merged = []
+        for day in iter_days(start_date, end_date):
+            iso = day.isoformat()
+            merged.append(fresh[iso] if iso in fresh else days.get(iso))
+        return ReportFrame.concat(merged, metrics, dimensions)
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self) -> dict:
+        return self._cache.stats()
+
+
+def compact_day(frame):
+    # Day slices share the categories of the whole report; store only their own
+    return frame.compact() if frame is not None else None
+
+
+def iter_days(start_date: str, end_date: str):
+    day = date.fromisoformat(start_date)
+    end = date.fromisoformat(end_date)
+    while day <= end:
+        yield day
+        day += timedelta(days=1)
+
+
+def ga4_date_to_iso(value: str) -> str:
+    # GA4 returns the date dimension as YYYYMMDD
+    return f"{value[:4]}-{value[4:6]}-{value[6:8]}"
+
+
+report_cache = ReportCache()
+
+# -----------------------------
+# Cached report execution
+# -----------------------------
+
+def run_report_cached(property_id, metrics, dimensions, start_date, end_date, page_path=None):
+    if not is_cacheable(dimensions):
+        return run_report(property_id, metrics, dimensions, start_date, end_date, page_path)
+
+    key = report_cache_key(property_id, metrics, dimensions, page_path)
+    days = report_cache.cached_days(key, start_date, end_date)
+    gaps = report_cache.missing_ranges(key, start_date, end_date, days)
+    logger.info(f"Report cache needs {len(gaps)} GA4 range(s) for {start_date}..{end_date}")
+    fetched = [
+        ((start, end), run_report(property_id, metrics, dimensions, start, end, page_path))
+        for start, end in gaps
+    ]
+    return report_cache.merge(key, start_date, end_date, fetched, metrics, dimensions, days)
+
+
+async def run_report_cached_async(property_id, metrics, dimensions, start_date, end_date, page_path=None):
+    if not is_cacheable(dimensions):
+        return await run_report_async(property_id, metrics, dimensions, start_date, end_date, page_path)
+
+    key = report_cache_key(property_id, metrics, dimensions, page_path)
+    days = report_cache.cached_days(key, start_date, end_date)
+    gaps = report_cache.missing_ranges(key, start_date, end_date, days)
+    logger.info(f"Report cache needs {len(gaps)} GA4 range(s) for {start_date}..{end_date}")
+    results = await asyncio.gather(*[
+        run_report_async(property_id, metrics, dimensions, start, end, page_path)
+        for start, end in gaps
+    ])
+    return report_cache.merge(key, start_date, end_date, list(zip(gaps, results)), metrics, dimensions, days)
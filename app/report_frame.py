@@ -0,0 +1,345 @@
+"""
+Columnar GA4 report result.
+
+Metrics are held as one typed NumPy array each (int64 for TYPE_INTEGER,
+float64 for every other metric type) and dimensions are dictionary-encoded
+(int32 codes into a list of distinct values). Iterating a frame yields the
+familiar row dicts lazily, so existing consumers keep working, while
+to_numpy / to_arrow / to_json avoid building per-row dicts altogether.
+"""
+
+from utils.packages import *
+import numpy as np
+
+INTEGER_METRIC_TYPES = {"TYPE_INTEGER"}
+
+
+def metric_dtype(type_name) -> type:
+    return np.int64 if type_name in INTEGER_METRIC_TYPES else np.float64
+
+
+class ReportFrame:
+    def __init__(self, dimensions, metrics, codes: dict, categories: dict, columns: dict):
+        self.dimensions = list(dimensions)
+        self.metrics = list(metrics)
+        self.codes = codes
+        self.categories = categories
+        self.columns = columns
+
+    # -----------------------------
+    # Construction
+    # -----------------------------
+
+    @classmethod
+    def empty(cls, dimensions, metrics, metric_types: dict = None):
+        metric_types = metric_types or {}
+        return cls(
+            dimensions,
+            metrics,
+            {d: np.empty(0, dtype=np.int32) for d in dimensions},
+            {d: [] for d in dimensions},
+            {m: np.empty(0, dtype=metric_dtype(metric_types.get(m))) for m in metrics}
+        )
+
+    @classmethod
+    def from_response(cls, response, metrics, dimensions):
+        """Build a frame from a RunReportResponse / RunRealtimeReportResponse."""
+        header_types = {h.name: h.type_.name for h in response.metric_headers}
+        rows = list(response.rows)
+        n = len(rows)
+
+        columns = {}
+        for i, m in enumerate(metrics):
+            dtype = metric_dtype(header_types.get(m, "TYPE_INTEGER"))
+            raw = np.array([row.metric_values[i].value for row in rows], dtype=str)
+            columns[m] = raw.astype(dtype) if n else np.empty(0, dtype=dtype)
+
+        codes, categories = {}, {}
+        for i, d in enumerate(dimensions):
+            codes[d], categories[d] = encode(row.dimension_values[i].value for row in rows)
+        return cls(dimensions, metrics, codes, categories, columns)
+
+    @classmethod
+    def from_records(cls, records, metrics, dimensions, metric_types: dict = None):
+        records = list(records)
+        metric_types = metric_types or {}
+        columns = {}
+        for m in metrics:
+            values = [r[m] for r in records]
+            if m in metric_types:
+                dtype = metric_dtype(metric_types[m])
+            else:
+                dtype = np.int64 if all(isinstance(v, (int, np.integer)) for v in values) else np.float64
+            columns[m] = np.asarray(values, dtype=dtype)
+
+        codes, categories = {}, {}
+        for d in dimensions:
+            codes[d], categories[d] = encode(str(r[d]) for r in records)
+        return cls(dimensions, metrics, codes, categories, columns)
+
+    @classmethod
+    def concat(cls, frames, metrics=None, dimensions=None):
+        frames = [f for f in frames if f is not None]
+        if not frames:
+            return cls.empty(dimensions or [], metrics or [])
+        first = frames[0]
+        dimensions = list(dimensions or first.dimensions)
+        metrics = list(metrics or first.metrics)
+        if len(frames) == 1:
+            return cls(dimensions, metrics, first.codes, first.categories, first.columns)
+
+        codes, categories = {}, {}
+        for d in dimensions:
+            merged, lookup, parts = [], {}, []
+            for f in frames:
+                remap = np.empty(len(f.categories[d]), dtype=np.int32)
+                for i, value in enumerate(f.categories[d]):
+                    code = lookup.get(value)
+                    if code is None:
+                        code = lookup[value] = len(merged)
+                        merged.append(value)
+                    remap[i] = code
+                parts.append(remap[f.codes[d]])
+            codes[d], categories[d] = np.concatenate(parts), merged
+
+        columns = {}
+        for m in metrics:
+            dtype = np.result_type(*[f.columns[m].dtype for f in frames])
+            columns[m] = np.concatenate([f.columns[m] for f in frames]).astype(dtype, copy=False)
+        return cls(dimensions, metrics, codes, categories, columns)
+
+    def with_dimension(self, name, value):
+        """Same rows with a constant leading dimension, e.g. the propertyId of a fan-out."""
+        return ReportFrame(
+            [name] + self.dimensions,
+            self.metrics,
+            {name: np.zeros(len(self), dtype=np.int32), **self.codes},
+            {name: [value], **self.categories},
+            self.columns
+        )
+
+    def split_by(self, dimension):
+        """Yield (value, frame) per distinct value of ``dimension``, keeping row order."""
+        codes = self.codes[dimension]
+        order = np.argsort(codes, kind="stable")
+        bounds = np.cumsum(np.bincount(codes, minlength=len(self.categories[dimension])))
+        start = 0
+        for value, end in zip(self.categories[dimension], bounds.tolist()):
+            if end > start:
+                yield value, self.take(order[start:end])
+            start = end
+
+    def compact(self):
+        """Copy whose categories only hold the values used, e.g. before pickling a slice."""
+        codes, categories = {}, {}
+        for d in self.dimensions:
+            used, remapped = np.unique(self.codes[d], return_inverse=True)
+            codes[d] = remapped.astype(np.int32).reshape(-1)
+            categories[d] = [self.categories[d][i] for i in used.tolist()]
+        return ReportFrame(self.dimensions, self.metrics, codes, categories, dict(self.columns))
+
+    def project(self, dimensions):
+        """Same rows with only ``dimensions``, in that order (no aggregation)."""
+        return ReportFrame(
+            dimensions,
+            self.metrics,
+            {d: self.codes[d] for d in dimensions},
+            {d: self.categories[d] for d in dimensions},
+            self.columns
+        )
+
+    def filter_values(self, dimension, values, case_sensitive: bool = True):
+        """Rows whose ``dimension`` is one of ``values`` (ignoring case unless ``case_sensitive``)."""
+        fold = (lambda v: v) if case_sensitive else str.casefold
+        wanted = {fold(v) for v in values}
+        keep = np.array([fold(v) in wanted for v in self.categories[dimension]], dtype=bool)
+        if not len(keep):
+            return self
+        return self.take(np.nonzero(keep[self.codes[dimension]])[0])
+
+    def derive_dimension(self, source, name, fn):
+        """Add dimension ``name`` computed by ``fn`` from each distinct value of ``source``."""
+        remap, categories = encode(fn(v) for v in self.categories[source])
+        return ReportFrame(
+            self.dimensions + [name],
+            self.metrics,
+            {**self.codes, name: remap[self.codes[source]] if len(remap) else self.codes[source]},
+            {**self.categories, name: categories},
+            self.columns
+        )
+
+    def group_sum(self, dimensions):
+        """
+        One row per distinct combination of ``dimensions`` with the metrics
+        summed, in order of first appearance. Only meaningful for additive
+        metrics.
+        """
+        n = len(self)
+        if not dimensions:
+            columns = {m: c.sum(keepdims=True) if n else c for m, c in self.columns.items()}
+            return ReportFrame([], self.metrics, {}, {}, columns)
+
+        keys = np.stack([self.codes[d] for d in dimensions], axis=1) if n else np.empty((0, len(dimensions)), np.int32)
+        unique, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        # np.unique sorts by code; put groups back in order of first appearance
+        order = np.argsort(first, kind="stable")
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        groups = rank[inverse]
+
+        columns = {
+            m: np.bincount(groups, weights=c, minlength=len(unique)).astype(c.dtype)
+            for m, c in self.columns.items()
+        }
+        codes = {d: unique[order, i].astype(np.int32) for i, d in enumerate(dimensions)}
+        return ReportFrame(dimensions, self.metrics, codes, {d: self.categories[d] for d in dimensions}, columns)
+
+    def take(self, indices):
+        """New frame with the rows at ``indices``; categories are shared."""
+        return ReportFrame(
+            self.dimensions,
+            self.metrics,
+            {d: c[indices] for d, c in self.codes.items()},
+            self.categories,
+            {m: c[indices] for m, c in self.columns.items()}
+        )
+
+    # -----------------------------
+    # Row access
+    # -----------------------------
+
+    def __len__(self):
+        if self.metrics:
+            return len(self.columns[self.metrics[0]])
+        if self.dimensions:
+            return len(self.codes[self.dimensions[0]])
+        return 0
+
+    def __iter__(self):
+        dimension_values = [
+            (d, self.categories[d], self.codes[d].tolist()) for d in self.dimensions
+        ]
+        metric_values = [(m, self.columns[m].tolist()) for m in self.metrics]
+        for i in range(len(self)):
+            entry = {d: categories[codes[i]] for d, categories, codes in dimension_values}
+            for m, values in metric_values:
+                entry[m] = values[i]
+            yield entry
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return self.take(np.arange(len(self))[item])
+        if item < 0:
+            item += len(self)
+        entry = {d: self.categories[d][self.codes[d][item]] for d in self.dimensions}
+        for m in self.metrics:
+            entry[m] = self.columns[m][item].item()
+        return entry
+
+    def __eq__(self, other):
+        if isinstance(other, ReportFrame):
+            return self.to_records() == other.to_records()
+        if isinstance(other, list):
+            return self.to_records() == other
+        return NotImplemented
+
+    def __repr__(self):
+        return f"ReportFrame(rows={len(self)}, dimensions={self.dimensions}, metrics={self.metrics})"
+
+    def dimension_array(self, dimension):
+        """Decoded values of one dimension as an object array."""
+        categories = np.empty(len(self.categories[dimension]), dtype=object)
+        categories[:] = self.categories[dimension]
+        return categories[self.codes[dimension]]
+
+    # -----------------------------
+    # Export
+    # -----------------------------
+
+    def to_records(self) -> list:
+        return list(self)
+
+    def to_numpy(self) -> dict:
+        """Metric arrays as-is (no copy) and decoded dimension arrays."""
+        return {
+            **{d: self.dimension_array(d) for d in self.dimensions},
+            **self.columns
+        }
+
+    def to_arrow(self):
+        """pyarrow Table with dictionary-encoded dimensions; requires pyarrow."""
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise ImportError("ReportFrame.to_arrow requires the optional 'pyarrow' package")
+
+        arrays, names = [], []
+        for d in self.dimensions:
+            arrays.append(pa.DictionaryArray.from_arrays(
+                pa.array(self.codes[d], type=pa.int32()),
+                pa.array(self.categories[d], type=pa.string())
+            ))
+            names.append(d)
+        for m in self.metrics:
+            arrays.append(pa.array(self.columns[m]))
+            names.append(m)
+        return pa.Table.from_arrays(arrays, names=names)
+
+    def to_json(self) -> str:
+        """Serialize as a JSON list of row objects without building row dicts."""
+        if not len(self):
+            return "[]"
+        parts = []
+        for d in self.dimensions:
+            key = json.dumps(d)
+            encoded = [f"{key}: {json.dumps(v)}" for v in self.categories[d]]
+            parts.append([encoded[c] for c in self.codes[d].tolist()])
+        for m in self.metrics:
+            key = json.dumps(m)
+            parts.append([f"{key}: {json.dumps(v)}" for v in self.columns[m].tolist()])
+        return "[" + ", ".join("{" + ", ".join(fields) + "}" for fields in zip(*parts)) + "]"
+
+
+def encode(values):
+    """Dictionary-encode an iterable of strings into (int32 codes, categories)."""
+    lookup, categories, codes = {}, [], []
+    for value in values:
+        code = lookup.get(value)
+        if code is None:
+            code = lookup[value] = len(categories)
+            categories.append(value)
+        codes.append(code)
+    return np.asarray(codes, dtype=np.int32), categories
+
+# -----------------------------
+# JSON response
+# -----------------------------
+
+class FrameJSONResponse(JSONResponse):
+    """
+    JSONResponse that serializes any ReportFrame in the content with
+    ReportFrame.to_json only when the response is rendered.
+    """
+
+    def render(self, content) -> bytes:
+        # Random per response so no string in the content can match it.
+        nonce = uuid.uuid4().hex
+        frames = []
+
+        def strip(value):
+            if isinstance(value, ReportFrame):
+                frames.append(value)
+                return f"__report_frame_{nonce}_{len(frames) - 1}__"
+            if isinstance(value, dict):
+                return {k: strip(v) for k, v in value.items()}
+            if isinstance(value, (list, tuple)):
+                return [strip(v) for v in value]
+            return value
+
+        text = json.dumps(jsonable_encoder(strip(content)), ensure_ascii=False)
+        for i, frame in enumerate(frames):
+            text = text.replace(
+                f'"__report_frame_{nonce}_{i}__"', frame.to_json(), 1
+            )
+        return text.encode("utf-8")
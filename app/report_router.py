@@ -1,7 +1,10 @@
 from app.ga4_client import *
+from app.report_cache import *
+from app.rollup_store import run_rollup_report, run_rollup_report_async
+from utils.response_structure import *
 
 def execute_report(parsed_query, property_id):
-    if eval(parsed_query.get("is_realtime")):
+    if is_realtime(parsed_query):
         return run_realtime_report(
             property_id=property_id,
             metrics=parsed_query["metrics"],
@@ -9,7 +12,47 @@ def execute_report(parsed_query, property_id):
             minute_ranges=parsed_query.get("minute_ranges", ['30'])
         )
     else:
-        return run_report(
+        # Historical specs covered by the local rollups skip GA4 except for today
+        rolled = run_rollup_report(
+            property_id=property_id,
+            metrics=parsed_query["metrics"],
+            dimensions=parsed_query["dimensions"],
+            start_date=parsed_query["start_date"],
+            end_date=parsed_query["end_date"],
+            page_path=parsed_query.get("page_path")
+        )
+        if rolled is not None:
+            return rolled
+        return run_report_cached(
+            property_id=property_id,
+            metrics=parsed_query["metrics"],
+            dimensions=parsed_query["dimensions"],
+            start_date=parsed_query["start_date"],
+            end_date=parsed_query["end_date"],
+            page_path=parsed_query.get("page_path")
+        )
+
+
+async def execute_report_async(parsed_query, property_id):
+    if is_realtime(parsed_query):
+        return await run_realtime_report_async(
+            property_id=property_id,
+            metrics=parsed_query["metrics"],
+            dimensions=parsed_query["dimensions"],
+            minute_ranges=parsed_query.get("minute_ranges", ['30'])
+        )
+    else:
+        rolled = await run_rollup_report_async(
+            property_id=property_id,
+            metrics=parsed_query["metrics"],
+            dimensions=parsed_query["dimensions"],
+            start_date=parsed_query["start_date"],
+            end_date=parsed_query["end_date"],
+            page_path=parsed_query.get("page_path")
+        )
+        if rolled is not None:
+            return rolled
+        return await run_report_cached_async(
             property_id=property_id,
             metrics=parsed_query["metrics"],
             dimensions=parsed_query["dimensions"],
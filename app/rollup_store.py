@@ -0,0 +1,445 @@
+"""
+Local daily rollups of historical GA4 data for the busiest properties.
+
+For every property in ROLLUP_PROPERTIES the sync job stores, per cube
+(a set of dimensions and metrics from ROLLUP_CUBES), one compacted
+ReportFrame per day, broken down by ``date`` plus the cube's dimensions,
+in the SQLite file at ROLLUP_PATH. It fetches with run_report on the batch
+lane, re-fetching days that were synced less than ROLLUP_SETTLE_DAYS after
+they ended, as GA4 keeps processing late hits.
+
+A core report is answered from a cube when the cube has every requested
+metric and dimension (and pagePath when there is a page filter) and every
+closed day of the window has been synced. Rows are filtered by page, the
+cube's extra dimensions are summed away, and week / month / year style
+dimensions are derived from ``date``. Summing rows (over days or over a
+dimension) is only done when every metric is additive (ROLLUP_ADDITIVE_METRICS):
+user counts and ratios are not sums of their parts, so such specs go to
+GA4. Today is always fetched from GA4 and merged in.
+
+Run the sync from cron with ``python -m app.rollup_store``, or in the app
+every ROLLUP_SYNC_INTERVAL seconds. A lease in the database lets only one
+worker sync at a time.
+"""
+
+if __name__ == "__main__":
+    # Run as the sync job, so this is the process entry point: load .env
+    # before any module reads its settings
+    from dotenv import load_dotenv
+    load_dotenv()
+
+from utils.packages import *
+from utils.cache import connect_sqlite
+from utils.singleflight import call_key
+from app.ga4_client import run_report, run_report_async
+from app.ga4_scheduler import ga4_lane
+from app.report_frame import ReportFrame
+import numpy as np
+import pickle
+import socket
+
+ROLLUP_PROPERTIES = [p.strip() for p in os.getenv("ROLLUP_PROPERTIES", "").split(",") if p.strip()]
+ROLLUP_PATH = os.getenv("ROLLUP_PATH", ".cache/rollups.sqlite3")
+ROLLUP_HISTORY_DAYS = int(os.getenv("ROLLUP_HISTORY_DAYS", "400"))
+ROLLUP_SETTLE_DAYS = int(os.getenv("ROLLUP_SETTLE_DAYS", "3"))
+ROLLUP_SYNC_CHUNK_DAYS = int(os.getenv("ROLLUP_SYNC_CHUNK_DAYS", "31"))
+# 0 disables the in-app sync; use the CLI from cron instead
+ROLLUP_SYNC_INTERVAL = int(os.getenv("ROLLUP_SYNC_INTERVAL", "0"))
+
+DEFAULT_CUBES = {
+    "totals": {"dimensions": [], "metrics": ["screenPageViews", "sessions", "totalUsers"]},
+    "pages": {"dimensions": ["pagePath"], "metrics": ["screenPageViews", "sessions", "totalUsers"]},
+    "countries": {"dimensions": ["country"], "metrics": ["screenPageViews", "sessions", "totalUsers"]},
+    "devices": {"dimensions": ["deviceCategory"], "metrics": ["screenPageViews", "sessions", "totalUsers"]},
+}
+ROLLUP_CUBES = json.loads(os.getenv("ROLLUP_CUBES") or "null") or DEFAULT_CUBES
+
+# Metrics whose value over several days / dimension values is the sum of the parts
+ROLLUP_ADDITIVE_METRICS = set(
+    os.getenv(
+        "ROLLUP_ADDITIVE_METRICS",
+        "screenPageViews,sessions,eventCount,newUsers,engagedSessions,userEngagementDuration,"
+        "keyEvents,conversions,transactions,ecommercePurchases,purchaseRevenue,totalRevenue,"
+        "itemsPurchased,addToCarts,checkouts"
+    ).split(",")
+)
+
+
+def parse_ga4_date(value: str) -> date:
+    return date(int(value[:4]), int(value[4:6]), int(value[6:8]))
+
+
+def ga4_week(day: date) -> str:
+    # GA4 weeks start on Sunday and January 1st is always in week 01
+    offset = (day.replace(month=1, day=1).weekday() + 1) % 7
+    return f"{(day.timetuple().tm_yday - 1 + offset) // 7 + 1:02d}"
+
+
+# GA4 time dimensions that are a function of the date, in GA4's formats
+DATE_DERIVED_DIMENSIONS = {
+    "day": lambda d: f"{d.day:02d}",
+    "dayOfWeek": lambda d: str((d.weekday() + 1) % 7),
+    "week": ga4_week,
+    "month": lambda d: f"{d.month:02d}",
+    "year": lambda d: str(d.year),
+    "yearWeek": lambda d: f"{d.year}{ga4_week(d)}",
+    "yearMonth": lambda d: f"{d.year}{d.month:02d}",
+    "isoWeek": lambda d: f"{d.isocalendar()[1]:02d}",
+    "isoYearIsoWeek": lambda d: f"{d.isocalendar()[0]}{d.isocalendar()[1]:02d}",
+}
+
+
+def iter_days(start: date, end: date):
+    day = start
+    while day <= end:
+        yield day
+        day += timedelta(days=1)
+
+
+def day_ranges(days, max_days: int = ROLLUP_SYNC_CHUNK_DAYS):
+    """Sorted days -> contiguous (start, end) ranges of at most ``max_days``."""
+    ranges = []
+    for day in days:
+        if ranges and day - ranges[-1][1] == timedelta(days=1) and (day - ranges[-1][0]).days < max_days:
+            ranges[-1][1] = day
+        else:
+            ranges.append([day, day])
+    return [(start, end) for start, end in ranges]
+
+
+@dataclass
+class Cube:
+    name: str
+    dimensions: list
+    metrics: list
+
+    @property
+    def id(self) -> str:
+        # A changed definition starts a new cube; the old one is pruned
+        return f"{self.name}:{call_key(self.dimensions, sorted(self.metrics))[:12]}"
+
+    @property
+    def report_dimensions(self) -> list:
+        return ["date"] + self.dimensions
+
+
+@dataclass
+class RollupPlan:
+    """How a report spec is answered from a cube."""
+    cube: Cube
+    metrics: list
+    dimensions: list
+    # Dimensions of the daily frame: date plus the requested cube dimensions
+    base_dimensions: list
+    # (start, end) ISO range to fetch from GA4, i.e. today, or None
+    live_range: tuple
+    local: ReportFrame = None
+
+    def finish(self, live: ReportFrame = None) -> ReportFrame:
+        daily = ReportFrame.concat([self.local, live], self.metrics, self.base_dimensions)
+        for d in self.dimensions:
+            if d in DATE_DERIVED_DIMENSIONS:
+                fn = DATE_DERIVED_DIMENSIONS[d]
+                daily = daily.derive_dimension("date", d, lambda v, fn=fn: fn(parse_ga4_date(v)))
+        if "date" in self.dimensions:
+            return daily.project(self.dimensions)
+        return daily.group_sum(self.dimensions)
+
+
+def cubes_from_config(config: dict = None) -> list:
+    config = config or ROLLUP_CUBES
+    return [Cube(name, list(spec.get("dimensions", [])), list(spec["metrics"])) for name, spec in config.items()]
+
+
+class RollupStore:
+    def __init__(self, path: str = ROLLUP_PATH, properties=None, cubes=None):
+        self.path = path
+        self.properties = set(ROLLUP_PROPERTIES if properties is None else properties)
+        self.cubes = cubes if cubes is not None else cubes_from_config()
+        self._connections = threading.local()
+        self._ready = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.hits = 0
+        self.misses = 0
+
+    # -----------------------------
+    # Storage
+    # -----------------------------
+
+    def _connection(self):
+        conn = getattr(self._connections, "conn", None)
+        if conn is None or self._connections.pid != os.getpid():
+            conn = connect_sqlite(self.path)
+            self._connections.conn, self._connections.pid = conn, os.getpid()
+        if not self._ready:
+            with self._lock:
+                conn.executescript("""
+                    CREATE TABLE IF NOT EXISTS rollup_days (
+                        property_id TEXT NOT NULL,
+                        cube TEXT NOT NULL,
+                        day TEXT NOT NULL,
+                        frame BLOB NOT NULL,
+                        synced_at REAL NOT NULL,
+                        PRIMARY KEY (property_id, cube, day)
+                    ) WITHOUT ROWID;
+                    CREATE TABLE IF NOT EXISTS rollup_leases (
+                        name TEXT PRIMARY KEY,
+                        holder TEXT NOT NULL,
+                        expires_at REAL NOT NULL
+                    );
+                """)
+                self._ready = True
+        return conn
+
+    def load_days(self, property_id, cube: Cube, start: date, end: date) -> dict:
+        """{day: ReportFrame} of the synced days in [start, end]."""
+        rows = self._connection().execute(
+            "SELECT day, frame FROM rollup_days WHERE property_id = ? AND cube = ? AND day BETWEEN ? AND ?",
+            (str(property_id), cube.id, start.isoformat(), end.isoformat())
+        ).fetchall()
+        return {date.fromisoformat(day): pickle.loads(blob) for day, blob in rows}
+
+    def synced_at(self, property_id, cube: Cube) -> dict:
+        rows = self._connection().execute(
+            "SELECT day, synced_at FROM rollup_days WHERE property_id = ? AND cube = ?",
+            (str(property_id), cube.id)
+        ).fetchall()
+        return {date.fromisoformat(day): synced_at for day, synced_at in rows}
+
+    def store_days(self, property_id, cube: Cube, frames: dict):
+        now = time.time()
+        rows = [
+            (str(property_id), cube.id, day.isoformat(), pickle.dumps(frame, protocol=pickle.HIGHEST_PROTOCOL), now)
+            for day, frame in frames.items()
+        ]
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT OR REPLACE INTO rollup_days (property_id, cube, day, frame, synced_at) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def prune(self, property_id, oldest: date):
+        """Drop days past the history window and cubes no longer configured."""
+        ids = [cube.id for cube in self.cubes]
+        marks = ",".join("?" * len(ids))
+        self._connection().execute(
+            f"DELETE FROM rollup_days WHERE property_id = ? AND (day < ? OR cube NOT IN ({marks}))",
+            (str(property_id), oldest.isoformat(), *ids)
+        )
+
+    # -----------------------------
+    # Answering reports
+    # -----------------------------
+
+    def covers(self, property_id) -> bool:
+        return str(property_id) in self.properties
+
+    def choose_cube(self, metrics, dimensions, page_path):
+        """(cube, base dimensions) able to answer the spec, preferring the fewest rows to sum."""
+        time_dimensions = [d for d in dimensions if d == "date" or d in DATE_DERIVED_DIMENSIONS]
+        other = [d for d in dimensions if d not in time_dimensions]
+        needed = set(other) | ({"pagePath"} if page_path else set())
+        additive = all(m in ROLLUP_ADDITIVE_METRICS for m in metrics)
+        # An exact page filter usually leaves one pagePath value, so dropping it
+        # sums nothing; plan() checks for case variants of the page
+        single_page = isinstance(page_path, str) and bool(page_path)
+
+        best = None
+        for cube in self.cubes:
+            if not set(metrics) <= set(cube.metrics) or not needed <= set(cube.dimensions):
+                continue
+            summed = [d for d in cube.dimensions if d not in other and not (d == "pagePath" and single_page)]
+            if ("date" not in dimensions or summed) and not additive:
+                continue
+            rank = len(cube.dimensions)
+            if best is None or rank < best[0]:
+                best = (rank, cube, ["date"] + other)
+        return (best[1], best[2]) if best else (None, None)
+
+    def plan(self, property_id, metrics, dimensions, start_date, end_date, page_path=None, today: date = None):
+        """A RollupPlan with the local rows loaded, or None when the spec is not covered."""
+        if not self.covers(property_id) or not metrics:
+            return None
+        # Time dimensions not derivable from date (dateHour, ...) match no cube
+        cube, base_dimensions = self.choose_cube(metrics, dimensions, page_path)
+        if cube is None:
+            self.misses += 1
+            return None
+
+        today = today or date.today()
+        start, end = date.fromisoformat(start_date), date.fromisoformat(end_date)
+        closed_end = min(end, today - timedelta(days=1))
+        days = self.load_days(property_id, cube, start, closed_end) if start <= closed_end else {}
+        if any(day not in days for day in iter_days(start, closed_end)):
+            self.misses += 1
+            return None
+
+        frames = []
+        for day in iter_days(start, closed_end):
+            frame = days[day]
+            if page_path:
+                # Same match as the GA4 string / in-list filter: exact, ignoring case
+                paths = page_path if isinstance(page_path, (list, tuple)) else [page_path]
+                frame = frame.filter_values("pagePath", paths, case_sensitive=False)
+            frames.append(frame)
+        local = ReportFrame.concat(frames, cube.metrics, cube.report_dimensions)
+        if page_path and "pagePath" not in base_dimensions and not all(m in ROLLUP_ADDITIVE_METRICS for m in metrics):
+            # Several spellings of one page would be summed; GA4 deduplicates users across them
+            if len(set(local.dimension_array("pagePath").tolist())) > 1:
+                self.misses += 1
+                return None
+        if set(cube.report_dimensions) != set(base_dimensions):
+            local = local.group_sum(base_dimensions)
+        local = ReportFrame(base_dimensions, metrics, local.codes, local.categories, {m: local.columns[m] for m in metrics})
+
+        live_start = max(start, today)
+        live_range = (live_start.isoformat(), end_date) if live_start <= end else None
+        self.hits += 1
+        return RollupPlan(cube, list(metrics), list(dimensions), base_dimensions, live_range, local)
+
+    # -----------------------------
+    # Sync
+    # -----------------------------
+
+    def sync_property(self, property_id, history_days: int = ROLLUP_HISTORY_DAYS, today: date = None) -> int:
+        """Fetch missing and unsettled days of every cube; returns the days stored."""
+        today = today or date.today()
+        oldest = today - timedelta(days=history_days)
+        stored = 0
+        token = ga4_lane.set("batch")
+        try:
+            for cube in self.cubes:
+                synced = self.synced_at(property_id, cube)
+                wanted = [
+                    day for day in iter_days(oldest, today - timedelta(days=1))
+                    if day not in synced
+                    or (date.fromtimestamp(synced[day]) - day).days < ROLLUP_SETTLE_DAYS
+                ]
+                for start, end in day_ranges(wanted):
+                    frame = run_report(property_id, cube.metrics, cube.report_dimensions, start.isoformat(), end.isoformat())
+                    # Days without rows are stored too, as zero-row frames with the report's types
+                    empty = frame.take(np.arange(0)).compact()
+                    frames = {day: empty for day in iter_days(start, end)}
+                    for value, rows in frame.split_by("date"):
+                        frames[parse_ga4_date(value)] = rows.compact()
+                    self.store_days(property_id, cube, frames)
+                    stored += len(frames)
+            self.prune(property_id, oldest)
+        finally:
+            ga4_lane.reset(token)
+        logger.info(f"Rollup sync stored {stored} day(s) for property {property_id}")
+        return stored
+
+    def sync(self, property_ids=None) -> dict:
+        results = {}
+        for property_id in property_ids or sorted(self.properties):
+            try:
+                results[property_id] = self.sync_property(property_id)
+            except Exception as e:
+                logger.error(f"Rollup sync failed for property {property_id}: {e}")
+                results[property_id] = str(e)
+        return results
+
+    def acquire_lease(self, name: str, seconds: float) -> bool:
+        """Take or renew the named lease unless another live holder has it."""
+        conn = self._connection()
+        now = time.time()
+        holder = f"{socket.gethostname()}:{os.getpid()}"
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT holder, expires_at FROM rollup_leases WHERE name = ?", (name,)).fetchone()
+            if row is not None and row[0] != holder and row[1] > now:
+                conn.execute("COMMIT")
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO rollup_leases (name, holder, expires_at) VALUES (?, ?, ?)",
+                (name, holder, now + seconds)
+            )
+            conn.execute("COMMIT")
+            return True
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def start(self, interval: int = ROLLUP_SYNC_INTERVAL):
+        """Sync every ``interval`` seconds in a background thread (one worker at a time)."""
+        if interval <= 0 or not self.properties or self._thread is not None:
+            return
+
+        def loop():
+            while not self._stop.is_set():
+                try:
+                    if self.acquire_lease("sync", interval):
+                        self.sync()
+                except Exception as e:
+                    logger.error(f"Rollup sync loop failed: {e}")
+                self._stop.wait(interval)
+
+        self._thread = threading.Thread(target=loop, name="rollup-sync", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self) -> dict:
+        size = 0
+        if self.properties and os.path.exists(self.path):
+            size = self._connection().execute("SELECT COUNT(*) FROM rollup_days").fetchone()[0]
+        return {"size": size, "hits": self.hits, "misses": self.misses}
+
+
+rollup_store = RollupStore()
+
+# -----------------------------
+# Report execution
+# -----------------------------
+
+def run_rollup_report(property_id, metrics, dimensions, start_date, end_date, page_path=None):
+    """The report answered from rollups (plus today from GA4), or None when not covered."""
+    plan = rollup_store.plan(property_id, metrics, dimensions, start_date, end_date, page_path)
+    if plan is None:
+        return None
+    live = None
+    if plan.live_range:
+        live = run_report(property_id, metrics, plan.base_dimensions, *plan.live_range, page_path)
+    logger.info(f"Answered {metrics} by {dimensions} from the '{plan.cube.name}' rollup")
+    return plan.finish(live)
+
+
+async def run_rollup_report_async(property_id, metrics, dimensions, start_date, end_date, page_path=None):
+    if not rollup_store.covers(property_id):
+        return None
+    # SQLite reads and unpickling up to a year of days stay off the event loop
+    plan = await asyncio.to_thread(rollup_store.plan, property_id, metrics, dimensions, start_date, end_date, page_path)
+    if plan is None:
+        return None
+    live = None
+    if plan.live_range:
+        live = await run_report_async(property_id, metrics, plan.base_dimensions, *plan.live_range, page_path)
+    logger.info(f"Answered {metrics} by {dimensions} from the '{plan.cube.name}' rollup")
+    return plan.finish(live)
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Sync the GA4 rollup store")
+    parser.add_argument("property_ids", nargs="*", help="defaults to ROLLUP_PROPERTIES")
+    args = parser.parse_args()
+    if not args.property_ids and not rollup_store.properties:
+        sys.exit("No properties to sync: set ROLLUP_PROPERTIES (environment or .env) or pass property IDs")
+
+    results = rollup_store.sync(args.property_ids)
+    for property_id, result in results.items():
+        print(f"{property_id}: {result}")
+    # Failed properties are reported with their error message
+    sys.exit(1 if any(isinstance(result, str) for result in results.values()) else 0)
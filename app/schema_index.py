@@ -0,0 +1,184 @@
+"""
+Candidate retrieval over a property's GA4 schema.
+
+Indexes every metric and dimension by character trigrams of its api name
+and UI name and by the words of its UI name and description. A lookup
+gathers candidates from the inverted indexes and ranks them by edit-distance
+similarity plus word overlap, so a misspelt or paraphrased name
+("page veiws", "bounce", "traffic channel") can be mapped to a valid api
+name locally, or narrowed down to a handful of candidates for the LLM.
+"""
+
+from utils.packages import *
+
+SCHEMA_RESOLVE_THRESHOLD = float(os.getenv("SCHEMA_RESOLVE_THRESHOLD", "0.85"))
+SCHEMA_RESOLVE_MARGIN = float(os.getenv("SCHEMA_RESOLVE_MARGIN", "0.05"))
+SCHEMA_REPAIR_TOP_K = int(os.getenv("SCHEMA_REPAIR_TOP_K", "8"))
+
+# Candidates gathered from the n-gram index before edit-distance ranking
+RERANK_POOL = 64
+
+CAMEL_PATTERN = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+DESCRIPTION_STOPWORDS = {
+    "the", "a", "an", "of", "to", "in", "on", "for", "by", "and", "or", "is", "are", "that",
+    "with", "your", "this", "from", "as", "be", "was", "which", "at", "it", "its", "their",
+}
+
+
+def split_words(text: str) -> list:
+    """``screenPageViews`` / ``Screen page views`` -> ["screen", "page", "views"]."""
+    words = []
+    for part in re.split(r"[^A-Za-z0-9]+", text or ""):
+        words.extend(w.lower() for w in CAMEL_PATTERN.findall(part))
+    return words
+
+
+def compact(text: str) -> str:
+    return "".join(split_words(text))
+
+
+def trigrams(text: str) -> set:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def stem(word: str) -> str:
+    # Enough to match "views" with "view" and "sessions" with "session"
+    return word[:-1] if len(word) > 3 and word.endswith("s") else word
+
+
+def edit_distance(a: str, b: str) -> int:
+    """Levenshtein distance with adjacent transpositions ("veiws" -> "views" is 1)."""
+    before, previous = None, list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i]
+        for j in range(1, len(b) + 1):
+            cost = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (a[i - 1] != b[j - 1]))
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                cost = min(cost, before[j - 2] + 1)
+            current.append(cost)
+        before, previous = previous, current
+    return previous[-1]
+
+
+def similarity(a: str, b: str) -> float:
+    if not a or not b:
+        return 0.0
+    return 1.0 - edit_distance(a, b) / max(len(a), len(b))
+
+
+def word_overlap(query_words, words, min_similarity: float = 0.75) -> float:
+    """Share of ``query_words`` found in ``words``, allowing small typos per word."""
+    if not query_words or not words:
+        return 0.0
+    total = 0.0
+    for q in query_words:
+        if q in words:
+            total += 1.0
+            continue
+        best = max(similarity(q, w) for w in words)
+        total += best if best >= min_similarity else 0.0
+    return total / len(query_words)
+
+
+@dataclass
+class SchemaEntry:
+    api_name: str
+    kind: str
+    ui_name: str = ""
+    description: str = ""
+
+
+class SchemaIndex:
+    def __init__(self, entries):
+        self.entries: List[SchemaEntry] = list(entries)
+        self.by_name = {(e.kind, e.api_name): e for e in self.entries}
+        self._names = []
+        self._name_words = []
+        self._words = []
+        self._grams = {}
+        self._word_index = {}
+
+        for i, entry in enumerate(self.entries):
+            names = {compact(entry.api_name)}
+            if entry.ui_name:
+                names.add(compact(entry.ui_name))
+            self._names.append(names)
+
+            name_words = {stem(w) for w in split_words(entry.api_name) + split_words(entry.ui_name)}
+            self._name_words.append(name_words)
+            words = name_words | {
+                stem(w) for w in WORD_PATTERN.findall((entry.description or "").lower())
+                if w not in DESCRIPTION_STOPWORDS
+            }
+            self._words.append(words)
+
+            for name in names:
+                for gram in trigrams(name):
+                    self._grams.setdefault(gram, set()).add(i)
+            for word in words:
+                self._word_index.setdefault(word, set()).add(i)
+
+    @classmethod
+    def from_names(cls, metrics=(), dimensions=()):
+        return cls(
+            [SchemaEntry(m, "metric") for m in sorted(metrics)]
+            + [SchemaEntry(d, "dimension") for d in sorted(dimensions)]
+        )
+
+    def score(self, i, query: str, query_words: set) -> float:
+        name_score = max(similarity(query, name) for name in self._names[i])
+        if not query_words:
+            return name_score
+        # Words of the name ("page views" in screenPageViews) are strong
+        # evidence; words only found in the description just rank candidates
+        return max(
+            name_score,
+            0.9 * word_overlap(query_words, self._name_words[i]),
+            0.7 * word_overlap(query_words, self._words[i])
+        )
+
+    def candidates(self, name: str, kind: str = None, k: int = SCHEMA_REPAIR_TOP_K):
+        """Top ``k`` (api_name, score) for ``name``, optionally restricted to metrics / dimensions."""
+        query = compact(name)
+        query_words = {stem(w) for w in split_words(name)}
+        if not query:
+            return []
+
+        votes = {}
+        for gram in trigrams(query):
+            for i in self._grams.get(gram, ()):
+                votes[i] = votes.get(i, 0) + 1
+        for word in query_words:
+            for i in self._word_index.get(word, ()):
+                votes[i] = votes.get(i, 0) + 2
+
+        pool = sorted(votes, key=votes.get, reverse=True)[:RERANK_POOL]
+        scored = [
+            (self.entries[i].api_name, self.score(i, query, query_words))
+            for i in pool
+            if kind is None or self.entries[i].kind == kind
+        ]
+        scored.sort(key=lambda item: item[1], reverse=True)
+        return scored[:k]
+
+    def resolve(self, name: str, kind: str, threshold: float = SCHEMA_RESOLVE_THRESHOLD,
+                margin: float = SCHEMA_RESOLVE_MARGIN):
+        """The single valid api name ``name`` most likely meant, or None when unsure."""
+        if (kind, name) in self.by_name:
+            return name
+        ranked = self.candidates(name, kind, k=2)
+        if not ranked or ranked[0][1] < threshold:
+            return None
+        if len(ranked) > 1 and ranked[0][1] - ranked[1][1] < margin:
+            return None
+        return ranked[0][0]
+
+    def describe(self, api_name: str, kind: str) -> str:
+        entry = self.by_name.get((kind, api_name))
+        if entry is None or not (entry.ui_name or entry.description):
+            return api_name
+        label = entry.ui_name if entry.ui_name and entry.ui_name != api_name else ""
+        text = " - ".join(p for p in (label, entry.description) if p)
+        return f"{api_name} ({text[:120]})" if text else api_name
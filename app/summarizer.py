@@ -1,33 +1,38 @@
 from utils.packages import *
 from utils.response_structure import *
 from utils.config import *
+from utils.metrics import LLM_FALLBACKS
+from utils.logger import log_payload
+from utils.cache import cache_backend
+from app.insights import RowDigest, analyze, digest_to_summary
+from app.llm_gateway import llm_gateway
 
-def summarize(query, rows, metrics, dimensions, date_range):
-    logger.info(f"LLM Parse Running")
-    try:
-        api_key = os.getenv("LITELLM_KEY")
+# When false, summaries are built from the numeric digest alone without an LLM call
+SUMMARY_LLM_PHRASING = os.getenv("SUMMARY_LLM_PHRASING", "false").lower() == "true"
+SUMMARY_CACHE_TTL = int(os.getenv("SUMMARY_CACHE_TTL", "3600"))
+SUMMARY_CACHE_MAX_ENTRIES = int(os.getenv("SUMMARY_CACHE_MAX_ENTRIES", "1024"))
 
-        client = OpenAI(api_key=api_key,
-                        base_url="http://3.110.18.218")
+# LLM-phrased summaries by (model, prompt); the prompt embeds the digest, so
+# a hit means the same question over the same numbers
+summary_cache = cache_backend("summary", maxsize=SUMMARY_CACHE_MAX_ENTRIES, ttl=SUMMARY_CACHE_TTL)
 
-        logger.info(f"Client Initialized")
-        prompt = f"""
+def build_summary_prompt(query, insights, metrics, dimensions, date_range) -> str:
+    return f"""
         You are a senior data analyst specializing in Google Analytics 4 (GA4).
 
 Your task is to analyze GA4 report results and produce a concise, business-ready natural language summary.
 
 You will be given:
 - The original user query (natural language) : {query}
-- The GA4 report data (time-series and/or aggregate values): {rows}
+- A pre-computed analysis of the GA4 report data (trends, anomalies and top dimension values): {json.dumps(insights)}
 - The metrics, dimensions, and date range used: {[metrics, dimensions, date_range]}
 
 Your responsibilities:
-1. Identify overall trends (increasing, decreasing, flat)
-2. Highlight significant spikes, drops, or anomalies
-3. Compare start vs end of period when time-series data exists
-4. Call out notable patterns related to dimensions (e.g. page path, country, device)
-5. Keep explanations factual and grounded strictly in the provided data
-6. Do NOT speculate beyond the data
+1. Rephrase the pre-computed trends, anomalies and dimension insights for business stakeholders
+2. Keep every direction, anomaly and dimension value exactly as computed
+3. Write a high-level summary of overall performance
+4. Keep explanations factual and grounded strictly in the provided analysis
+5. Do NOT speculate beyond the data
 
 Constraints:
 - Do NOT mention internal implementation details
@@ -63,17 +68,94 @@ Return STRICT JSON ONLY in the following format:
 }
 
         """
-        logger.info(f"prompt is :- {prompt}")
-        response = client.chat.completions.create(
-            model=summarizer_model,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0
-        )
-        logger.info(f"Response:{response} and model used is {summarizer_model}")
-        return safe_json_loads(response.choices[0].message.content)
-    # return response
+
+
+def summarize(query, rows, metrics, dimensions, date_range):
+    insights = digest_to_summary(analyze(rows, metrics, dimensions))
+    if not SUMMARY_LLM_PHRASING:
+        return insights
+
+    logger.info(f"LLM Summary Running")
+    try:
+        prompt = build_summary_prompt(query, insights, metrics, dimensions, date_range)
+        log_payload("Summary prompt", prompt)
+        key = call_key(summarizer_model, prompt)
+        cached = summary_cache.get(key)
+        if cached is not None:
+            return cached
+        response = llm_gateway.complete(summarizer_model, prompt, temperature=0)
+        log_payload("Summary response", response, model=summarizer_model)
+        summary = safe_json_loads(response.choices[0].message.content)
+        summary_cache.set(key, summary)
+        return summary
+
+    except Exception as e:
+        # Any failure → fall back to the deterministic summary
+        logger.error(f"Error {e}")
+        LLM_FALLBACKS.inc(component="summarize")
+        return insights
+
+
+async def summarize_async(query, rows, metrics, dimensions, date_range):
+    insights = digest_to_summary(analyze(rows, metrics, dimensions))
+    if not SUMMARY_LLM_PHRASING:
+        return insights
+
+    logger.info(f"LLM Summary Running")
+    try:
+        prompt = build_summary_prompt(query, insights, metrics, dimensions, date_range)
+        log_payload("Summary prompt", prompt)
+        key = call_key(summarizer_model, prompt)
+        cached = summary_cache.get(key)
+        if cached is not None:
+            return cached
+        response = await llm_gateway.complete_async(summarizer_model, prompt, temperature=0)
+        log_payload("Summary response", response, model=summarizer_model)
+        summary = safe_json_loads(response.choices[0].message.content)
+        summary_cache.set(key, summary)
+        return summary
+
+    except Exception as e:
+        # Any failure → fall back to the deterministic summary
+        logger.error(f"Error {e}")
+        LLM_FALLBACKS.inc(component="summarize")
+        return insights
+
+
+async def summarize_stream_async(query, rows, metrics, dimensions, date_range):
+    digest = analyze(rows, metrics, dimensions)
+    async for event in summarize_digest_stream_async(query, digest, metrics, dimensions, date_range):
+        yield event
+
+
+async def summarize_digest_stream_async(query, digest, metrics, dimensions, date_range):
+    """
+    Yields ("summary_token", text) for every streamed LLM delta and finally
+    ("summary", dict). Without LLM phrasing only the final summary is sent.
+    """
+    insights = digest_to_summary(digest)
+    if not SUMMARY_LLM_PHRASING:
+        yield "summary", insights
+        return
+
+    logger.info(f"LLM Summary Streaming")
+    parts = []
+    try:
+        prompt = build_summary_prompt(query, insights, metrics, dimensions, date_range)
+        key = call_key(summarizer_model, prompt)
+        cached = summary_cache.get(key)
+        if cached is not None:
+            yield "summary", cached
+            return
+        async for delta in llm_gateway.stream_async(summarizer_model, prompt, temperature=0):
+            parts.append(delta)
+            yield "summary_token", delta
+        summary = safe_json_loads("".join(parts))
+        summary_cache.set(key, summary)
+        yield "summary", summary
 
     except Exception as e:
-        # Any failure → fallback to rules
+        # Any failure → fall back to the deterministic summary
         logger.error(f"Error {e}")
-        return None
\ No newline at end of file
+        LLM_FALLBACKS.inc(component="summarize")
+        yield "summary", insights
@@ -0,0 +1,228 @@
+"""
+Fake BetaAnalyticsDataClient / BetaAnalyticsDataAsyncClient.
+
+Serves synthetic metadata and reports with a configurable latency and row
+count. Report rows are deterministic for a given request so caches behave
+as they would against GA4, and ``limit`` / ``offset`` are honoured so
+pagination is exercised.
+"""
+
+import asyncio
+import time
+import zlib
+from datetime import date, timedelta
+
+import numpy as np
+from google.analytics.data_v1beta.types import (
+    BatchRunReportsResponse,
+    CheckCompatibilityResponse,
+    Compatibility,
+    DimensionCompatibility,
+    DimensionHeader,
+    DimensionMetadata,
+    DimensionValue,
+    Metadata,
+    MetricCompatibility,
+    MetricHeader,
+    MetricMetadata,
+    MetricType,
+    MetricValue,
+    PropertyQuota,
+    QuotaStatus,
+    Row,
+    RunRealtimeReportResponse,
+    RunReportResponse,
+)
+
+METRICS = {
+    "activeUsers": MetricType.TYPE_INTEGER,
+    "totalUsers": MetricType.TYPE_INTEGER,
+    "newUsers": MetricType.TYPE_INTEGER,
+    "sessions": MetricType.TYPE_INTEGER,
+    "engagedSessions": MetricType.TYPE_INTEGER,
+    "screenPageViews": MetricType.TYPE_INTEGER,
+    "eventCount": MetricType.TYPE_INTEGER,
+    "keyEvents": MetricType.TYPE_INTEGER,
+    "ecommercePurchases": MetricType.TYPE_INTEGER,
+    "engagementRate": MetricType.TYPE_FLOAT,
+    "bounceRate": MetricType.TYPE_FLOAT,
+    "sessionsPerUser": MetricType.TYPE_FLOAT,
+    "averageSessionDuration": MetricType.TYPE_SECONDS,
+    "userEngagementDuration": MetricType.TYPE_SECONDS,
+    "totalRevenue": MetricType.TYPE_CURRENCY,
+    "purchaseRevenue": MetricType.TYPE_CURRENCY,
+}
+
+DIMENSIONS = [
+    "date", "week", "month", "year", "hour", "dateHour", "pagePath", "pageTitle", "landingPage",
+    "country", "city", "region", "deviceCategory", "browser", "platform", "language", "source",
+    "medium", "sessionDefaultChannelGroup", "campaignName", "eventName", "minutesAgo",
+    "itemName", "itemBrand", "itemCategory", "itemId", "itemVariant",
+]
+
+ITEM_DIMENSIONS = {"itemName", "itemBrand", "itemCategory", "itemId", "itemVariant"}
+# Metrics that can be broken down by item dimensions
+ITEM_METRICS = {"ecommercePurchases", "purchaseRevenue", "totalRevenue"}
+
+
+def compatible(a, b):
+    """Pairwise rule of the fake property: item dimensions only go with item metrics."""
+    for x, y in ((a, b), (b, a)):
+        if x in ITEM_DIMENSIONS and y in METRICS and y not in ITEM_METRICS:
+            return False
+    return True
+
+
+def dimension_values(name, count, start=None):
+    if name == "date" and start is not None:
+        return [(start + timedelta(days=i)).strftime("%Y%m%d") for i in range(count)]
+    if name == "minutesAgo":
+        return [f"{i:02d}" for i in range(count)]
+    return [f"{name}-{i}" for i in range(count)]
+
+
+class FakeGA4Client:
+    def __init__(self, rows: int = 1000, latency: float = 0.05):
+        self.rows = rows
+        self.latency = latency
+        self.calls = {"metadata": 0, "report": 0, "realtime": 0, "batch": 0, "compatibility": 0}
+
+    def metadata(self):
+        return Metadata(
+            metrics=[MetricMetadata(api_name=m, ui_name=m, type_=t) for m, t in METRICS.items()],
+            dimensions=[DimensionMetadata(api_name=d, ui_name=d) for d in DIMENSIONS]
+        )
+
+    def compatibility(self, request):
+        fields = [m.name for m in request.metrics] + [d.name for d in request.dimensions]
+
+        def verdict(name):
+            ok = all(compatible(name, f) for f in fields if f != name)
+            return Compatibility.COMPATIBLE if ok else Compatibility.INCOMPATIBLE
+
+        return CheckCompatibilityResponse(
+            metric_compatibilities=[
+                MetricCompatibility(metric_metadata=MetricMetadata(api_name=m), compatibility=verdict(m))
+                for m in METRICS
+            ],
+            dimension_compatibilities=[
+                DimensionCompatibility(dimension_metadata=DimensionMetadata(api_name=d), compatibility=verdict(d))
+                for d in DIMENSIONS
+            ]
+        )
+
+    def report(self, request, realtime=False):
+        metrics = [m.name for m in request.metrics]
+        dimensions = [d.name for d in request.dimensions]
+
+        if realtime or not request.date_ranges:
+            total, start = min(self.rows, 30), None
+        else:
+            start = date.fromisoformat(request.date_ranges[0].start_date)
+            end = date.fromisoformat(request.date_ranges[0].end_date)
+            days = (end - start).days + 1
+            # A date breakdown has one row per day per combination of the others
+            total = self.rows if "date" not in dimensions else max(days, self.rows // days * days)
+
+        offset = int(getattr(request, "offset", 0) or 0)
+        limit = int(getattr(request, "limit", 0) or 0) or total
+        indexes = np.arange(offset, min(offset + limit, total))
+
+        seed = zlib.crc32(f"{metrics}{dimensions}".encode())
+        rng = np.random.default_rng(seed)
+        values = rng.integers(1, 5000, size=(total, len(metrics)))[indexes] if len(indexes) else np.empty((0, len(metrics)))
+
+        columns = []
+        for d in dimensions:
+            if d == "date" and start is not None:
+                labels = dimension_values(d, (end - start).days + 1, start)
+            else:
+                labels = dimension_values(d, 25)
+            columns.append([labels[i % len(labels)] for i in indexes.tolist()])
+
+        rows = []
+        for r, i in enumerate(indexes.tolist()):
+            rows.append(Row(
+                dimension_values=[DimensionValue(value=c[r]) for c in columns],
+                metric_values=[
+                    MetricValue(value=str(v if METRICS.get(m) == MetricType.TYPE_INTEGER else v / 1000))
+                    for m, v in zip(metrics, values[r].tolist())
+                ]
+            ))
+
+        cls = RunRealtimeReportResponse if realtime else RunReportResponse
+        return cls(
+            rows=rows,
+            row_count=total,
+            dimension_headers=[DimensionHeader(name=d) for d in dimensions],
+            metric_headers=[MetricHeader(name=m, type_=METRICS.get(m, MetricType.TYPE_INTEGER)) for m in metrics],
+            property_quota=PropertyQuota(
+                tokens_per_day=QuotaStatus(consumed=1 + total // 10000, remaining=200000),
+                tokens_per_hour=QuotaStatus(consumed=1 + total // 10000, remaining=40000)
+            )
+        )
+
+    # BetaAnalyticsDataClient surface
+
+    def get_metadata(self, name=None, request=None):
+        self.calls["metadata"] += 1
+        time.sleep(self.latency)
+        return self.metadata()
+
+    def check_compatibility(self, request):
+        self.calls["compatibility"] += 1
+        time.sleep(self.latency)
+        return self.compatibility(request)
+
+    def run_report(self, request):
+        self.calls["report"] += 1
+        time.sleep(self.latency)
+        return self.report(request)
+
+    def run_realtime_report(self, request):
+        self.calls["realtime"] += 1
+        time.sleep(self.latency)
+        return self.report(request, realtime=True)
+
+    def batch_run_reports(self, request):
+        self.calls["batch"] += 1
+        time.sleep(self.latency)
+        return BatchRunReportsResponse(reports=[self.report(r) for r in request.requests])
+
+
+class FakeGA4AsyncClient(FakeGA4Client):
+    async def get_metadata(self, name=None, request=None):
+        self.calls["metadata"] += 1
+        await asyncio.sleep(self.latency)
+        return self.metadata()
+
+    async def check_compatibility(self, request):
+        self.calls["compatibility"] += 1
+        await asyncio.sleep(self.latency)
+        return self.compatibility(request)
+
+    async def run_report(self, request):
+        self.calls["report"] += 1
+        await asyncio.sleep(self.latency)
+        return self.report(request)
+
+    async def run_realtime_report(self, request):
+        self.calls["realtime"] += 1
+        await asyncio.sleep(self.latency)
+        return self.report(request, realtime=True)
+
+    async def batch_run_reports(self, request):
+        self.calls["batch"] += 1
+        await asyncio.sleep(self.latency)
+        return BatchRunReportsResponse(reports=[self.report(r) for r in request.requests])
+
+
+def install(rows: int = 1000, latency: float = 0.05):
+    """Route the app's GA4 client manager to the fakes; returns (sync, async) clients."""
+    from app.ga4_client import client_manager
+
+    sync_client = FakeGA4Client(rows, latency)
+    async_client = FakeGA4AsyncClient(rows, latency)
+    client_manager.get_client = lambda *args, **kwargs: sync_client
+    client_manager.get_async_client = lambda *args, **kwargs: async_client
+    return sync_client, async_client
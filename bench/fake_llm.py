@@ -0,0 +1,157 @@
+"""
+Local stand-in for the OpenAI-compatible (LiteLLM) chat completions endpoint.
+
+Answers POST /chat/completions (and /v1/chat/completions) after a
+configurable latency with canned JSON chosen from the prompt: parse prompts
+get a GA4 query spec, repair prompts echo the first valid metric, summary
+prompts get a fixed summary. ``stream: true`` is answered as SSE chunks.
+
+    python bench/fake_llm.py --port 8765 --latency 0.8
+"""
+
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+QUERY_PATTERN = re.compile(r"Natural language query:\s*\n(.*?)\n", re.S)
+VALID_METRICS_PATTERN = re.compile(r"VALID METRICS[^\n]*\n((?:- .*\n)+)")
+
+CANNED_SUMMARY = {
+    "summary": "Traffic was steady over the period with no unusual movements.",
+    "trends": [],
+    "anomalies": [],
+    "dimension_insights": []
+}
+
+
+def parse_answer(prompt: str) -> dict:
+    from app.fast_parser import fast_parse
+
+    match = QUERY_PATTERN.search(prompt)
+    parsed = fast_parse(match.group(1).strip() if match else "")
+    days = (date.fromisoformat(parsed["end_date"]) - date.fromisoformat(parsed["start_date"])).days
+    return {
+        "metrics": parsed["metrics"] or ["sessions"],
+        "dimensions": parsed["dimensions"],
+        "days": days or 7,
+        "page_path": parsed["page_path"],
+        "minute_ranges": parsed["minute_ranges"],
+        "is_realtime": parsed["is_realtime"]
+    }
+
+
+def repair_answer(prompt: str) -> dict:
+    match = VALID_METRICS_PATTERN.search(prompt)
+    metrics = re.findall(r"^- (\w+)", match.group(1), re.M) if match else []
+    return {"metrics": metrics[:1] or ["sessions"], "dimensions": []}
+
+
+def canned_answer(prompt: str) -> dict:
+    if "query parsing agent" in prompt:
+        return parse_answer(prompt)
+    if "query repair agent" in prompt:
+        return repair_answer(prompt)
+    return CANNED_SUMMARY
+
+
+def completion(model, content, prompt_tokens):
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop"
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(content) // 4,
+            "total_tokens": prompt_tokens + len(content) // 4
+        }
+    }
+
+
+def stream_chunks(model, content, prompt_tokens, size=16):
+    base = {"id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion.chunk",
+            "created": int(time.time()), "model": model}
+    for i in range(0, len(content), size):
+        yield {**base, "choices": [{"index": 0, "delta": {"content": content[i:i + size]}, "finish_reason": None}]}
+    yield {**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+    yield {**base, "choices": [], "usage": {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": len(content) // 4,
+        "total_tokens": prompt_tokens + len(content) // 4
+    }}
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+    calls = 0
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_error(404)
+            return
+
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        with FakeLLMHandler.lock:
+            FakeLLMHandler.calls += 1
+        prompt = "\n".join(m.get("content", "") for m in body.get("messages", []))
+        content = json.dumps(canned_answer(prompt))
+        model = body.get("model") or "fake-model"
+        time.sleep(self.latency)
+
+        if body.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.end_headers()
+            for chunk in stream_chunks(model, content, len(prompt) // 4):
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.write(b"data: [DONE]\n\n")
+            return
+
+        payload = json.dumps(completion(model, content, len(prompt) // 4)).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def start_server(port: int = 0, latency: float = 0.0):
+    """Start the stub in a daemon thread; returns (server, base_url)."""
+    handler = type("BenchLLMHandler", (FakeLLMHandler,), {"latency": latency})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible chat endpoint")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds per completion")
+    args = parser.parse_args()
+
+    server, url = start_server(args.port, args.latency)
+    print(f"Fake LLM listening on {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,308 @@
+"""
+Offline load test for the /query pipeline.
+
+Starts the fake LLM endpoint (bench/fake_llm.py) and routes GA4 calls to the
+fake Data API client (bench/fake_ga4.py), then replays the question corpus
+through each pipeline stage and through app.main.analytics_query at a fixed
+concurrency. Reports p50 / p95 / p99 latency, throughput and peak RSS per
+stage, plus a cold-start profile: the time to import app.main and answer
+/health in a fresh interpreter, against a budget, and the import time of
+each app / utils module and of the heaviest third-party packages.
+
+    python bench/run.py --concurrency 16 --requests 200 --rows 5000 --llm-latency 0.8
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+STAGES = ("parse", "metadata", "validate", "execute", "summarize", "query")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the GA4 analytics pipeline against local fakes")
+    parser.add_argument("--corpus", default=os.path.join(ROOT, "bench", "corpus.txt"))
+    parser.add_argument("--requests", type=int, default=100, help="calls per stage")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rows", type=int, default=1000, help="rows per synthetic GA4 report")
+    parser.add_argument("--ga4-latency", type=float, default=0.05, help="seconds per GA4 call")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="seconds per LLM completion")
+    parser.add_argument("--llm-url", default=None, help="use an already running LLM stub instead of starting one")
+    parser.add_argument("--properties", type=int, default=1, help="number of distinct property IDs to spread load over")
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"comma separated subset of {','.join(STAGES)}")
+    parser.add_argument("--cold", action="store_true", help="clear the in-process caches before every call")
+    parser.add_argument("--llm-summary", action="store_true", help="enable SUMMARY_LLM_PHRASING")
+    parser.add_argument("--cache-backend", choices=("memory", "sqlite"), default="memory",
+                        help="sqlite uses a fresh cache file under /tmp")
+    parser.add_argument("--output", default=None, help="also write the report to this file (e.g. bench_output.txt)")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--startup-budget-ms", type=float, default=1000, help="cold start budget for import + /health")
+    parser.add_argument("--no-startup-profile", action="store_true", help="skip the cold-start import profile")
+    return parser.parse_args(argv)
+
+
+def load_corpus(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+
+def configure_environment(args):
+    """Point the app at the fakes. Must run before anything under app/ is imported."""
+    from fake_llm import start_server
+
+    if args.llm_url:
+        url = args.llm_url
+    else:
+        _, url = start_server(latency=args.llm_latency)
+    os.environ["LLM_BASE_URL"] = url
+    os.environ.setdefault("LITELLM_KEY", "bench")
+    os.environ.setdefault("PARSER_MODEL", "bench-parser")
+    os.environ.setdefault("SUMMARIZER_MODEL", "bench-summarizer")
+    os.environ["SUMMARY_LLM_PHRASING"] = "true" if args.llm_summary else "false"
+    os.environ.pop("GA4_METADATA_CACHE_DIR", None)
+    os.environ.pop("GA4_COMPATIBILITY_CACHE_DIR", None)
+    os.environ["LOG_LEVEL"] = "WARNING"
+    os.environ["CACHE_BACKEND"] = args.cache_backend
+    if args.cache_backend == "sqlite":
+        os.environ["CACHE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="spikeai-bench-"), "cache.sqlite3")
+    return url
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def clear_caches():
+    from app.parse_cache import parse_cache
+    from app.report_cache import report_cache
+    from app.ga4_schema_validator import metadata_store
+    from app.compatibility import compatibility_engine
+
+    from app.summarizer import summary_cache
+
+    parse_cache.clear()
+    report_cache.clear()
+    metadata_store._cache.clear()
+    compatibility_engine.clear()
+    summary_cache.clear()
+
+
+STARTUP_SCRIPT = """
+import time
+started = time.perf_counter()
+import app.main
+imported = time.perf_counter()
+app.main.health()
+print((imported - started) * 1000, (time.perf_counter() - started) * 1000)
+"""
+
+
+def startup_profile(budget_ms, top=10):
+    """Import app.main in a fresh interpreter under -X importtime."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", STARTUP_SCRIPT],
+        cwd=ROOT, env=dict(os.environ), capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"Cold start failed: {proc.stderr.strip().splitlines()[-1:]}")
+    import_ms, health_ms = (float(v) for v in proc.stdout.split()[-2:])
+
+    modules, packages = [], defaultdict(float)
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = (part.strip() for part in line[len("import time:"):].split("|"))
+        if name.split(".")[0] in ("app", "utils"):
+            modules.append({"module": name, "self_ms": int(self_us) / 1000, "cumulative_ms": int(cumulative_us) / 1000})
+        else:
+            packages[name.split(".")[0]] += int(self_us) / 1000
+
+    heaviest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+    return {
+        "import_ms": import_ms,
+        "health_ms": health_ms,
+        "budget_ms": budget_ms,
+        "within_budget": health_ms <= budget_ms,
+        "modules": sorted(modules, key=lambda m: m["cumulative_ms"], reverse=True),
+        "packages": [{"package": name, "self_ms": ms} for name, ms in heaviest]
+    }
+
+
+async def drive(name, calls, concurrency, cold=False):
+    """Run ``calls`` (zero-argument coroutine factories) at ``concurrency``."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], []
+
+    async def one(call):
+        async with semaphore:
+            if cold:
+                clear_caches()
+            started = time.perf_counter()
+            try:
+                await call()
+            except Exception as e:
+                errors.append(f"{type(e).__name__}: {e}")
+            latencies.append(time.perf_counter() - started)
+
+    rss_before = peak_rss_mb()
+    started = time.perf_counter()
+    await asyncio.gather(*[one(call) for call in calls])
+    wall = time.perf_counter() - started
+
+    ms = np.array(latencies) * 1000
+    return {
+        "stage": name,
+        "calls": len(calls),
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "p50_ms": float(np.percentile(ms, 50)) if len(ms) else 0.0,
+        "p95_ms": float(np.percentile(ms, 95)) if len(ms) else 0.0,
+        "p99_ms": float(np.percentile(ms, 99)) if len(ms) else 0.0,
+        "throughput_rps": len(calls) / wall if wall else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+        "rss_growth_mb": peak_rss_mb() - rss_before
+    }
+
+
+async def benchmark(args, corpus):
+    import app.main as main
+    from app.nl_parser import parse_query_async
+    from app.ga4_schema_validator import get_property_metadata_async, validate_with_auto_repair_async
+    from app.report_router import execute_report_async
+    from app.summarizer import summarize_async
+    from utils.response_structure import is_realtime
+    import fake_ga4
+
+    ga4, ga4_async = fake_ga4.install(rows=args.rows, latency=args.ga4_latency)
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+
+    questions = [corpus[i % len(corpus)] for i in range(args.requests)]
+    properties = [str(1000 + i % args.properties) for i in range(args.requests)]
+
+    # Parsed and validated specs for the stages that start mid-pipeline
+    plans = []
+    for query in corpus:
+        try:
+            parsed = await parse_query_async(query)
+            mode = "realtime" if is_realtime(parsed) else "core"
+            parsed["metrics"], parsed["dimensions"] = await validate_with_auto_repair_async(
+                property_id="1000", metrics=parsed["metrics"],
+                dimensions=parsed.get("dimensions", []), mode=mode
+            )
+            plans.append((query, parsed, mode))
+        except Exception as e:
+            print(f"Skipping '{query}' for stage benchmarks: {e}", file=sys.stderr)
+    plans = [plans[i % len(plans)] for i in range(args.requests)] if plans else []
+
+    async def report_for_plan(query, parsed, mode, pid):
+        rows = await execute_report_async(parsed, pid)
+        if mode == "realtime":
+            rows, duration = rows
+        else:
+            duration = [parsed["start_date"], parsed["end_date"]]
+        return rows, duration
+
+    inputs = {}
+    if "summarize" in stages:
+        for i, (query, parsed, mode) in enumerate(plans):
+            inputs[i] = await report_for_plan(query, parsed, mode, properties[i])
+
+    factories = {
+        "parse": [lambda q=q: parse_query_async(q) for q in questions],
+        "metadata": [lambda p=p: get_property_metadata_async(p) for p in properties],
+        "validate": [
+            lambda p=parsed, m=mode, pid=pid: validate_with_auto_repair_async(
+                property_id=pid, metrics=p["metrics"], dimensions=p["dimensions"], mode=m
+            )
+            for (_, parsed, mode), pid in zip(plans, properties)
+        ],
+        "execute": [
+            lambda p=parsed, pid=pid: execute_report_async(p, pid)
+            for (_, parsed, _), pid in zip(plans, properties)
+        ],
+        "summarize": [
+            lambda i=i, q=query, p=parsed: summarize_async(q, inputs[i][0], p["metrics"], p["dimensions"], inputs[i][1])
+            for i, (query, parsed, _) in enumerate(plans)
+        ],
+        "query": [
+            lambda q=q, pid=pid: main.analytics_query(main.AnalyticsRequest(propertyId=pid, query=q))
+            for q, pid in zip(questions, properties)
+        ],
+    }
+
+    results = []
+    for stage in stages:
+        if stage not in factories:
+            raise SystemExit(f"Unknown stage '{stage}'; choose from {', '.join(STAGES)}")
+        results.append(await drive(stage, factories[stage], args.concurrency, args.cold))
+    return results, {"ga4_calls": ga4_async.calls}
+
+
+def format_report(args, results, extra) -> str:
+    lines = [
+        f"requests/stage={args.requests} concurrency={args.concurrency} rows={args.rows} "
+        f"ga4_latency={args.ga4_latency}s llm_latency={args.llm_latency}s cold={args.cold} "
+        f"cache={args.cache_backend}",
+        f"{'stage':<10} {'calls':>6} {'errors':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+        f"{'req/s':>8} {'peak RSS MB':>12} {'RSS +MB':>8}",
+    ]
+    for r in results:
+        lines.append(
+            f"{r['stage']:<10} {r['calls']:>6} {r['errors']:>6} {r['p50_ms']:>9.1f} {r['p95_ms']:>9.1f} "
+            f"{r['p99_ms']:>9.1f} {r['throughput_rps']:>8.1f} {r['peak_rss_mb']:>12.1f} {r['rss_growth_mb']:>8.1f}"
+        )
+    for r in results:
+        if r["first_error"]:
+            lines.append(f"{r['stage']}: first error: {r['first_error']}")
+    lines.append(f"GA4 calls: {extra['ga4_calls']}")
+
+    startup = extra.get("startup")
+    if startup:
+        verdict = "within" if startup["within_budget"] else "OVER"
+        lines.append(
+            f"cold start: import app.main {startup['import_ms']:.0f} ms, /health ready {startup['health_ms']:.0f} ms "
+            f"({verdict} budget of {startup['budget_ms']:.0f} ms)"
+        )
+        lines.append(f"{'module':<32} {'self ms':>9} {'cum ms':>9}")
+        for m in startup["modules"]:
+            lines.append(f"{m['module']:<32} {m['self_ms']:>9.1f} {m['cumulative_ms']:>9.1f}")
+        lines.append("heaviest third-party packages (self ms): " + ", ".join(
+            f"{p['package']} {p['self_ms']:.0f}" for p in startup["packages"]
+        ))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    corpus = load_corpus(args.corpus)
+    configure_environment(args)
+
+    # Profiled before the benchmark imports the app into this process
+    startup = None if args.no_startup_profile else startup_profile(args.startup_budget_ms)
+    results, extra = asyncio.run(benchmark(args, corpus))
+    extra["startup"] = startup
+    report = json.dumps({"results": results, **extra}, indent=2) if args.json else format_report(args, results, extra)
+    print(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,8 @@
 set -e
 
 PORT=8080
+# Worker processes; with more than one, caches are shared through SQLite
+WORKERS=${WORKERS:-1}
 
 echo "Starting deployment..."
 
@@ -27,10 +29,15 @@ fi
 
 uv pip install -r requirements.txt
 
-echo "Starting server on port $PORT..."
+if [ "$WORKERS" -gt 1 ]; then
+  export CACHE_BACKEND=${CACHE_BACKEND:-sqlite}
+fi
+
+echo "Starting server on port $PORT with $WORKERS worker(s)..."
 nohup python -m uvicorn app.main:app \
   --host 0.0.0.0 \
   --port $PORT \
+  --workers $WORKERS \
   > server.log 2>&1 &
 
 echo "Deployment completed successfully."
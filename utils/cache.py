@@ -0,0 +1,364 @@
+"""
+Cache backends.
+
+Every cache in the app goes through ``cache_backend(namespace, ...)``, which
+returns an in-process TTLCache or, with CACHE_BACKEND=sqlite, a SQLiteCache
+in the shared database file at CACHE_PATH. That file is opened in WAL mode
+so several uvicorn workers read and write the same entries. Both backends
+expose get_entry / get / get_many / set / set_many / delete / clear / stats,
+with per-entry TTLs and LRU eviction at ``maxsize`` entries per namespace.
+"""
+
+from utils.packages import *
+import pickle
+import sqlite3
+
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory").lower()
+CACHE_PATH = os.getenv("CACHE_PATH", ".cache/spikeai.sqlite3")
+# Whole-file cap; least recently used entries of any namespace go first
+CACHE_MAX_MB = float(os.getenv("CACHE_MAX_MB", "512"))
+CACHE_SQLITE_TIMEOUT = float(os.getenv("CACHE_SQLITE_TIMEOUT", "5"))
+# How long a worker may serve its decoded copy of a shared entry
+CACHE_LOCAL_TTL = float(os.getenv("CACHE_LOCAL_TTL", "60"))
+
+# Writes between eviction passes, and how stale an entry's LRU timestamp may
+# get before a read refreshes it (saves a write on most hits)
+EVICT_EVERY = 64
+TOUCH_INTERVAL = 30
+
+
+class CacheBackend:
+    """Operations shared by the backends on top of get_entry / set."""
+
+    def get(self, key, default=None):
+        entry = self.get_entry(key)
+        return default if entry is None else entry[0]
+
+    def get_many(self, keys) -> dict:
+        """{key: value} for the keys that are present and fresh."""
+        found = {}
+        for key in keys:
+            entry = self.get_entry(key)
+            if entry is not None:
+                found[key] = entry[0]
+        return found
+
+    def set_many(self, items, stored_at: float = None):
+        for key, value in items:
+            self.set(key, value, stored_at)
+
+    def latest(self, key, default=None):
+        """The value as last written by any process, skipping in-process copies."""
+        return self.get(key, default)
+
+    def __contains__(self, key):
+        return self.get_entry(key) is not None
+
+# -----------------------------
+# In-process TTL + LRU cache
+# -----------------------------
+
+class TTLCache(CacheBackend):
+    """
+    Thread-safe mapping with a per-entry time-to-live and LRU eviction.
+
+    Entries are stored with the time they were written so callers can decide
+    to serve a stale-but-present value while refreshing it in the background.
+    """
+
+    def __init__(self, maxsize: int = 128, ttl: float = 3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_entry(self, key):
+        """Return (value, stored_at) or None if the key is missing or expired."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, stored_at = entry
+            if self.ttl is not None and time.time() - stored_at > self.ttl:
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value, stored_at
+
+    def set(self, key, value, stored_at: float = None):
+        with self._lock:
+            self._data[key] = (value, stored_at if stored_at is not None else time.time())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def items(self):
+        with self._lock:
+            return list(self._data.items())
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def stats(self) -> dict:
+        return {"size": len(self), "hits": self.hits, "misses": self.misses}
+
+# -----------------------------
+# Shared SQLite cache
+# -----------------------------
+
+def connect_sqlite(path: str) -> sqlite3.Connection:
+    """Autocommit connection to ``path`` in WAL mode, creating its directory."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=CACHE_SQLITE_TIMEOUT, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def storage_key(key) -> str:
+    return key if isinstance(key, str) else json.dumps(key, default=str, separators=(",", ":"))
+
+
+class SQLiteCache(CacheBackend):
+    """
+    One namespace of the shared SQLite cache file.
+
+    Values are pickled, after ``codec[0]`` when a codec is given (for objects
+    that are better stored as plain data, e.g. ``to_dict`` / ``from_dict``).
+    With ``local_ttl`` decoded values are also kept in memory for that many
+    seconds, so hot entries skip the database and the decoding.
+    """
+
+    def __init__(self, namespace: str, path: str = CACHE_PATH, maxsize: int = 128, ttl: float = 3600,
+                 codec=None, local_ttl: float = 0):
+        self.namespace = namespace
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.encode, self.decode = codec or (None, None)
+        self._local = TTLCache(maxsize=maxsize, ttl=local_ttl) if local_ttl else None
+        self._connections = threading.local()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self._execute_script()
+
+    def _connection(self):
+        # sqlite3 connections are per thread; a forked worker opens its own
+        conn = getattr(self._connections, "conn", None)
+        if conn is None or self._connections.pid != os.getpid():
+            conn = connect_sqlite(self.path)
+            self._connections.conn, self._connections.pid = conn, os.getpid()
+        return conn
+
+    def _execute_script(self):
+        self._connection().executescript("""
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value BLOB,
+                size INTEGER NOT NULL,
+                stored_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS cache_entries_lru ON cache_entries (namespace, accessed_at);
+            CREATE INDEX IF NOT EXISTS cache_entries_accessed ON cache_entries (accessed_at);
+        """)
+
+    def _dumps(self, value) -> bytes:
+        return pickle.dumps(self.encode(value) if self.encode else value, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def _loads(self, blob):
+        value = pickle.loads(blob)
+        return self.decode(value) if self.decode else value
+
+    def _expired(self, stored_at, now) -> bool:
+        return self.ttl is not None and now - stored_at > self.ttl
+
+    def get_entry(self, key):
+        if self._local is not None:
+            entry = self._local.get(key)
+            if entry is not None:
+                self.hits += 1
+                return entry
+        return self._fetch([key]).get(key)
+
+    def get_many(self, keys) -> dict:
+        return {key: entry[0] for key, entry in self._fetch(list(keys)).items()}
+
+    def latest(self, key, default=None):
+        entry = self._fetch([key], keep_local=False).get(key)
+        return default if entry is None else entry[0]
+
+    def _fetch(self, keys, keep_local: bool = True) -> dict:
+        """{key: (value, stored_at)} for the present and fresh ``keys``."""
+        by_storage = {storage_key(k): k for k in keys}
+        now = time.time()
+        found, touch, expired = {}, [], []
+        try:
+            conn = self._connection()
+            names = list(by_storage)
+            for i in range(0, len(names), 500):
+                chunk = names[i:i + 500]
+                rows = conn.execute(
+                    f"SELECT key, value, stored_at, accessed_at FROM cache_entries "
+                    f"WHERE namespace = ? AND key IN ({','.join('?' * len(chunk))})",
+                    [self.namespace, *chunk]
+                ).fetchall()
+                for name, blob, stored_at, accessed_at in rows:
+                    if self._expired(stored_at, now):
+                        expired.append(name)
+                        continue
+                    found[by_storage[name]] = (self._loads(blob), stored_at)
+                    if now - accessed_at > TOUCH_INTERVAL:
+                        touch.append(name)
+            if touch:
+                conn.executemany(
+                    "UPDATE cache_entries SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                    [(now, self.namespace, name) for name in touch]
+                )
+            if expired:
+                conn.executemany(
+                    "DELETE FROM cache_entries WHERE namespace = ? AND key = ?",
+                    [(self.namespace, name) for name in expired]
+                )
+        except Exception as e:
+            # A broken cache must never fail the request; treat it as a miss
+            logger.error(f"Cache read failed for {self.namespace}: {e}")
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        if self._local is not None and keep_local:
+            for key, entry in found.items():
+                self._local.set(key, entry)
+        return found
+
+    def set(self, key, value, stored_at: float = None):
+        self.set_many([(key, value)], stored_at)
+
+    def set_many(self, items, stored_at: float = None):
+        items = list(items)
+        if not items:
+            return
+        stored_at = stored_at if stored_at is not None else time.time()
+        now = time.time()
+        try:
+            rows = []
+            for key, value in items:
+                blob = self._dumps(value)
+                rows.append((self.namespace, storage_key(key), blob, len(blob), stored_at, now))
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO cache_entries "
+                    "(namespace, key, value, size, stored_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        except Exception as e:
+            logger.error(f"Cache write failed for {self.namespace}: {e}")
+            return
+
+        if self._local is not None:
+            for key, value in items:
+                self._local.set(key, (value, stored_at))
+        self._writes += len(items)
+        if self._writes >= EVICT_EVERY:
+            self._writes = 0
+            self.evict()
+
+    def evict(self):
+        """Drop expired entries, then the least recently used beyond maxsize and CACHE_MAX_MB."""
+        try:
+            conn = self._connection()
+            if self.ttl is not None:
+                conn.execute(
+                    "DELETE FROM cache_entries WHERE namespace = ? AND stored_at < ?",
+                    (self.namespace, time.time() - self.ttl)
+                )
+            count = conn.execute(
+                "SELECT COUNT(*) FROM cache_entries WHERE namespace = ?", (self.namespace,)
+            ).fetchone()[0]
+            if count > self.maxsize:
+                conn.execute(
+                    "DELETE FROM cache_entries WHERE namespace = ? AND key IN ("
+                    "SELECT key FROM cache_entries WHERE namespace = ? ORDER BY accessed_at LIMIT ?)",
+                    (self.namespace, self.namespace, count - self.maxsize)
+                )
+
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache_entries").fetchone()[0]
+            excess = total - CACHE_MAX_MB * 1024 * 1024
+            if excess > 0:
+                victims, freed = [], 0
+                for namespace, key, size in conn.execute(
+                    "SELECT namespace, key, size FROM cache_entries ORDER BY accessed_at"
+                ):
+                    victims.append((namespace, key))
+                    freed += size
+                    if freed >= excess:
+                        break
+                conn.executemany("DELETE FROM cache_entries WHERE namespace = ? AND key = ?", victims)
+        except sqlite3.Error as e:
+            logger.error(f"Cache eviction failed for {self.namespace}: {e}")
+
+    def delete(self, key):
+        if self._local is not None:
+            self._local.delete(key)
+        try:
+            self._connection().execute(
+                "DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (self.namespace, storage_key(key))
+            )
+        except sqlite3.Error as e:
+            logger.error(f"Cache delete failed for {self.namespace}: {e}")
+
+    def clear(self):
+        if self._local is not None:
+            self._local.clear()
+        try:
+            self._connection().execute("DELETE FROM cache_entries WHERE namespace = ?", (self.namespace,))
+        except sqlite3.Error as e:
+            logger.error(f"Cache clear failed for {self.namespace}: {e}")
+
+    def __len__(self):
+        try:
+            return self._connection().execute(
+                "SELECT COUNT(*) FROM cache_entries WHERE namespace = ?", (self.namespace,)
+            ).fetchone()[0]
+        except sqlite3.Error:
+            return 0
+
+    def stats(self) -> dict:
+        return {"size": len(self), "hits": self.hits, "misses": self.misses}
+
+
+def cache_backend(namespace: str, maxsize: int = 128, ttl: float = 3600, codec=None, local_ttl: float = 0):
+    """
+    The cache for ``namespace`` on the configured backend. ``codec`` and
+    ``local_ttl`` only apply to the shared backend.
+    """
+    if CACHE_BACKEND == "sqlite":
+        return SQLiteCache(namespace, CACHE_PATH, maxsize=maxsize, ttl=ttl, codec=codec, local_ttl=local_ttl)
+    if CACHE_BACKEND != "memory":
+        raise ValueError(f"Unknown CACHE_BACKEND '{CACHE_BACKEND}'; use 'memory' or 'sqlite'")
+    return TTLCache(maxsize=maxsize, ttl=ttl)
@@ -1,8 +1,33 @@
 from utils.packages import *
-load_dotenv()
+from utils.singleflight import SingleFlight, call_key
+
+# .env is loaded once by the process entry point (app/main.py, the rollup
+# sync CLI) before any module reads its settings, not as an import side effect
 
 api_key = os.getenv("LITELLM_KEY")
-client = OpenAI(api_key=api_key,
-                base_url="http://3.110.18.218")
+llm_base_url = os.getenv("LLM_BASE_URL", "http://3.110.18.218")
+# Default deadline of one LLM call; app/llm_gateway.py enforces it end to end
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "20"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "3"))
+# SDK retries would outlive the deadline; stragglers are hedged instead
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "0"))
+
+
+def llm_client_options() -> dict:
+    return {
+        "api_key": api_key,
+        "base_url": llm_base_url,
+        "timeout": OpenAITimeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+        "max_retries": LLM_MAX_RETRIES
+    }
+
+
+# One client per process so keep-alive connections are pooled across calls.
+# Built on first use so importing the app does not construct HTTP clients
+client = Lazy(lambda: OpenAI(**llm_client_options()), "client")
+async_client = Lazy(lambda: AsyncOpenAI(**llm_client_options()), "async_client")
 parser_model = os.getenv("PARSER_MODEL")
-summarizer_model = os.getenv("SUMMARIZER_MODEL")
\ No newline at end of file
+summarizer_model = os.getenv("SUMMARIZER_MODEL")
+
+# Identical prompts in flight at the same time share one completion
+llm_flight = SingleFlight("llm")
@@ -0,0 +1,104 @@
+"""
+Logging setup on top of loguru.
+
+``configure_logging`` installs one sink that writes either JSON lines
+(LOG_FORMAT=json, the default) or the usual text format. Records go through
+a background queue (LOG_ENQUEUE) so a slow disk or pipe never blocks a
+request, and every record carries the request ID of the request being
+handled.
+
+Large payloads (prompts, LLM responses, GA4 protobufs) are logged with
+``log_payload``. They are formatted only when they will be written: in full
+(up to LOG_PAYLOAD_MAX_CHARS) when DEBUG is enabled, otherwise for a
+LOG_PAYLOAD_SAMPLE_RATE fraction of calls at INFO, truncated to
+LOG_PAYLOAD_SAMPLE_CHARS. Any other message longer than LOG_MESSAGE_MAX_CHARS
+is truncated before it is written.
+"""
+
+from utils.packages import *
+from utils.metrics import request_id
+import sys
+import traceback
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+LOG_FILE = os.getenv("LOG_FILE")
+LOG_ENQUEUE = os.getenv("LOG_ENQUEUE", "true").lower() == "true"
+LOG_MESSAGE_MAX_CHARS = int(os.getenv("LOG_MESSAGE_MAX_CHARS", "2000"))
+LOG_PAYLOAD_MAX_CHARS = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "20000"))
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.01"))
+LOG_PAYLOAD_SAMPLE_CHARS = int(os.getenv("LOG_PAYLOAD_SAMPLE_CHARS", "500"))
+
+TEXT_FORMAT = (
+    "<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | <level>{level: <8}</level> | "
+    "{extra[request_id]} | <cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - "
+    "<level>{message}</level>"
+)
+
+DEBUG_LEVEL = logger.level("DEBUG").no
+# Level number at or above which records are written; set by configure_logging
+_min_level = logger.level(LOG_LEVEL).no
+
+
+def truncate(text: str, limit: int) -> str:
+    if limit <= 0 or len(text) <= limit:
+        return text
+    return f"{text[:limit]}... [{len(text) - limit} more chars]"
+
+
+def add_context(record):
+    if "request_id" not in record["extra"]:
+        record["extra"]["request_id"] = request_id.get() or "-"
+    if len(record["message"]) > LOG_MESSAGE_MAX_CHARS and record["level"].no > DEBUG_LEVEL:
+        record["message"] = truncate(record["message"], LOG_MESSAGE_MAX_CHARS)
+
+
+def json_formatter(record) -> str:
+    entry = {
+        "time": record["time"].isoformat(),
+        "level": record["level"].name,
+        "logger": f"{record['name']}:{record['function']}:{record['line']}",
+        "message": record["message"],
+        **record["extra"]
+    }
+    if record["exception"] is not None:
+        entry["exception"] = "".join(traceback.format_exception(*record["exception"]))
+    # Returned as a format string: escape braces so loguru leaves the JSON alone
+    record["extra"]["_json"] = json.dumps(entry, default=str)
+    return "{extra[_json]}\n"
+
+
+def configure_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT, sink=None, enqueue: bool = LOG_ENQUEUE):
+    """Replace loguru's default handler with the configured sink."""
+    global _min_level
+    logger.remove()
+    logger.configure(patcher=add_context)
+    logger.add(
+        sink or LOG_FILE or sys.stderr,
+        level=level,
+        format=json_formatter if fmt == "json" else TEXT_FORMAT,
+        enqueue=enqueue,
+        backtrace=False,
+        diagnose=False
+    )
+    _min_level = logger.level(level).no
+
+
+def debug_enabled() -> bool:
+    return _min_level <= DEBUG_LEVEL
+
+
+def log_payload(label: str, payload, **fields):
+    """
+    Log a large payload without formatting it unless it is written:
+    always at DEBUG, otherwise sampled at INFO and truncated.
+    """
+    if debug_enabled():
+        level, limit = "DEBUG", LOG_PAYLOAD_MAX_CHARS
+    elif random.random() < LOG_PAYLOAD_SAMPLE_RATE:
+        level, limit = "INFO", LOG_PAYLOAD_SAMPLE_CHARS
+    else:
+        return
+    logger.bind(payload=label, **fields).opt(lazy=True, depth=1).log(
+        level, "{}: {}", lambda: label, lambda: truncate(str(payload), limit)
+    )
@@ -0,0 +1,227 @@
+"""
+Minimal in-process Prometheus instrumentation.
+
+Counters, gauges and histograms with labels, rendered in the Prometheus
+text exposition format by ``registry.render()`` for the /metrics endpoint.
+Collectors registered with ``registry.collector`` are called at scrape time
+so existing ``stats()`` counters (caches, single-flight) are exported
+without touching their hot paths.
+"""
+
+from utils.packages import *
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+# Trace ID of the request being handled, if any
+request_id = contextvars.ContextVar("request_id", default=None)
+# {stage: milliseconds} of the request being handled, logged when it completes
+stage_timings = contextvars.ContextVar("stage_timings", default=None)
+
+
+def format_labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricFamily:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        missing = set(self.labelnames) - set(labels)
+        if missing:
+            raise ValueError(f"Metric {self.name} is missing labels {sorted(missing)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(MetricFamily):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+
+class Gauge(MetricFamily):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+
+class Histogram(MetricFamily):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts, _, _ = entry
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        out = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, n in zip(self.buckets, counts):
+                    cumulative += n
+                    out.append((f"{self.name}_bucket", key + (format_value(float(bound)),), cumulative))
+                out.append((f"{self.name}_bucket", key + ("+Inf",), count))
+                out.append((f"{self.name}_sum", key, total))
+                out.append((f"{self.name}_count", key, count))
+        return out
+
+    def label_names_for(self, sample_name):
+        return self.labelnames + ("le",) if sample_name.endswith("_bucket") else self.labelnames
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._collectors = []
+
+    def register(self, metric: MetricFamily):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def collector(self, fn):
+        """
+        Register ``fn() -> [(name, kind, documentation, labelnames, [(labels, value)])]``,
+        evaluated on every scrape.
+        """
+        self._collectors.append(fn)
+        return fn
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.header())
+            for sample_name, key, value in metric.samples():
+                names = metric.label_names_for(sample_name) if isinstance(metric, Histogram) else metric.labelnames
+                lines.append(f"{sample_name}{format_labels(names, key)} {format_value(value)}")
+
+        for fn in self._collectors:
+            try:
+                families = fn()
+            except Exception as e:
+                logger.error(f"Metrics collector {fn.__name__} failed: {e}")
+                continue
+            for name, kind, documentation, labelnames, samples in families:
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{format_labels(labelnames, labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# -----------------------------
+# Application metrics
+# -----------------------------
+
+STAGE_SECONDS = registry.histogram(
+    "spikeai_stage_seconds", "Time spent in each /query pipeline stage", ["stage"]
+)
+REQUEST_SECONDS = registry.histogram(
+    "spikeai_http_request_seconds", "HTTP request latency", ["method", "path", "status"]
+)
+LLM_FALLBACKS = registry.counter(
+    "spikeai_llm_fallbacks_total", "LLM calls that failed and fell back to the deterministic path", ["component"]
+)
+SCHEMA_REPAIRS = registry.counter(
+    "spikeai_schema_repairs_total", "Invalid metric / dimension names repaired, by method", ["method"]
+)
+LLM_SECONDS = registry.histogram(
+    "spikeai_llm_call_seconds", "LLM completion latency by model and outcome", ["model", "outcome"]
+)
+LLM_TOKENS = registry.counter(
+    "spikeai_llm_tokens_total", "LLM tokens reported by completion responses", ["model", "kind"]
+)
+GA4_QUOTA_CONSUMED = registry.counter(
+    "spikeai_ga4_quota_tokens_consumed_total", "GA4 property quota tokens consumed", ["property", "report"]
+)
+GA4_QUOTA_REMAINING = registry.gauge(
+    "spikeai_ga4_quota_tokens_remaining", "GA4 property quota tokens remaining at the last report",
+    ["property", "report", "window"]
+)
+
+
+def record_llm_usage(model, response):
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    LLM_TOKENS.inc(usage.prompt_tokens or 0, model=model, kind="prompt")
+    LLM_TOKENS.inc(usage.completion_tokens or 0, model=model, kind="completion")
+
+
+def record_property_quota(property_id, response, report="core"):
+    """Record the property_quota of a response requested with return_property_quota."""
+    quota = getattr(response, "property_quota", None)
+    if not quota:
+        return
+    GA4_QUOTA_CONSUMED.inc(quota.tokens_per_day.consumed, property=property_id, report=report)
+    for window in ("tokens_per_day", "tokens_per_hour", "tokens_per_project_per_hour"):
+        status = getattr(quota, window, None)
+        if status:
+            GA4_QUOTA_REMAINING.set(status.remaining, property=property_id, report=report, window=window)
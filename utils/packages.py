@@ -1,22 +1,89 @@
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta
 import re
 import json
-import re
+import asyncio
 import os
+import threading
+import time
+import random
+import hashlib
+import uuid
+import contextvars
+import importlib
+from contextlib import contextmanager
 from loguru import logger
 from dotenv import load_dotenv
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from pydantic import BaseModel
 
-from openai import OpenAI
-
-from google.analytics.data_v1beta import BetaAnalyticsDataClient
-from google.analytics.data_v1beta.types import (
-    RunRealtimeReportRequest,
-    MinuteRange
-)
-from google.analytics.data_v1beta.types import DateRange, Dimension, Metric, RunReportRequest, FilterExpression, Filter
-from google.oauth2 import service_account
-from functools import lru_cache
-from typing import List, Set
\ No newline at end of file
+from functools import lru_cache, partial
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import List, Set
+
+
+class Lazy:
+    """
+    Stand-in for a value built on first use (call or attribute access).
+
+    The openai and GA4 SDKs (with gRPC and protobuf) take most of a cold
+    start to import; going through Lazy keeps them off the startup path
+    while call sites use the names as before.
+    """
+
+    def __init__(self, factory, name=None):
+        self._factory = factory
+        self._name = name or getattr(factory, "__name__", "value")
+        self._value = None
+        self._lock = threading.Lock()
+
+    def resolve(self):
+        if self._value is None:
+            with self._lock:
+                if self._value is None:
+                    self._value = self._factory()
+        return self._value
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
+
+    def __repr__(self):
+        state = "loaded" if self._value is not None else "not loaded"
+        return f"<Lazy {self._name} ({state})>"
+
+
+def lazy_import(module: str, attr: str = None) -> Lazy:
+    def load():
+        value = importlib.import_module(module)
+        return getattr(value, attr) if attr else value
+    return Lazy(load, f"{module}.{attr}" if attr else module)
+
+
+OpenAI = lazy_import("openai", "OpenAI")
+AsyncOpenAI = lazy_import("openai", "AsyncOpenAI")
+OpenAITimeout = lazy_import("openai", "Timeout")
+
+GA4_TYPES = "google.analytics.data_v1beta.types"
+BetaAnalyticsDataClient = lazy_import("google.analytics.data_v1beta", "BetaAnalyticsDataClient")
+BetaAnalyticsDataAsyncClient = lazy_import("google.analytics.data_v1beta", "BetaAnalyticsDataAsyncClient")
+RunRealtimeReportRequest = lazy_import(GA4_TYPES, "RunRealtimeReportRequest")
+MinuteRange = lazy_import(GA4_TYPES, "MinuteRange")
+DateRange = lazy_import(GA4_TYPES, "DateRange")
+Dimension = lazy_import(GA4_TYPES, "Dimension")
+Metric = lazy_import(GA4_TYPES, "Metric")
+RunReportRequest = lazy_import(GA4_TYPES, "RunReportRequest")
+FilterExpression = lazy_import(GA4_TYPES, "FilterExpression")
+Filter = lazy_import(GA4_TYPES, "Filter")
+BatchRunReportsRequest = lazy_import(GA4_TYPES, "BatchRunReportsRequest")
+CheckCompatibilityRequest = lazy_import(GA4_TYPES, "CheckCompatibilityRequest")
+Compatibility = lazy_import(GA4_TYPES, "Compatibility")
+service_account = lazy_import("google.oauth2.service_account")
+GoogleAuthRequest = lazy_import("google.auth.transport.requests", "Request")
+google_exceptions = lazy_import("google.api_core.exceptions")
@@ -14,4 +14,15 @@ def safe_json_loads(llm_text: str) -> dict:
     llm_text = llm_text.strip()
 
     # 3. Parse JSON
-    return json.loads(llm_text)
\ No newline at end of file
+    return json.loads(llm_text)
+
+
+def is_realtime(parsed_query: dict) -> bool:
+    """
+    Reads the parser's is_realtime flag, which the LLM returns either as a
+    JSON boolean or as the string "True"/"False".
+    """
+    flag = parsed_query.get("is_realtime", False)
+    if isinstance(flag, str):
+        return flag.strip().lower() == "true"
+    return bool(flag)
@@ -0,0 +1,89 @@
+from utils.packages import *
+
+# -----------------------------
+# Request coalescing
+# -----------------------------
+
+def call_key(*parts) -> str:
+    """Canonical hash of a call's arguments (order-insensitive for dict keys)."""
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Collapses concurrent identical calls into one.
+
+    While a call for ``key`` is in flight, every other caller with the same
+    key waits for it and gets its result (or exception) instead of issuing
+    its own. Nothing is cached: once the call finishes the next caller runs
+    it again.
+    """
+
+    def __init__(self, name: str = "singleflight"):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._tasks = {}
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    async def do_async(self, key, fn, *args, **kwargs):
+        # Tasks belong to one event loop, so in-flight calls are per loop
+        loop_key = (id(asyncio.get_running_loop()), key)
+        with self._lock:
+            task = self._tasks.get(loop_key)
+            if task is None:
+                task = self._tasks[loop_key] = asyncio.ensure_future(fn(*args, **kwargs))
+                task.add_done_callback(lambda _: self._forget(loop_key, task))
+                self.calls += 1
+            else:
+                self.shared += 1
+
+        # A caller giving up must not cancel the call for everyone else
+        return await asyncio.shield(task)
+
+    def _forget(self, loop_key, task):
+        with self._lock:
+            if self._tasks.get(loop_key) is task:
+                del self._tasks[loop_key]
+        # Mark the exception retrieved even if every waiter went away
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> dict:
+        return {"calls": self.calls, "shared": self.shared}